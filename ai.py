@@ -1,11 +1,18 @@
 import json
-import os
+import logging
 import re
-import anthropic
+import time
+
+from ai_cache import ai_responses
+from ai_client import ai_client
+from models import db, AICall
+
+logger = logging.getLogger(__name__)
 
 
 def get_client():
-    return anthropic.Anthropic(api_key=os.environ.get("ANTHROPIC_API_KEY"))
+    """The process-wide Anthropic client (see ai_client.py)."""
+    return ai_client.client()
 
 
 def _extract_json(text):
@@ -32,45 +39,134 @@ def _extract_json(text):
         raise ValueError(f"Invalid JSON in response: {e}") from e
 
 
-def generate_workout_plan(profile, fitness_test=None, prior_review=None, extra_context=None):
-    client = get_client()
+class PlanStreamParser:
+    """Incremental scanner for a plan's JSON as it streams in.
 
-    fitness_test_section = ""
-    if fitness_test:
-        fitness_test_section = f"""
-Recent Fitness Test Results (use these to calibrate difficulty):
-- Push-ups: {fitness_test.pushups}
-- Pull-ups: {fitness_test.pullups}
-- Wall Sit: {fitness_test.wall_sit_seconds} seconds
-- Toe Touch: {fitness_test.toe_touch_inches} inches
-- Plank: {fitness_test.plank_seconds} seconds
-- Vertical Jump: {fitness_test.vertical_jump_inches} inches
-"""
+    feed() each text chunk; it returns the events completed by that chunk,
+    in order: ("meta", {"plan_name": ...}) and ("meta", {"description": ...})
+    once those strings close, and ("phase", {...}) / ("workout", {...}) for
+    each element of the top-level "phases" / "workouts" arrays once its
+    closing brace arrives. It tracks only string/escape state and nesting
+    depth, and keeps only the unfinished item's text, so each chunk costs
+    time proportional to its length. Anything before the first "{" (a
+    ```json fence) is skipped; the complete text is still parsed with
+    _extract_json() at the end.
+    """
 
-    prior_review_section = ""
-    if prior_review:
-        suggestions = prior_review.get("suggestions", [])
-        suggestions_text = "\n".join(f"  - {s}" for s in suggestions) if suggestions else "  None provided"
-        prior_review_section = f"""
-Prior Plan Review (use these insights to inform the new plan — build on what worked, address what didn't):
-- What was working well: {prior_review.get("whats_working", "N/A")}
-- Watch out for: {prior_review.get("watch_out_for", "N/A")}
-- Suggested adjustments:
-{suggestions_text}
-- Overall assessment: {prior_review.get("overall_assessment", "N/A")}
-"""
+    ARRAY_EVENTS = {"phases": "phase", "workouts": "workout"}
+    META_KEYS = ("plan_name", "description")
 
-    extra_context_section = ""
-    if extra_context and extra_context.strip():
-        extra_context_section = f"""
-Additional context from the user (treat this as high-priority input when building the plan):
-{extra_context.strip()}
-"""
+    def __init__(self):
+        self._chunks = []
+        self._window = ""  # the text from the oldest open string or item on
+        self._window_start = 0  # its offset in the whole text
+        self._stack = []  # open "{" / "[" characters
+        self._in_string = False
+        self._escape = False
+        self._string_start = None
+        self._last_string = None
+        self._key = None  # current top-level key
+        self._expect_value = False
+        self._item_start = None
+
+    @property
+    def text(self):
+        return "".join(self._chunks)
+
+    def feed(self, chunk):
+        self._chunks.append(chunk)
+        start = self._window_start + len(self._window)
+        self._window += chunk
+        window, offset = self._window, self._window_start
+        events = []
+        for i in range(start, start + len(chunk)):
+            c = window[i - offset]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif c == "\\":
+                    self._escape = True
+                elif c == '"':
+                    self._in_string = False
+                    if len(self._stack) == 1:
+                        self._close_top_level_string(window[self._string_start - offset:i + 1 - offset], events)
+                continue
+            if not self._stack and c != "{":
+                continue
+            if c == '"':
+                self._in_string = True
+                self._string_start = i
+            elif c in "{[":
+                self._stack.append(c)
+                if c == "{" and self._stack == ["{", "[", "{"] and self._key in self.ARRAY_EVENTS:
+                    self._item_start = i
+            elif c in "}]":
+                if c == "}" and self._item_start is not None and self._stack == ["{", "[", "{"]:
+                    try:
+                        item = json.loads(window[self._item_start - offset:i + 1 - offset])
+                        events.append((self.ARRAY_EVENTS[self._key], item))
+                    except json.JSONDecodeError:
+                        pass  # left to _extract_json() to report
+                    self._item_start = None
+                if self._stack:
+                    self._stack.pop()
+            elif len(self._stack) == 1:
+                if c == ":":
+                    self._key, self._expect_value = self._last_string, True
+                elif c == ",":
+                    self._key, self._expect_value = None, False
+
+        # Keep only what an unfinished string or item still needs
+        anchors = [a for a in (self._item_start, self._string_start if self._in_string else None) if a is not None]
+        keep_from = min(anchors) if anchors else start + len(chunk)
+        self._window = window[keep_from - offset:]
+        self._window_start = keep_from
+        return events
 
-    prompt = f"""You are a certified personal trainer inspired by Tony Horton's P90X methodology. Create a detailed 12-week periodized workout plan for the following person:
+    def _close_top_level_string(self, literal, events):
+        try:
+            value = json.loads(literal)
+        except json.JSONDecodeError:
+            return
+        if self._expect_value:
+            self._expect_value = False
+            if self._key in self.META_KEYS:
+                events.append(("meta", {self._key: value}))
+        else:
+            self._last_string = value
+
+
+def validate_plan(plan):
+    """Raise ValueError unless `plan` has what plan activation relies on:
+    a name, phases with week ranges, and workouts with named exercises."""
+    if not isinstance(plan, dict) or not isinstance(plan.get("plan_name"), str) or not plan["plan_name"].strip():
+        raise ValueError("Plan has no plan_name")
+    phases = plan.get("phases", [])
+    if not isinstance(phases, list):
+        raise ValueError("Plan phases must be a list")
+    for phase in phases:
+        if not isinstance(phase, dict) or not phase.get("phase_name") \
+                or not isinstance(phase.get("week_start"), int) or not isinstance(phase.get("week_end"), int):
+            raise ValueError("Every phase needs a phase_name, week_start and week_end")
+    workouts = plan.get("workouts")
+    if not isinstance(workouts, list) or not workouts:
+        raise ValueError("Plan has no workouts")
+    for workout in workouts:
+        if not isinstance(workout, dict) or not workout.get("day") or not workout.get("name"):
+            raise ValueError("Every workout needs a day and a name")
+        exercises = workout.get("exercises")
+        if not isinstance(exercises, list) or not exercises:
+            raise ValueError(f"Workout {workout['name']!r} has no exercises")
+        for exercise in exercises:
+            if not isinstance(exercise, dict) or not exercise.get("name") or not isinstance(exercise.get("sets"), int):
+                raise ValueError(f"Every exercise in {workout['name']!r} needs a name and a whole number of sets")
+    return plan
+
+
+# The instructions every plan request shares. Sent as the system prompt, a
+# cacheable prefix ahead of the person's details (see _cached_system).
+PLAN_INSTRUCTIONS = """You are a certified personal trainer inspired by Tony Horton's P90X methodology. Create a detailed 12-week periodized workout plan for the person described in the user's message.
 
-Age: {profile.age}, Sex: {profile.sex}, Fitness Level: {profile.fitness_level}, Goals: {profile.goals}.
-{fitness_test_section}{prior_review_section}{extra_context_section}
 Requirements:
 - Create 3 workouts per cycle labeled "Workout A", "Workout B", "Workout C"
 - The user will do them in sequence on whatever days they choose — do NOT use day names like Monday/Wednesday/Friday
@@ -86,27 +182,27 @@ Requirements:
 - Include a nutrition_guide for each phase (simple tips, not a meal plan)
 
 Return a JSON object with this structure:
-{{
+{
   "plan_name": string,
   "description": string,
   "days_per_week": 3,
   "total_weeks": 12,
   "phases": [
-    {{
+    {
       "phase_name": string,
       "phase_type": "progressive" or "recovery",
       "week_start": int,
       "week_end": int,
       "description": string,
       "nutrition_guide": string
-    }}
+    }
   ],
   "workouts": [
-    {{
+    {
       "day": "Workout A",
       "name": string,
       "exercises": [
-        {{
+        {
           "name": string,
           "type": "warmup" or "main" or "cooldown",
           "sets": int,
@@ -114,57 +210,197 @@ Return a JSON object with this structure:
           "rest_seconds": int,
           "notes": string,
           "form_cues": string
-        }}
+        }
       ]
-    }}
+    }
   ]
-}}
+}
 
 Return only valid JSON, no commentary."""
 
-    message = client.messages.create(
-        model="claude-opus-4-6",
-        max_tokens=32000,
-        messages=[{"role": "user", "content": prompt}],
-    )
-
-    return _extract_json(message.content[0].text)
-
-
-def generate_progress_review(profile, sessions_data, plan_name=None):
-    client = get_client()
-
-    plan_label = f'"{plan_name}"' if plan_name else "their current"
-    sessions_label = f"all {len(sessions_data)} completed sessions from their {plan_label} plan"
-
-    prompt = f"""You are Tony Horton — legendary fitness trainer, creator of P90X. You're reviewing one of your people's workout data. Be DIRECT, MOTIVATIONAL, and use your signature style:
+# Likewise for progress reviews: the persona and response format
+REVIEW_INSTRUCTIONS = """You are Tony Horton — legendary fitness trainer, creator of P90X. You're reviewing one of your people's workout data. Be DIRECT, MOTIVATIONAL, and use your signature style:
 
 - Use Tony Horton catchphrases naturally: "Bring it!", "Do your best and forget the rest!", "Rome wasn't built in a day, and neither was your body!", "Tip of the day...", "That's called X, and I like it!"
 - Be encouraging but honest — if someone is slacking, call it out with love
 - Keep it personal and energetic — like you're right there in the room
 - Reference specific exercises and numbers from their data
 
-Client: {profile.name}, Age: {profile.age}, Sex: {profile.sex}, Fitness Level: {profile.fitness_level}, Goals: {profile.goals}.
-
-Here is a summary of {sessions_label}:
-{json.dumps(sessions_data, indent=2)}
-
-Please analyze this data and provide your Tony Horton-style review.
-
 Return your review as JSON with these keys:
-{{
+{
   "whats_working": string (what they're crushing — be specific and encouraging),
   "watch_out_for": string (what needs attention — be direct but supportive),
   "suggestions": [string] (3-5 specific adjustments, Tony Horton style),
   "overall_assessment": string (your big-picture motivational assessment, sign off as Tony)
-}}
+}
 
 Return only valid JSON, no commentary."""
 
-    message = client.messages.create(
-        model="claude-opus-4-6",
-        max_tokens=4096,
-        messages=[{"role": "user", "content": prompt}],
-    )
 
-    return _extract_json(message.content[0].text)
+def _tokens(usage, name):
+    value = getattr(usage, name, None)
+    return value if isinstance(value, int) else 0
+
+
+def _record_call(kind, request, message, started, first_token_at=None):
+    """Record a finished call's token usage, prompt cache included, as an
+    AICall. Called once the call has succeeded, outside ai_client.call's
+    retries; a failure to record is logged, never raised."""
+    usage = getattr(message, "usage", None)
+    finished = time.monotonic()
+    try:
+        with db.engine.begin() as conn:
+            conn.execute(db.insert(AICall.__table__).values(
+                kind=kind,
+                model=request["model"],
+                input_tokens=_tokens(usage, "input_tokens"),
+                output_tokens=_tokens(usage, "output_tokens"),
+                cache_creation_input_tokens=_tokens(usage, "cache_creation_input_tokens"),
+                cache_read_input_tokens=_tokens(usage, "cache_read_input_tokens"),
+                first_token_ms=int((first_token_at - started) * 1000) if first_token_at is not None else None,
+                duration_ms=int((finished - started) * 1000),
+            ))
+    except Exception:
+        logger.exception("Could not record %s call usage", kind)
+
+
+def call_stats():
+    """Per kind of call: count, token totals and mean time to first token."""
+    columns = AICall.__table__.c
+    with db.engine.connect() as conn:
+        rows = conn.execute(
+            db.select(columns.kind, db.func.count(), db.func.sum(columns.input_tokens),
+                      db.func.sum(columns.cache_creation_input_tokens),
+                      db.func.sum(columns.cache_read_input_tokens), db.func.sum(columns.output_tokens),
+                      db.func.avg(columns.first_token_ms))
+            .group_by(columns.kind).order_by(columns.kind)
+        ).all()
+    return {
+        kind: {"calls": calls, "input_tokens": input_tokens or 0, "cache_creation_input_tokens": created or 0,
+               "cache_read_input_tokens": read or 0, "output_tokens": output_tokens or 0,
+               "first_token_ms": round(first_token_ms) if first_token_ms is not None else None}
+        for kind, calls, input_tokens, created, read, output_tokens, first_token_ms in rows
+    }
+
+
+def _cached_system(text):
+    """A system prompt marked for the API's prompt cache. The instructions
+    are kept apart from the per-user message so the prefix can be cached,
+    but PLAN_INSTRUCTIONS and REVIEW_INSTRUCTIONS are still below the
+    model's minimum cacheable prompt length: for now the API caches
+    nothing and the marker has no effect (call_stats() shows zero cache
+    reads). It starts to pay once the instructions grow past that length."""
+    return [{"type": "text", "text": text, "cache_control": {"type": "ephemeral"}}]
+
+
+def generate_workout_plan(profile, fitness_test=None, prior_review=None, extra_context=None, on_event=None,
+                          refresh=False):
+    """Generate a plan with a streamed model call. on_event(kind, data) is
+    called with each PlanStreamParser event as soon as the stream completes
+    it (or all at once, for a response from the cache); the returned plan is
+    the whole response, parsed and validated. refresh (a regenerate) asks
+    the model again even if an identical request was answered recently."""
+    fitness_test_section = ""
+    if fitness_test:
+        fitness_test_section = f"""
+Recent Fitness Test Results (use these to calibrate difficulty):
+- Push-ups: {fitness_test.pushups}
+- Pull-ups: {fitness_test.pullups}
+- Wall Sit: {fitness_test.wall_sit_seconds} seconds
+- Toe Touch: {fitness_test.toe_touch_inches} inches
+- Plank: {fitness_test.plank_seconds} seconds
+- Vertical Jump: {fitness_test.vertical_jump_inches} inches
+"""
+
+    prior_review_section = ""
+    if prior_review:
+        suggestions = prior_review.get("suggestions", [])
+        suggestions_text = "\n".join(f"  - {s}" for s in suggestions) if suggestions else "  None provided"
+        prior_review_section = f"""
+Prior Plan Review (use these insights to inform the new plan — build on what worked, address what didn't):
+- What was working well: {prior_review.get("whats_working", "N/A")}
+- Watch out for: {prior_review.get("watch_out_for", "N/A")}
+- Suggested adjustments:
+{suggestions_text}
+- Overall assessment: {prior_review.get("overall_assessment", "N/A")}
+"""
+
+    extra_context_section = ""
+    if extra_context and extra_context.strip():
+        extra_context_section = f"""
+Additional context from the user (treat this as high-priority input when building the plan):
+{extra_context.strip()}
+"""
+
+    prompt = f"""Age: {profile.age}, Sex: {profile.sex}, Fitness Level: {profile.fitness_level}, Goals: {profile.goals}.
+{fitness_test_section}{prior_review_section}{extra_context_section}"""
+
+    request = {
+        "model": "claude-opus-4-6",
+        "max_tokens": 32000,
+        "system": _cached_system(PLAN_INSTRUCTIONS),
+        "messages": [{"role": "user", "content": prompt}],
+    }
+    parser = PlanStreamParser()
+
+    def emit(events):
+        for kind, data in events:
+            if on_event is not None:
+                on_event(kind, data)
+
+    def stream_plan():
+        started, first_token_at = time.monotonic(), None
+        with get_client().messages.stream(**request) as stream:
+            for chunk in stream.text_stream:
+                if first_token_at is None:
+                    first_token_at = time.monotonic()
+                emit(parser.feed(chunk))
+            message = stream.get_final_message()
+        return message, started, first_token_at
+
+    def call():
+        # Retry only while nothing has streamed: parts already handed out can't be taken back
+        message, started, first_token_at = ai_client.call(stream_plan, can_retry=lambda: not parser.text)
+        _record_call("plan", request, message, started, first_token_at)
+        if message.stop_reason == "max_tokens":
+            raise ValueError("Plan response was cut off before it finished")
+        validate_plan(_extract_json(parser.text))  # never cache a plan we would reject
+        return parser.text
+
+    text = ai_responses.fetch(request, call, refresh=refresh)
+    if not parser.text:  # answered from the cache: replay its parts
+        emit(parser.feed(text))
+    return validate_plan(_extract_json(text))
+
+
+def generate_progress_review(profile, sessions_data, plan_name=None):
+    plan_label = f'"{plan_name}"' if plan_name else "their current"
+    sessions_label = f"all {len(sessions_data)} completed sessions from their {plan_label} plan"
+
+    prompt = f"""Client: {profile.name}, Age: {profile.age}, Sex: {profile.sex}, Fitness Level: {profile.fitness_level}, Goals: {profile.goals}.
+
+Here is a summary of {sessions_label}:
+{json.dumps(sessions_data, indent=2)}
+
+Please analyze this data and provide your Tony Horton-style review."""
+
+    request = {
+        "model": "claude-opus-4-6",
+        "max_tokens": 4096,
+        "system": _cached_system(REVIEW_INSTRUCTIONS),
+        "messages": [{"role": "user", "content": prompt}],
+    }
+
+    def create_review():
+        started = time.monotonic()
+        return get_client().messages.create(**request), started
+
+    def call():
+        message, started = ai_client.call(create_review)
+        _record_call("review", request, message, started)
+        text = message.content[0].text
+        _extract_json(text)  # never cache a review we can't parse
+        return text
+
+    # A review is made inside the web request: wait on an identical one no longer than a call of our own may take
+    return _extract_json(ai_responses.fetch(request, call, max_wait=ai_client.read_timeout))
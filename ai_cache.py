@@ -0,0 +1,241 @@
+"""
+Persistent, content-addressed cache of model responses, shared by every worker.
+
+Plan generation and progress reviews are slow, expensive model calls, and the
+same inputs (profile, fitness test, prior review, extra context, session
+data) render the same prompt. fetch() keys each call by the sha256 of its
+request (model, max_tokens, messages...), so a re-submit with unchanged
+inputs is answered from the ai_response table instead of the model. A
+regenerate passes refresh, which skips the response the user just turned
+down and replaces it. Entries live for AI_CACHE_TTL seconds (0 disables the
+cache), and the table is kept under AI_CACHE_MAX_BYTES of response text by
+evicting the least recently used entries.
+
+A miss claims the key by writing a pending row with a conditional upsert,
+so of any number of identical requests, in any worker, one calls the model
+and the rest wait for its row to turn ready, no longer than their own
+deadline. If the call fails its error is left on the row and the waiters
+raise it rather than each calling the model again; the next new request
+tries afresh. If the worker dies mid-call the claim lapses after LEASE and
+the next caller re-claims it. Every claim carries a claim_id that its
+caller's later writes must match, so a caller whose lease lapsed cannot
+overwrite its successor's row. Only responses the caller accepts are
+stored: call() raises on anything it would not want served again.
+
+stats() reports entries, bytes and the hit/miss counters, which are kept
+in ai_cache_counter so they cover every worker (python ai_cache_stats.py).
+"""
+import hashlib
+import json
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy.dialects.sqlite import insert
+
+from models import (
+    db, AIResponse, AICacheCounter, AI_RESPONSE_PENDING, AI_RESPONSE_READY, AI_RESPONSE_FAILED,
+)
+
+DEFAULT_TTL_SECONDS = 24 * 3600
+DEFAULT_MAX_BYTES = 8 * 1024 * 1024
+# Longer than any one model call, retries included, should take
+LEASE = timedelta(minutes=10)
+POLL_SECONDS = 0.5
+# How long a failed call's error stays for the callers that were waiting on it
+FAILED_TTL = timedelta(minutes=1)
+
+COUNTERS = ("hits", "misses", "coalesced", "evictions")
+
+_responses = AIResponse.__table__
+_counters = AICacheCounter.__table__
+
+
+class SharedCallError(RuntimeError):
+    """Raised to a caller that waited on another caller's identical request,
+    when that call failed or was still running at the caller's deadline."""
+
+
+def _now():
+    # Naive UTC, as the DateTime columns store it
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def request_key(request):
+    """sha256 of a model call's keyword arguments, independent of key order."""
+    canonical = json.dumps(request, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def _count(conn, name, amount=1):
+    conn.execute(
+        insert(_counters).values(name=name, value=amount)
+        .on_conflict_do_update(index_elements=[_counters.c.name],
+                               set_={"value": _counters.c.value + amount})
+    )
+
+
+class AIResponseCache:
+    def __init__(self, ttl=DEFAULT_TTL_SECONDS, max_bytes=DEFAULT_MAX_BYTES):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+
+    def configure(self, ttl, max_bytes):
+        self.ttl = float(ttl)
+        self.max_bytes = int(max_bytes)
+
+    def fetch(self, request, call, refresh=False, max_wait=None):
+        """The response text for `request`, the model call's keyword
+        arguments: cached if an identical request was answered within the
+        TTL, else call()'s return value. call() runs once across every
+        worker however many identical requests arrive while it runs; the
+        others wait up to max_wait seconds (default LEASE) for its response
+        and raise SharedCallError if it fails or is still running then.
+        refresh skips a cached response (the user asked for a new one) and
+        replaces it with call()'s."""
+        if self.ttl <= 0:
+            return call()
+        key = request_key(request)
+        deadline = _now() + (LEASE if max_wait is None else timedelta(seconds=max_wait))
+        waited = False
+        while True:
+            # Once waiting, whatever the running call returns is new enough
+            claim_id, text = self._claim(key, request.get("model", ""), waited=waited,
+                                         refresh=refresh and not waited)
+            if claim_id is not None or text is not None:
+                break
+            if _now() >= deadline:
+                raise SharedCallError("An identical request is still waiting on the AI service. "
+                                      "Please try again in a minute.")
+            waited = True
+            time.sleep(POLL_SECONDS)
+        if text is not None:
+            return text
+
+        try:
+            text = call()
+        except BaseException as e:
+            self._fail(key, claim_id, e)
+            raise
+        self._store(key, claim_id, text)
+        return text
+
+    def _claim(self, key, model, waited=False, refresh=False):
+        """(claim_id, None) if this caller must call the model; (None, text)
+        on a hit; (None, None) while another caller's identical call runs.
+        Raises SharedCallError if the call this caller waited on failed. With
+        refresh, a cached response is claimed like an expired one."""
+        now = _now()
+        claim_id = uuid.uuid4().hex
+        # Expired, or its caller's lease has lapsed
+        claimable = [
+            db.and_(_responses.c.status == AI_RESPONSE_READY, _responses.c.expires_at <= now),
+            db.and_(_responses.c.status == AI_RESPONSE_PENDING, _responses.c.claimed_at < now - LEASE),
+        ]
+        if not waited:
+            claimable.append(_responses.c.status == AI_RESPONSE_FAILED)  # a new request tries again
+        if refresh:
+            claimable.append(_responses.c.status == AI_RESPONSE_READY)
+        with db.engine.begin() as conn:
+            claimed = conn.execute(
+                insert(_responses)
+                .values(key=key, model=model, status=AI_RESPONSE_PENDING, claim_id=claim_id, claimed_at=now,
+                        size_bytes=0, hits=0)
+                .on_conflict_do_update(
+                    index_elements=[_responses.c.key],
+                    set_={"status": AI_RESPONSE_PENDING, "claim_id": claim_id, "claimed_at": now,
+                          "response_text": None, "size_bytes": 0, "hits": 0, "expires_at": None},
+                    where=db.or_(*claimable),
+                )
+            ).rowcount == 1
+            if claimed:
+                _count(conn, "misses")
+                return claim_id, None
+            row = conn.execute(
+                db.select(_responses.c.status, _responses.c.response_text).where(_responses.c.key == key)
+            ).first()
+            if row is not None and row.status == AI_RESPONSE_FAILED:
+                raise SharedCallError(row.response_text)
+            if row is None or row.status != AI_RESPONSE_READY:
+                return None, None
+            conn.execute(
+                db.update(_responses).where(_responses.c.key == key)
+                .values(hits=_responses.c.hits + 1, last_used_at=now)
+            )
+            _count(conn, "coalesced" if waited else "hits")
+            return None, row.response_text
+
+    @staticmethod
+    def _held(key, claim_id):
+        # Once a lapsed claim is taken over, its old caller's writes match nothing
+        return db.and_(_responses.c.key == key, _responses.c.claim_id == claim_id)
+
+    def _fail(self, key, claim_id, error):
+        """Hand the call's error to the callers waiting on it."""
+        now = _now()
+        with db.engine.begin() as conn:
+            conn.execute(
+                db.update(_responses).where(self._held(key, claim_id))
+                .values(status=AI_RESPONSE_FAILED, response_text=str(error) or type(error).__name__,
+                        expires_at=now + FAILED_TTL)
+            )
+
+    def _store(self, key, claim_id, text):
+        now = _now()
+        size = len(text.encode("utf-8"))
+        with db.engine.begin() as conn:
+            if size > self.max_bytes:
+                conn.execute(db.delete(_responses).where(self._held(key, claim_id)))
+                return
+            conn.execute(
+                db.update(_responses).where(self._held(key, claim_id))
+                .values(status=AI_RESPONSE_READY, response_text=text, size_bytes=size,
+                        expires_at=now + timedelta(seconds=self.ttl), last_used_at=now)
+            )
+            self._evict(conn, now)
+
+    def _evict(self, conn, now):
+        """Drop expired entries, then least recently used ones until the
+        stored responses fit in max_bytes."""
+        evicted = conn.execute(
+            db.delete(_responses).where(_responses.c.status != AI_RESPONSE_PENDING,
+                                        _responses.c.expires_at <= now)
+        ).rowcount
+        total = conn.execute(db.select(db.func.coalesce(db.func.sum(_responses.c.size_bytes), 0))).scalar()
+        if total > self.max_bytes:
+            oldest = conn.execute(
+                db.select(_responses.c.key, _responses.c.size_bytes)
+                .where(_responses.c.status == AI_RESPONSE_READY)
+                .order_by(_responses.c.last_used_at)
+            )
+            drop = []
+            for key, size in oldest:
+                if total <= self.max_bytes:
+                    break
+                drop.append(key)
+                total -= size
+            conn.execute(db.delete(_responses).where(_responses.c.key.in_(drop)))
+            evicted += len(drop)
+        if evicted:
+            _count(conn, "evictions", evicted)
+
+    def clear(self):
+        with db.engine.begin() as conn:
+            conn.execute(db.delete(_responses))
+            conn.execute(db.delete(_counters))
+
+    def stats(self):
+        with db.engine.connect() as conn:
+            entries, size = conn.execute(
+                db.select(db.func.count(), db.func.coalesce(db.func.sum(_responses.c.size_bytes), 0))
+                .where(_responses.c.status == AI_RESPONSE_READY)
+            ).one()
+            counts = dict(conn.execute(db.select(_counters.c.name, _counters.c.value)).all())
+        stats = {"entries": entries, "bytes": size, "max_bytes": self.max_bytes, "ttl": self.ttl}
+        stats.update({name: counts.get(name, 0) for name in COUNTERS})
+        lookups = stats["hits"] + stats["coalesced"] + stats["misses"]
+        stats["hit_rate"] = (stats["hits"] + stats["coalesced"]) / lookups if lookups else 0.0
+        return stats
+
+
+ai_responses = AIResponseCache()
@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+"""CLI script to report the AI response cache's size and hit rate, and the
+API's prompt cache use per kind of call.
+
+The counters cover every worker since they were last cleared. --clear
+empties the response cache and resets its counters.
+
+Usage:
+    python ai_cache_stats.py [--clear]
+"""
+import sys
+import os
+
+sys.path.insert(0, os.path.dirname(__file__))
+
+from dotenv import load_dotenv  # noqa: E402
+load_dotenv()
+
+from app import app  # noqa: E402
+from ai import call_stats  # noqa: E402
+from ai_cache import ai_responses  # noqa: E402
+
+
+def report():
+    with app.app_context():
+        if "--clear" in sys.argv[1:]:
+            ai_responses.clear()
+            print("Cleared the AI response cache.")
+            return
+        stats = ai_responses.stats()
+        calls = call_stats()
+    print(f"{stats['entries']} cached responses, {stats['bytes'] / 1024:.0f} of "
+          f"{stats['max_bytes'] / 1024:.0f} KiB, kept {stats['ttl'] / 3600:g} h")
+    print(f"{stats['hits']} hits, {stats['coalesced']} coalesced, {stats['misses']} misses "
+          f"(hit rate {stats['hit_rate']:.0%}), {stats['evictions']} evicted")
+    for kind, usage in calls.items():
+        prompt = usage["input_tokens"] + usage["cache_creation_input_tokens"] + usage["cache_read_input_tokens"]
+        first_token = f", first token after {usage['first_token_ms']} ms" if usage["first_token_ms"] is not None else ""
+        print(f"{kind}: {usage['calls']} calls, {prompt} input tokens "
+              f"({usage['cache_read_input_tokens'] / prompt if prompt else 0:.0%} read from the prompt cache, "
+              f"{usage['cache_creation_input_tokens']} written to it), {usage['output_tokens']} output tokens"
+              f"{first_token}")
+
+
+if __name__ == "__main__":
+    report()
@@ -0,0 +1,223 @@
+"""
+The process-wide Anthropic client, with deadlines, retries and a circuit
+breaker.
+
+One anthropic.Anthropic (and its httpx connection pool) is built per process
+and reused by every call, so keep-alive connections survive between
+requests; a forked worker builds its own rather than sharing the parent's
+sockets. Each request gets explicit deadlines: AI_CONNECT_TIMEOUT to
+connect and AI_READ_TIMEOUT between bytes (for a streamed plan that is the
+gap between chunks, not the whole generation).
+
+call() makes the request, retrying rate limits (429), overloads and server
+errors (5xx), timeouts and dropped connections up to AI_MAX_RETRIES times
+with jittered exponential backoff, or after the server's Retry-After. The
+SDK's own retries are off so every attempt passes through here.
+
+Consecutive failed attempts feed a per-worker circuit breaker. After
+AI_BREAKER_FAILURES in a row it opens: calls fail at once with
+CircuitOpenError instead of tying up a request thread on a degraded API.
+After AI_BREAKER_RESET seconds it lets one trial call through; success
+closes it, failure re-opens it. Any response from the API (even a 400)
+counts as the API being up; an error raised on this side, inside fn,
+leaves the breaker as it was.
+
+ANTHROPIC_BASE_URL points the client elsewhere, e.g. at a local stub server.
+"""
+import os
+import random
+import threading
+import time
+
+import anthropic
+import httpx
+
+DEFAULT_CONNECT_TIMEOUT = 5.0
+DEFAULT_READ_TIMEOUT = 120.0
+DEFAULT_MAX_RETRIES = 2
+DEFAULT_BREAKER_FAILURES = 5
+DEFAULT_BREAKER_RESET = 30.0
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 8.0
+
+RETRY_STATUS = frozenset({408, 409, 429})
+
+
+class CircuitOpenError(RuntimeError):
+    """Raised instead of calling the API while the circuit breaker is open."""
+
+    def __init__(self, retry_in):
+        self.retry_in = retry_in
+        super().__init__(f"The AI service is unavailable right now. Please try again in {retry_in} seconds.")
+
+
+def retryable(error):
+    """True for failures worth another attempt (and counted by the breaker)."""
+    # The SDK wraps transport errors raised before a response arrives; a
+    # stream that breaks mid-body raises httpx's own
+    if isinstance(error, (anthropic.APIConnectionError, httpx.TransportError)):  # includes timeouts
+        return True
+    if isinstance(error, anthropic.APIStatusError):
+        return error.status_code in RETRY_STATUS or error.status_code >= 500
+    return False
+
+
+def _retry_after(error):
+    """The server's Retry-After, in seconds, if it sent a usable one."""
+    response = getattr(error, "response", None)
+    try:
+        return float(response.headers["retry-after"])
+    except (AttributeError, KeyError, TypeError, ValueError):
+        return None
+
+
+class CircuitBreaker:
+    def __init__(self, failures=DEFAULT_BREAKER_FAILURES, reset_seconds=DEFAULT_BREAKER_RESET):
+        self.failures = failures
+        self.reset_seconds = reset_seconds
+        self._lock = threading.Lock()
+        self._failed = 0  # consecutive failed attempts
+        self._opened_at = None
+        self._trial_until = None  # while set, one half-open trial call is in flight
+        self.rejected = 0
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._opened_at is None:
+                return "closed"
+            if time.monotonic() < self._opened_at + self.reset_seconds:
+                return "open"
+            return "half-open"
+
+    def before_call(self):
+        """Raise CircuitOpenError unless a call may go ahead now."""
+        with self._lock:
+            if self._opened_at is None:
+                return
+            now = time.monotonic()
+            wait = self._opened_at + self.reset_seconds - now
+            if wait <= 0 and (self._trial_until is None or self._trial_until < now):
+                # Half-open: this call is the trial; the rest keep failing fast.
+                # A trial that never reports back is given up after another reset period.
+                self._trial_until = now + self.reset_seconds
+                return
+            self.rejected += 1
+            raise CircuitOpenError(max(int(wait + 0.999), 1))
+
+    def record_success(self):
+        with self._lock:
+            self._failed = 0
+            self._opened_at = self._trial_until = None
+
+    def release_trial(self):
+        """Let another call be the half-open trial; this one proved nothing."""
+        with self._lock:
+            self._trial_until = None
+
+    def record_failure(self):
+        with self._lock:
+            self._failed += 1
+            if self._opened_at is not None or self._failed >= self.failures:
+                self._opened_at = time.monotonic()
+            self._trial_until = None
+
+    def reset(self):
+        with self._lock:
+            self._failed = 0
+            self._opened_at = self._trial_until = None
+            self.rejected = 0
+
+
+class AIClient:
+    def __init__(self):
+        self.connect_timeout = DEFAULT_CONNECT_TIMEOUT
+        self.read_timeout = DEFAULT_READ_TIMEOUT
+        self.max_retries = DEFAULT_MAX_RETRIES
+        self.base_url = None
+        self.breaker = CircuitBreaker()
+        self._client = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self.attempts = 0
+        self.retries = 0
+
+    def configure(self, connect_timeout=DEFAULT_CONNECT_TIMEOUT, read_timeout=DEFAULT_READ_TIMEOUT,
+                  max_retries=DEFAULT_MAX_RETRIES, breaker_failures=DEFAULT_BREAKER_FAILURES,
+                  breaker_reset=DEFAULT_BREAKER_RESET, base_url=None):
+        with self._lock:
+            self.connect_timeout = float(connect_timeout)
+            self.read_timeout = float(read_timeout)
+            self.max_retries = max(int(max_retries), 0)
+            self.base_url = base_url or None
+            self.breaker.failures = max(int(breaker_failures), 1)
+            self.breaker.reset_seconds = float(breaker_reset)
+            self._close()
+
+    def client(self):
+        """This process's anthropic.Anthropic, built on first use."""
+        with self._lock:
+            if self._client is None or self._pid != os.getpid():
+                # After a fork the inherited pool's sockets belong to the parent: build a new one
+                self._client = anthropic.Anthropic(
+                    api_key=os.environ.get("ANTHROPIC_API_KEY"),
+                    base_url=self.base_url,
+                    timeout=httpx.Timeout(self.read_timeout, connect=self.connect_timeout),
+                    max_retries=0,
+                )
+                self._pid = os.getpid()
+            return self._client
+
+    def _close(self):
+        if self._client is not None and self._pid == os.getpid():
+            self._client.close()
+        self._client = self._pid = None
+
+    def close(self):
+        with self._lock:
+            self._close()
+
+    @staticmethod
+    def backoff(attempt, error=None):
+        """Seconds to wait before retry number `attempt` (0-based)."""
+        retry_after = _retry_after(error)
+        if retry_after is not None:
+            return min(max(retry_after, 0.0), BACKOFF_MAX)
+        return min(BACKOFF_BASE * 2 ** attempt, BACKOFF_MAX) * random.uniform(0.5, 1.0)
+
+    def call(self, fn, can_retry=None):
+        """fn()'s result, retrying transient API failures. can_retry(), if
+        given, is asked before each retry; a streamed call that has already
+        handed out text must not start again."""
+        attempt = 0
+        while True:
+            self.breaker.before_call()
+            self.attempts += 1
+            try:
+                result = fn()
+            except Exception as e:
+                if not retryable(e):
+                    if isinstance(e, anthropic.APIStatusError):
+                        self.breaker.record_success()  # the API answered, if only with an error
+                    else:
+                        # Failed on this side (a parser, a database write in fn): no
+                        # evidence either way about the API
+                        self.breaker.release_trial()
+                    raise
+                self.breaker.record_failure()
+                if (attempt >= self.max_retries or self.breaker.state != "closed"
+                        or (can_retry is not None and not can_retry())):
+                    raise
+                time.sleep(self.backoff(attempt, e))
+                attempt += 1
+                self.retries += 1
+                continue
+            self.breaker.record_success()
+            return result
+
+    def stats(self):
+        return {"state": self.breaker.state, "attempts": self.attempts, "retries": self.retries,
+                "rejected": self.breaker.rejected}
+
+
+ai_client = AIClient()
@@ -4,10 +4,18 @@ import calendar as cal_module
 from datetime import datetime, date, timedelta, timezone
 
 from dotenv import load_dotenv
-from flask import Flask, render_template, request, redirect, url_for, flash, send_file, jsonify
+from flask import (
+    Flask, render_template, request, redirect, url_for, flash, send_file, jsonify, g,
+    has_request_context, make_response, session as flask_session,
+)
 from flask_login import login_required, current_user
+from sqlalchemy import event
+from sqlalchemy.exc import IntegrityError
 from werkzeug.middleware.proxy_fix import ProxyFix
 
+import sqlite_profile
+from plan_cache import parsed_plans
+
 load_dotenv()
 
 app = Flask(__name__)
@@ -19,6 +27,29 @@ app.secret_key = _secret
 
 app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get("DATABASE_URL", "sqlite:///fitlocal.db")
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+# Connection PRAGMAs and pool sizing for concurrent gunicorn workers (see sqlite_profile.py)
+app.config["SQLITE_PROFILE"] = os.environ.get("SQLITE_PROFILE", "production")
+app.config["SQLALCHEMY_ENGINE_OPTIONS"] = sqlite_profile.engine_options(
+    app.config["SQLITE_PROFILE"], app.config["SQLALCHEMY_DATABASE_URI"]
+)
+# Upper bound on the parsed-plan cache's estimated memory (see plan_cache.py)
+app.config["PLAN_CACHE_MAX_BYTES"] = int(os.environ.get("PLAN_CACHE_MAX_BYTES", 16 * 1024 * 1024))
+parsed_plans.resize(app.config["PLAN_CACHE_MAX_BYTES"])
+# Seconds a worker may reuse a loaded account + profile; 0 disables (see identity_cache.py)
+app.config["IDENTITY_CACHE_TTL"] = float(os.environ.get("IDENTITY_CACHE_TTL", 0))
+# Background threads per worker for plan generation jobs (see plan_jobs.py)
+app.config["PLAN_JOB_WORKERS"] = int(os.environ.get("PLAN_JOB_WORKERS", 1))
+# Seconds identical AI requests are answered from the response cache, 0 disables,
+# and the cap on its stored response text (see ai_cache.py)
+app.config["AI_CACHE_TTL"] = float(os.environ.get("AI_CACHE_TTL", 24 * 3600))
+app.config["AI_CACHE_MAX_BYTES"] = int(os.environ.get("AI_CACHE_MAX_BYTES", 8 * 1024 * 1024))
+# Anthropic request deadlines, retries and circuit breaker (see ai_client.py)
+app.config["AI_CONNECT_TIMEOUT"] = float(os.environ.get("AI_CONNECT_TIMEOUT", 5))
+app.config["AI_READ_TIMEOUT"] = float(os.environ.get("AI_READ_TIMEOUT", 120))
+app.config["AI_MAX_RETRIES"] = int(os.environ.get("AI_MAX_RETRIES", 2))
+app.config["AI_BREAKER_FAILURES"] = int(os.environ.get("AI_BREAKER_FAILURES", 5))
+app.config["AI_BREAKER_RESET"] = float(os.environ.get("AI_BREAKER_RESET", 30))
+app.config["ANTHROPIC_BASE_URL"] = os.environ.get("ANTHROPIC_BASE_URL", "")
 app.config["GOOGLE_CLIENT_ID"] = os.environ.get("GOOGLE_CLIENT_ID", "")
 app.config["GOOGLE_CLIENT_SECRET"] = os.environ.get("GOOGLE_CLIENT_SECRET", "")
 
@@ -36,11 +67,30 @@ app.config["WTF_CSRF_TIME_LIMIT"] = 8 * 3600  # 8 hours in seconds
 app.wsgi_app = ProxyFix(app.wsgi_app, x_for=1, x_proto=1, x_host=1, x_prefix=1)
 
 from models import (  # noqa: E402
-    db, Account, UserProfile, WorkoutPlan, PlannedWorkout, PlannedExercise,
+    db, UserProfile, WorkoutPlan, PlannedWorkout, PlannedExercise,
     WorkoutSession, LoggedSet, AIReview, FitnessTest, TrainingPhase, ExerciseLibrary,
-    NextWorkoutNote,
+    NextWorkoutNote, ExercisePerformance, PlanProgress, PlanJob, SESSION_STATUS_COMPLETED, SESSION_STATUS_PAUSED,
+    PLAN_JOB_QUEUED, PLAN_JOB_RUNNING, PLAN_JOB_SUCCEEDED, PLAN_JOB_FAILED, exercise_name_key,
 )
+import summaries  # noqa: E402  (also registers the summary-table triggers)
+import search_index  # noqa: E402  (also registers the search-index table and triggers)
 from extensions import login_manager, bcrypt, csrf, limiter, oauth_client  # noqa: E402
+from claim_gate import unclaimed_gate  # noqa: E402
+from identity_cache import identities  # noqa: E402
+from exercise_catalog import exercise_catalog  # noqa: E402
+import plan_jobs  # noqa: E402
+from plan_jobs import plan_job_runner  # noqa: E402
+from ai_cache import ai_responses  # noqa: E402
+from ai_client import ai_client  # noqa: E402
+
+identities.configure(app.config["IDENTITY_CACHE_TTL"])
+plan_job_runner.configure(app.config["PLAN_JOB_WORKERS"])
+ai_responses.configure(app.config["AI_CACHE_TTL"], app.config["AI_CACHE_MAX_BYTES"])
+ai_client.configure(
+    connect_timeout=app.config["AI_CONNECT_TIMEOUT"], read_timeout=app.config["AI_READ_TIMEOUT"],
+    max_retries=app.config["AI_MAX_RETRIES"], breaker_failures=app.config["AI_BREAKER_FAILURES"],
+    breaker_reset=app.config["AI_BREAKER_RESET"], base_url=app.config["ANTHROPIC_BASE_URL"],
+)
 
 db.init_app(app)
 login_manager.init_app(app)
@@ -85,130 +135,112 @@ def set_security_headers(response):
 
 
 with app.app_context():
-    # Add account_id column to user_profile if it doesn't exist yet
-    # (db.create_all won't alter existing tables)
-    with db.engine.connect() as conn:
-        from sqlalchemy import inspect, text
-        insp = inspect(db.engine)
-        if insp.has_table("user_profile"):
-            cols = [c["name"] for c in insp.get_columns("user_profile")]
-            if "account_id" not in cols:
-                conn.execute(text(
-                    "ALTER TABLE user_profile ADD COLUMN account_id INTEGER REFERENCES account(id)"
-                ))
-                conn.commit()
-
-        # Add status column to workout_plan if it doesn't exist, backfilling from is_active + notes
-        if insp.has_table("workout_plan"):
-            wp_cols = [c["name"] for c in insp.get_columns("workout_plan")]
-            if "status" not in wp_cols:
-                conn.execute(text(
-                    "ALTER TABLE workout_plan ADD COLUMN status VARCHAR(20) DEFAULT 'inactive'"
-                ))
-                conn.execute(text("""
-                    UPDATE workout_plan SET status = CASE
-                        WHEN is_active = 1 THEN 'active'
-                        WHEN notes = 'pending' THEN 'pending'
-                        ELSE 'inactive'
-                    END
-                """))
-                conn.commit()
-
-        # Add status, elapsed_seconds, superset_exercises columns to workout_session if missing
-        if insp.has_table("workout_session"):
-            ws_cols = [c["name"] for c in insp.get_columns("workout_session")]
-            if "status" not in ws_cols:
-                conn.execute(text(
-                    "ALTER TABLE workout_session ADD COLUMN status VARCHAR(20) DEFAULT 'completed'"
-                ))
-                conn.commit()
-            if "elapsed_seconds" not in ws_cols:
-                conn.execute(text(
-                    "ALTER TABLE workout_session ADD COLUMN elapsed_seconds INTEGER DEFAULT 0"
-                ))
-                conn.commit()
-            if "superset_exercises" not in ws_cols:
-                conn.execute(text(
-                    "ALTER TABLE workout_session ADD COLUMN superset_exercises TEXT"
-                ))
-                conn.commit()
-            if "phase_name" not in ws_cols:
-                conn.execute(text(
-                    "ALTER TABLE workout_session ADD COLUMN phase_name VARCHAR(100)"
-                ))
-                conn.commit()
-
-        # Add order_index and is_superset_default to planned_exercise if missing
-        if insp.has_table("planned_exercise"):
-            pe_cols = [c["name"] for c in insp.get_columns("planned_exercise")]
-            if "order_index" not in pe_cols:
-                conn.execute(text(
-                    "ALTER TABLE planned_exercise ADD COLUMN order_index INTEGER DEFAULT 0"
-                ))
-                conn.commit()
-            if "is_superset_default" not in pe_cols:
-                conn.execute(text(
-                    "ALTER TABLE planned_exercise ADD COLUMN is_superset_default BOOLEAN DEFAULT 0"
-                ))
-                conn.commit()
-
-        # Add weight_b and reps_b to logged_set if missing
-        if insp.has_table("logged_set"):
-            ls_cols = [c["name"] for c in insp.get_columns("logged_set")]
-            if "weight_b" not in ls_cols:
-                conn.execute(text("ALTER TABLE logged_set ADD COLUMN weight_b FLOAT"))
-                conn.commit()
-            if "reps_b" not in ls_cols:
-                conn.execute(text("ALTER TABLE logged_set ADD COLUMN reps_b INTEGER"))
-                conn.commit()
-
-    db.create_all()
+    sqlite_profile.install_pragmas(db.engine, app.config["SQLITE_PROFILE"])
 
+    # Versioned, run-once schema migrations (see migrate.py). Under gunicorn
+    # the on_starting hook has already applied them before the workers forked.
     from migrate import migrate as _run_migrations
-    _run_migrations()
-
-    # One-time migration: link an existing UserProfile to a new Account
-    # so legacy data is not lost when auth is first enabled.
-    if Account.query.count() == 0:
-        existing_profile = UserProfile.query.first()
-        if existing_profile and existing_profile.account_id is None:
-            migrated = Account(
-                email="local@fitlocal.local",
-                email_claimed=False,
-                is_admin=True,
-            )
-            db.session.add(migrated)
-            db.session.flush()
-            existing_profile.account_id = migrated.id
-            db.session.commit()
+    _run_migrations(db.engine)
 
 
-@app.before_request
 def redirect_unclaimed_account():
     """Block all non-auth requests until the legacy migrated account is claimed."""
     if request.endpoint is None:
         return
     if request.endpoint.startswith("static") or request.endpoint.startswith("auth."):
         return
-    unclaimed = Account.query.filter_by(email_claimed=False).first()
-    if unclaimed:
+    if unclaimed_gate.pending(db.session):
         return redirect(url_for("auth.claim_account"))
+    _hook_before_request(redirect_unclaimed_account, False)
+
+
+def _hook_before_request(fn, enabled):
+    # Swap in a new list rather than mutating the one other threads may be
+    # iterating; app.before_request() refuses once the app has served a request.
+    funcs = [f for f in app.before_request_funcs.get(None, []) if f is not fn]
+    app.before_request_funcs[None] = funcs + [fn] if enabled else funcs
+
+
+def install_claim_gate():
+    """Compute the unclaimed-account gate and keep redirect_unclaimed_account
+    in the request path only while an account is still unclaimed (see
+    claim_gate.py)."""
+    _hook_before_request(redirect_unclaimed_account, unclaimed_gate.refresh(db.session))
+
+
+with app.app_context():
+    install_claim_gate()
 
 
 DAY_NAMES = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]
 
-SESSION_STATUS_COMPLETED = 'completed'
-SESSION_STATUS_PAUSED = 'paused'
+
+# ---------------------------------------------------------------------------
+# Request-scoped memo
+# ---------------------------------------------------------------------------
+# A page asks for the profile, the active plan and the plan position from
+# several helpers; each is computed once per request and kept on flask.g.
+# Any write through db.session within the request drops the memo, so a value
+# read after a write is always fresh. Outside a request (CLI scripts, tests
+# calling helpers directly) nothing is memoized.
+
+def _memoized(key, compute):
+    if not has_request_context():
+        return compute()
+    memo = g.setdefault("memo", {})
+    if key not in memo:
+        memo[key] = compute()
+    return memo[key]
+
+
+def forget_request_memo():
+    if has_request_context():
+        g.pop("memo", None)
+
+
+@event.listens_for(db.session, "after_flush")
+def _forget_after_flush(session, flush_context):
+    # after_flush still sees the pre-flush new/dirty/deleted collections;
+    # a flush of attributes set to their current value changes nothing.
+    if session.new or session.deleted or any(session.is_modified(obj) for obj in session.dirty):
+        forget_request_memo()
+
+
+@event.listens_for(db.session, "do_orm_execute")
+def _forget_after_bulk_write(orm_execute_state):
+    # query.update()/delete() and raw DML bypass the flush
+    if not orm_execute_state.is_select:
+        forget_request_memo()
+
+
+@event.listens_for(db.session, "after_rollback")
+def _forget_after_rollback(session):
+    forget_request_memo()
 
 
 def get_profile():
     if not current_user.is_authenticated:
         return None
-    return UserProfile.query.filter_by(account_id=current_user.id).first()
+    return _memoized(
+        ("profile", current_user.id),
+        lambda: current_user.profile,  # loaded with the account (see identity_cache.py)
+    )
 
 
 def get_active_plan(user_id):
-    return WorkoutPlan.query.filter_by(status="active", user_id=user_id).first()
+    return _memoized(
+        ("active_plan", user_id),
+        lambda: WorkoutPlan.query.filter_by(status="active", user_id=user_id).first(),
+    )
+
+
+def get_plan_data(plan):
+    """plan.plan_json parsed, from the process-wide plan cache (plan_cache.py);
+    an empty mapping when missing or malformed. The result is read-only."""
+    return _memoized(
+        ("plan_data", plan.id, plan.plan_json),
+        lambda: parsed_plans.get(plan.id, plan.plan_json),
+    )
 
 
 def _get_review_sessions(user_id, plan_id):
@@ -251,13 +283,23 @@ def resolve_plan_position(profile_id, active_plan):
     next workout is the one AFTER the last logged workout in plan order (so the
     workout switcher / out-of-order logging behaves correctly).
 
+    Counts and "last workout" come from the plan_progress rows for this plan,
+    so this costs two small queries however long the history is — and only
+    once per request (see _memoized).
+
     Returns a dict (or None if there's no usable plan) with keys:
       phase_data, phase_index (0-based), workouts_done_in_phase,
       phase_total_workouts, next_workout (PlannedWorkout), workouts.
     """
     if not active_plan:
         return None
+    return _memoized(
+        ("plan_position", profile_id, active_plan.id),
+        lambda: _resolve_plan_position(profile_id, active_plan),
+    )
+
 
+def _resolve_plan_position(profile_id, active_plan):
     workouts = PlannedWorkout.query.filter_by(
         plan_id=active_plan.id
     ).order_by(PlannedWorkout.order_index).all()
@@ -265,56 +307,49 @@ def resolve_plan_position(profile_id, active_plan):
         return None
 
     days_per_week = active_plan.days_per_week or 3
-    workout_ids = [w.id for w in workouts]
     pos_by_id = {w.id: i for i, w in enumerate(workouts)}
 
-    try:
-        plan_data = json.loads(active_plan.plan_json or "{}")
-        phases_data = plan_data.get("phases", [])
-    except Exception:
-        phases_data = []
-
-    base_filter = (
-        WorkoutSession.user_id == profile_id,
-        WorkoutSession.planned_workout_id.in_(workout_ids),
-        WorkoutSession.status == SESSION_STATUS_COMPLETED,
-    )
+    phases_data = get_plan_data(active_plan).get("phases", [])
 
-    def _last_session(*extra):
-        return (
-            WorkoutSession.query
-            .filter(*base_filter, *extra)
-            .order_by(WorkoutSession.date.desc(), WorkoutSession.id.desc())
-            .first()
+    # Completed-session counters per phase tag, kept current by triggers
+    # (summaries.py); untagged sessions are counted under "".
+    progress = {
+        row.phase_name: row
+        for row in db.session.execute(
+            db.select(PlanProgress.__table__).where(PlanProgress.plan_id == active_plan.id)
         )
+    }
+
+    def _latest(rows):
+        rows = [r for r in rows if r.last_date is not None]
+        return max(rows, key=lambda r: (r.last_date, r.last_session_id)) if rows else None
+
+    def _count_in_phase(phase_name):
+        row = progress.get(phase_name or "")
+        return row.completed_count if row else 0
 
-    def _next_after(session):
-        """The workout after `session`'s workout in plan order, or workouts[0]."""
-        if session is not None and session.planned_workout_id in pos_by_id:
-            return workouts[(pos_by_id[session.planned_workout_id] + 1) % len(workouts)]
+    def _next_after(row):
+        """The workout after `row`'s last workout in plan order, or workouts[0]."""
+        if row is not None and row.last_planned_workout_id in pos_by_id:
+            return workouts[(pos_by_id[row.last_planned_workout_id] + 1) % len(workouts)]
         return workouts[0]
 
     # No phases at all — simple sequential cycling after the last logged workout.
     if not phases_data:
-        total = WorkoutSession.query.filter(*base_filter).count()
+        total = sum(row.completed_count for row in progress.values())
         return {
             "phase_data": None,
             "phase_index": 0,
             "workouts_done_in_phase": total,
             "phase_total_workouts": None,
-            "next_workout": _next_after(_last_session()) if total else workouts[0],
+            "next_workout": _next_after(_latest(progress.values())) if total else workouts[0],
             "workouts": workouts,
         }
 
     name_to_index = {p.get("phase_name"): i for i, p in enumerate(phases_data)}
 
-    def _count_in_phase(phase_name):
-        return WorkoutSession.query.filter(
-            *base_filter, WorkoutSession.phase_name == phase_name
-        ).count()
-
     # Current phase = the phase of the most recently completed, tagged session.
-    last_tagged = _last_session(WorkoutSession.phase_name.isnot(None))
+    last_tagged = _latest(row for name, row in progress.items() if name)
     if last_tagged and last_tagged.phase_name in name_to_index:
         idx = name_to_index[last_tagged.phase_name]
     else:
@@ -339,9 +374,7 @@ def resolve_plan_position(profile_id, active_plan):
     if done == 0:
         next_workout = workouts[0]
     else:
-        next_workout = _next_after(
-            _last_session(WorkoutSession.phase_name == phases_data[idx].get("phase_name"))
-        )
+        next_workout = _next_after(progress.get(phases_data[idx].get("phase_name") or ""))
 
     return {
         "phase_data": phases_data[idx],
@@ -379,18 +412,6 @@ def update_plan_week(plan):
     plan.current_week = min(week, plan.total_weeks or week)
 
 
-def _plan_total_sessions(plan_json_data):
-    """Total expected sessions for a plan (phases × weeks × days_per_week)."""
-    phases = plan_json_data.get("phases", [])
-    days_per_week = plan_json_data.get("days_per_week", 3)
-    if phases:
-        return sum(
-            (p.get("week_end", p.get("week_start", 1)) - p.get("week_start", 1) + 1) * days_per_week
-            for p in phases
-        )
-    return len(plan_json_data.get("workouts", []))
-
-
 def _session_offset_for_workout(workout_index, phases, days_per_week):
     """Effective session count that makes get_next_workout return the workout at workout_index."""
     if not phases:
@@ -408,8 +429,9 @@ def _session_offset_for_workout(workout_index, phases, days_per_week):
 
 def _compute_suggested_start(old_plan, old_session_count, new_plan_json):
     """Suggest a starting workout index in the new plan proportional to progress in the old plan."""
-    old_pj = json.loads(old_plan.plan_json or "{}")
-    old_total = _plan_total_sessions(old_pj)
+    old_total = old_plan.total_sessions
+    if old_total is None:
+        old_total = summaries.plan_total_sessions(get_plan_data(old_plan))
     if old_total == 0:
         return 0
     fraction = min(old_session_count / old_total, 1.0)
@@ -417,7 +439,7 @@ def _compute_suggested_start(old_plan, old_session_count, new_plan_json):
     new_phases = new_plan_json.get("phases", [])
     new_workouts = new_plan_json.get("workouts", [])
     new_days = new_plan_json.get("days_per_week", 3)
-    new_total = _plan_total_sessions(new_plan_json)
+    new_total = summaries.plan_total_sessions(new_plan_json)
     if new_total == 0 or not new_workouts:
         return 0
 
@@ -493,72 +515,65 @@ def get_next_workout(profile_id, active_plan):
     return pos["next_workout"]
 
 
-def get_last_performance(user_id, exercise_name):
-    """Get the last logged sets for a specific exercise."""
-    last_session = (
-        WorkoutSession.query
-        .join(LoggedSet)
-        .filter(
-            WorkoutSession.user_id == user_id,
-            LoggedSet.exercise_name == exercise_name,
-            WorkoutSession.status == SESSION_STATUS_COMPLETED,
+def get_performance_history(user_id, exercise_names, limit=3):
+    """Last `limit` completed sessions' sets for each exercise, newest first:
+    {exercise_name: [{"date": date, "sets": {set_number: {...}}}, ...]}.
+    Exercises with no history are omitted. One round trip for all exercises:
+    ROW_NUMBER() over the exercise_performance summary, partitioned by
+    exercise, keeps only each exercise's `limit` newest sessions."""
+    names = list(dict.fromkeys(exercise_names))
+    if not names or limit < 1:
+        return {}
+    # Rank over the covering (user_id, exercise_name, date, session_id) index
+    # only, then fetch sets_json for the surviving rows by primary key.
+    ranked = (
+        db.select(
+            ExercisePerformance.exercise_name,
+            ExercisePerformance.session_id,
+            db.func.row_number().over(
+                partition_by=ExercisePerformance.exercise_name,
+                order_by=(ExercisePerformance.date.desc(), ExercisePerformance.session_id.desc()),
+            ).label("recency"),
         )
-        .order_by(WorkoutSession.date.desc(), WorkoutSession.id.desc())
-        .first()
+        .where(
+            ExercisePerformance.user_id == user_id,
+            ExercisePerformance.exercise_name.in_(names),
+        )
+        .subquery()
     )
-    if not last_session:
-        return None
-    sets = [s for s in last_session.logged_sets if s.exercise_name == exercise_name]
-    if not sets:
-        return None
-    return {
-        "date": last_session.date,
-        "sets": {
-            s.set_number: {
-                "weight": s.weight_lbs,
-                "reps": s.reps_completed,
-                "weight_b": s.weight_b,
-                "reps_b": s.reps_b,
-                "rpe": s.rpe,
-                "notes": s.notes or "",
-            }
-            for s in sets
-        },
-    }
+    rows = db.session.execute(
+        db.select(ExercisePerformance.exercise_name, ExercisePerformance.date, ExercisePerformance.sets_json)
+        .join(ranked, db.and_(
+            ExercisePerformance.exercise_name == ranked.c.exercise_name,
+            ExercisePerformance.session_id == ranked.c.session_id,
+        ))
+        .where(ExercisePerformance.user_id == user_id, ranked.c.recency <= limit)
+        .order_by(ranked.c.exercise_name, ranked.c.recency)
+    )
+    history = {}
+    for name, session_date, sets_json in rows:
+        history.setdefault(name, []).append({
+            "date": session_date,
+            "sets": {
+                int(set_number): {
+                    "weight": weight, "reps": reps, "weight_b": weight_b,
+                    "reps_b": reps_b, "rpe": rpe, "notes": notes,
+                }
+                for set_number, (weight, reps, weight_b, reps_b, rpe, notes) in json.loads(sets_json).items()
+            },
+        })
+    return history
+
+
+def get_last_performance(user_id, exercise_name):
+    """Get the last logged sets for a specific exercise."""
+    sessions = get_performance_history(user_id, [exercise_name], limit=1).get(exercise_name)
+    return sessions[0] if sessions else None
 
 
 def get_recent_performance(user_id, exercise_name, limit=3):
     """Get the last N sessions for a specific exercise, for history tooltips."""
-    sessions = (
-        WorkoutSession.query
-        .filter(
-            WorkoutSession.user_id == user_id,
-            WorkoutSession.logged_sets.any(LoggedSet.exercise_name == exercise_name),
-            WorkoutSession.status == SESSION_STATUS_COMPLETED,
-        )
-        .order_by(WorkoutSession.date.desc(), WorkoutSession.id.desc())
-        .limit(limit)
-        .all()
-    )
-    result = []
-    for session in sessions:
-        sets = [s for s in session.logged_sets if s.exercise_name == exercise_name]
-        if sets:
-            result.append({
-                "date": session.date,
-                "sets": {
-                    s.set_number: {
-                        "weight": s.weight_lbs,
-                        "reps": s.reps_completed,
-                        "weight_b": s.weight_b,
-                        "reps_b": s.reps_b,
-                        "rpe": s.rpe,
-                        "notes": s.notes or "",
-                    }
-                    for s in sets
-                },
-            })
-    return result
+    return get_performance_history(user_id, [exercise_name], limit=limit).get(exercise_name, [])
 
 
 def update_streak(profile):
@@ -583,16 +598,48 @@ def update_streak(profile):
     profile.last_workout_date = today
 
 
+def get_session_index(user_id, start, end, statuses=None):
+    """Sessions dated start..end (inclusive) grouped by day, in one query:
+    {date: [{id, date, status, workout_name, phase_name, plan_id}, ...]}.
+    Days without sessions are absent; each day's sessions are in id order.
+    `statuses` limits the index to those session statuses (default: all).
+    Shared by the mini calendar and the month calendar."""
+    query = (
+        db.select(
+            WorkoutSession.id, WorkoutSession.date, WorkoutSession.status, WorkoutSession.phase_name,
+            PlannedWorkout.workout_name, PlannedWorkout.plan_id,
+        )
+        .outerjoin(PlannedWorkout, WorkoutSession.planned_workout_id == PlannedWorkout.id)
+        .where(
+            WorkoutSession.user_id == user_id,
+            WorkoutSession.date >= start,
+            WorkoutSession.date <= end,
+        )
+        .order_by(WorkoutSession.date, WorkoutSession.id)
+    )
+    if statuses is not None:
+        query = query.where(WorkoutSession.status.in_(statuses))
+    index = {}
+    for session_id, session_date, status, phase_name, workout_name, plan_id in db.session.execute(query):
+        index.setdefault(session_date, []).append({
+            "id": session_id,
+            "date": session_date,
+            "status": status,
+            "workout_name": workout_name,
+            "phase_name": phase_name,
+            "plan_id": plan_id,
+        })
+    return index
+
+
 def get_mini_calendar(user_id):
     """Get last 7 days with workout completion status."""
     today = date.today()
+    index = get_session_index(user_id, today - timedelta(days=6), today)
     days = []
     for i in range(6, -1, -1):
         d = today - timedelta(days=i)
-        has_workout = WorkoutSession.query.filter_by(
-            user_id=user_id, date=d
-        ).first() is not None
-        days.append({"date": d, "completed": has_workout, "is_today": d == today})
+        days.append({"date": d, "completed": d in index, "is_today": d == today})
     return days
 
 
@@ -607,11 +654,7 @@ def build_phase_color_map(active_plan):
     """Return {phase_name: color} for the active plan's phases (legend use only)."""
     if not active_plan:
         return {}
-    try:
-        plan_data = json.loads(active_plan.plan_json or "{}")
-        phases = [p.get("phase_name", "") for p in plan_data.get("phases", []) if p.get("phase_name")]
-    except Exception:
-        phases = []
+    phases = [p.get("phase_name", "") for p in get_plan_data(active_plan).get("phases", []) if p.get("phase_name")]
     return {name: PHASE_COLORS[i % len(PHASE_COLORS)] for i, name in enumerate(phases)}
 
 
@@ -628,45 +671,30 @@ def build_month_calendar(profile_id, year, month):
     first_day = date(year, month, 1)
     last_day = date(year, month + 1, 1) - timedelta(days=1) if month < 12 else date(year + 1, 1, 1) - timedelta(days=1)
 
-    sessions = WorkoutSession.query.filter(
-        WorkoutSession.user_id == profile_id,
-        WorkoutSession.date >= first_day,
-        WorkoutSession.date <= last_day,
-        WorkoutSession.status == SESSION_STATUS_COMPLETED,
-    ).order_by(WorkoutSession.date, WorkoutSession.id).all()
+    index = get_session_index(profile_id, first_day, last_day, statuses=(SESSION_STATUS_COMPLETED,))
+    sessions = [s for day in index.values() for s in day]
 
     # Build per-plan phase-name → color map (keyed by plan_id) for all plans
     # referenced by sessions in this month, resolved in one batch.
-    pw_ids = {s.planned_workout_id for s in sessions if s.planned_workout_id}
-    plan_id_by_pw: dict = {}
-    if pw_ids:
-        for pw in PlannedWorkout.query.filter(PlannedWorkout.id.in_(pw_ids)).all():
-            plan_id_by_pw[pw.id] = pw.plan_id
-
     phase_colors_by_plan: dict = {}
-    plan_ids = set(plan_id_by_pw.values())
+    plan_ids = {s["plan_id"] for s in sessions if s["plan_id"]}
     if plan_ids:
         for plan in WorkoutPlan.query.filter(WorkoutPlan.id.in_(plan_ids)).all():
-            try:
-                phases = json.loads(plan.plan_json or "{}").get("phases", [])
-                phase_colors_by_plan[plan.id] = {
-                    p["phase_name"]: PHASE_COLORS[i % len(PHASE_COLORS)]
-                    for i, p in enumerate(phases)
-                    if p.get("phase_name")
-                }
-            except Exception:
-                phase_colors_by_plan[plan.id] = {}
+            phase_colors_by_plan[plan.id] = {
+                p["phase_name"]: PHASE_COLORS[i % len(PHASE_COLORS)]
+                for i, p in enumerate(get_plan_data(plan).get("phases", []))
+                if p.get("phase_name")
+            }
 
     # Group sessions by date, coloring each by its phase index within its own plan
     sessions_by_date = {}
     for s in sessions:
-        plan_id = plan_id_by_pw.get(s.planned_workout_id)
-        plan_phases = phase_colors_by_plan.get(plan_id, {}) if plan_id else {}
-        color = plan_phases.get(s.phase_name, NO_PHASE_COLOR) if s.phase_name else NO_PHASE_COLOR
-        sessions_by_date.setdefault(s.date, []).append({
-            "id": s.id,
-            "phase_name": s.phase_name,
-            "workout_name": s.planned_workout.workout_name if s.planned_workout else None,
+        plan_phases = phase_colors_by_plan.get(s["plan_id"], {}) if s["plan_id"] else {}
+        color = plan_phases.get(s["phase_name"], NO_PHASE_COLOR) if s["phase_name"] else NO_PHASE_COLOR
+        sessions_by_date.setdefault(s["date"], []).append({
+            "id": s["id"],
+            "phase_name": s["phase_name"],
+            "workout_name": s["workout_name"],
             "color": color,
         })
 
@@ -811,6 +839,49 @@ def get_pending_plan(profile):
     ).order_by(WorkoutPlan.created_at.desc()).first()
 
 
+def get_plan_list(user_id, statuses):
+    """A user's plans with the given statuses, newest first, for the plan
+    history and generate-plan pages: [{plan, session_count, workouts, phases}, ...].
+
+    Completed-session counts come from the plan_progress counters in one
+    grouped query; workouts, their exercises and the plan's phases are
+    loaded in bulk; list-level details read the summary columns extracted at
+    activation. plan_json is parsed only for a plan with no TrainingPhase
+    rows (older activations), whose phases it still holds.
+    """
+    plans = (
+        WorkoutPlan.query
+        .options(
+            db.selectinload(WorkoutPlan.planned_workouts).selectinload(PlannedWorkout.planned_exercises),
+            db.selectinload(WorkoutPlan.phases),
+        )
+        .filter(WorkoutPlan.user_id == user_id, WorkoutPlan.status.in_(statuses))
+        .order_by(WorkoutPlan.created_at.desc())
+        .all()
+    )
+    session_counts = dict(db.session.execute(
+        db.select(PlanProgress.plan_id, db.func.sum(PlanProgress.completed_count))
+        .where(PlanProgress.plan_id.in_([p.id for p in plans]))
+        .group_by(PlanProgress.plan_id)
+    ).all()) if plans else {}
+    return [
+        {
+            "plan": p,
+            "session_count": session_counts.get(p.id, 0),
+            "workouts": sorted(p.planned_workouts, key=lambda w: w.order_index or 0),
+            "phases": p.phases or get_plan_data(p).get("phases") or (),
+        }
+        for p in plans
+    ]
+
+
+def _running_plan_job(user_id):
+    """The user's queued or running plan generation job, if any."""
+    return PlanJob.query.filter(
+        PlanJob.user_id == user_id, PlanJob.status.in_((PLAN_JOB_QUEUED, PLAN_JOB_RUNNING))
+    ).order_by(PlanJob.id.desc()).first()
+
+
 @app.route("/generate-plan")
 @login_required
 def generate_plan():
@@ -818,8 +889,24 @@ def generate_plan():
     if not profile:
         return redirect(url_for("setup"))
 
+    # The page polls a running job; ?job=<id> (where the generate POST lands)
+    # reports a finished one once: job ids only grow, so the session keeps the
+    # last one reported and a reload or bookmark of the URL stays quiet
+    job_id = request.args.get("job", type=int)
+    running_job = db.session.get(PlanJob, job_id) if job_id else _running_plan_job(profile.id)
+    if running_job is not None and running_job.user_id != profile.id:
+        running_job = None
+    elif running_job is not None and running_job.status in (PLAN_JOB_SUCCEEDED, PLAN_JOB_FAILED):
+        if running_job.id > flask_session.get("reported_plan_job", 0):
+            flask_session["reported_plan_job"] = running_job.id
+            if running_job.status == PLAN_JOB_SUCCEEDED:
+                flash("Plan generated! Review it below.", "success")
+            else:
+                flash(f"Error generating plan: {running_job.error}", "error")
+        return redirect(url_for("generate_plan"))
+
     pending = get_pending_plan(profile)
-    pending_plan = json.loads(pending.plan_json) if pending else None
+    pending_plan = get_plan_data(pending) if pending else None
 
     suggested_start_index = 0
     if pending_plan:
@@ -831,29 +918,7 @@ def generate_plan():
             ).count()
             suggested_start_index = _compute_suggested_start(old_plan, old_session_count, pending_plan)
 
-    past_plan_records = (
-        WorkoutPlan.query
-        .filter(WorkoutPlan.user_id == profile.id, WorkoutPlan.status.in_(["active", "inactive"]))
-        .order_by(WorkoutPlan.created_at.desc())
-        .all()
-    )
-    past_plans = []
-    for p in past_plan_records:
-        try:
-            pj = json.loads(p.plan_json or "{}")
-        except Exception:
-            pj = {}
-        session_count = WorkoutSession.query.filter(
-            WorkoutSession.user_id == profile.id,
-            WorkoutSession.planned_workout_id.in_([w.id for w in p.planned_workouts]),
-            WorkoutSession.status == SESSION_STATUS_COMPLETED,
-        ).count()
-        past_plans.append({
-            "plan": p,
-            "plan_json": pj,
-            "session_count": session_count,
-            "workouts": PlannedWorkout.query.filter_by(plan_id=p.id).order_by(PlannedWorkout.order_index).all(),
-        })
+    past_plans = get_plan_list(profile.id, ["active", "inactive"])
 
     latest_review = (
         AIReview.query
@@ -864,7 +929,8 @@ def generate_plan():
 
     return render_template("generate_plan.html", profile=profile, pending_plan=pending_plan,
                            suggested_start_index=suggested_start_index, past_plans=past_plans,
-                           latest_review=latest_review)
+                           latest_review=latest_review,
+                           running_job=plan_jobs.job_status(running_job) if running_job else None)
 
 
 @app.route("/generate-plan/generate", methods=["POST"])
@@ -895,109 +961,148 @@ def generate_plan_api():
                 pass
 
     extra_context = request.form.get("extra_context", "").strip() or None
+    # Regenerating means the pending plan was turned down: don't serve it from the cache again
+    regenerate = bool(request.form.get("regenerate")) or get_pending_plan(profile) is not None
 
-    from ai import generate_workout_plan
-    try:
-        plan_data = generate_workout_plan(profile, fitness_test=fitness_test, prior_review=prior_review, extra_context=extra_context)
-
-        # Remove any old pending plans
-        WorkoutPlan.query.filter_by(user_id=profile.id, status="pending").delete()
-
-        pending = WorkoutPlan(
+    # One generation at a time per user: a repeat submit joins the running job
+    job = _running_plan_job(profile.id)
+    if job is None:
+        job = PlanJob(
             user_id=profile.id,
-            name=plan_data["plan_name"],
-            description=plan_data.get("description", ""),
-            days_per_week=plan_data.get("days_per_week", 3),
-            plan_json=json.dumps(plan_data),
-            status="pending",
-            total_weeks=plan_data.get("total_weeks", 12),
+            stage=plan_jobs.STAGE_QUEUED,
+            params_json=json.dumps({
+                "fitness_test_id": fitness_test.id if fitness_test else None,
+                "prior_review": prior_review,
+                "extra_context": extra_context,
+                "regenerate": regenerate,
+            }),
         )
-        db.session.add(pending)
+        db.session.add(job)
         db.session.commit()
-        flash("Plan generated! Review it below.", "success")
-    except Exception as e:
-        flash(f"Error generating plan: {str(e)}", "error")
+    plan_job_runner.ensure(app, job)
 
-    return redirect(url_for("generate_plan"))
+    status_url = url_for("plan_job_status", job_id=job.id)
+    if request.accept_mimetypes.best == "application/json":
+        return jsonify({"job_id": job.id, "status_url": status_url}), 202
+    return redirect(url_for("generate_plan", job=job.id))
 
 
-@app.route("/generate-plan/confirm", methods=["POST"])
+@app.route("/api/plan/jobs/<int:job_id>")
 @login_required
-def confirm_plan():
+def plan_job_status(job_id):
+    """A plan generation job's progress, for the generate page to poll:
+    ?since=<n>&attempt=<a> returns the phases and workouts streamed since the
+    page's last poll (see plan_jobs.job_status)."""
     profile = get_profile()
-    pending = get_pending_plan(profile) if profile else None
-    if not pending or not profile:
-        flash("No plan to activate.", "error")
-        return redirect(url_for("generate_plan"))
+    job = db.session.get(PlanJob, job_id)
+    if not profile or job is None or job.user_id != profile.id:
+        return jsonify({"error": "job not found"}), 404
+    plan_job_runner.ensure(app, job)
+    response = jsonify(plan_jobs.job_status(job, since=request.args.get("since", 0, type=int),
+                                            attempt=request.args.get("attempt", type=int)))
+    response.headers["Cache-Control"] = "no-store"
+    return response
 
-    pending_plan = json.loads(pending.plan_json)
 
-    start_workout_index = request.form.get("start_workout_index", 0, type=int)
+def activate_plan(profile_id, pending, start_workout_index=0):
+    """Turn the pending plan into the user's active plan, with its phases,
+    workouts and exercises; returns the new plan's id. Not committed.
+
+    Reads (the exercise-library matches) happen before the first write, and
+    the rows go in as one multi-row INSERT per table with RETURNING ids, so
+    SQLite's write lock is held for a few statements rather than a round
+    trip per exercise.
+    """
+    pending_plan = json.loads(pending.plan_json)
     plan_phases = pending_plan.get("phases", [])
+    plan_workouts = pending_plan.get("workouts", [])
     plan_days_per_week = pending_plan.get("days_per_week", 3)
     offset = _session_offset_for_workout(start_workout_index, plan_phases, plan_days_per_week)
 
-    db.session.delete(pending)
+    # Library ids for every exercise name in the plan, in one read
+    library_ids = _library_ids_by_key(ex["name"] for w in plan_workouts for ex in w.get("exercises", []))
+
+    # Writes start here. A pending plan has no child rows, so skip the ORM
+    # delete cascade's loads of them.
+    db.session.execute(db.delete(WorkoutPlan).where(WorkoutPlan.id == pending.id))
 
     # Deactivate existing plans for this user only
-    WorkoutPlan.query.filter_by(status="active", user_id=profile.id).update({"status": "inactive"})
+    WorkoutPlan.query.filter_by(status="active", user_id=profile_id).update({"status": "inactive"})
 
-    plan = WorkoutPlan(
-        user_id=profile.id,
+    plan_id = db.session.execute(db.insert(WorkoutPlan).values(
+        user_id=profile_id,
         name=pending_plan["plan_name"],
         description=pending_plan.get("description", ""),
-        days_per_week=pending_plan.get("days_per_week", 3),
+        days_per_week=plan_days_per_week,
         plan_json=json.dumps(pending_plan),
         status="active",
         total_weeks=pending_plan.get("total_weeks", 12),
         current_week=1,
         start_date=date.today(),
         session_offset=offset,
-    )
-    db.session.add(plan)
-    db.session.flush()
+        **summaries.plan_summary_columns(pending_plan),
+    )).inserted_primary_key[0]
+
+    if plan_phases:
+        db.session.execute(db.insert(TrainingPhase).values([
+            {
+                "plan_id": plan_id,
+                "phase_name": phase_data["phase_name"],
+                "phase_type": phase_data.get("phase_type", "progressive"),
+                "week_start": phase_data["week_start"],
+                "week_end": phase_data["week_end"],
+                "description": phase_data.get("description", ""),
+                "nutrition_guide": phase_data.get("nutrition_guide", ""),
+                "order_index": i,
+            }
+            for i, phase_data in enumerate(plan_phases)
+        ]))
+
+    if plan_workouts:
+        # RETURNING row order isn't guaranteed; order_index maps ids back to workouts
+        workout_ids = dict(db.session.execute(
+            db.insert(PlannedWorkout).values([
+                {
+                    "plan_id": plan_id,
+                    "day_of_week": workout_data["day"],
+                    "workout_name": workout_data["name"],
+                    "order_index": i,
+                }
+                for i, workout_data in enumerate(plan_workouts)
+            ]).returning(PlannedWorkout.order_index, PlannedWorkout.id)
+        ).all())
+        exercise_rows = [
+            {
+                "planned_workout_id": workout_ids[i],
+                "exercise_name": exercise_data["name"],
+                "exercise_library_id": library_ids.get(exercise_name_key(exercise_data["name"])),
+                "sets_prescribed": exercise_data["sets"],
+                "reps_prescribed": str(exercise_data["reps"]),
+                "rest_seconds": exercise_data.get("rest_seconds"),
+                "notes": exercise_data.get("notes", ""),
+                "exercise_type": exercise_data.get("type", "main"),
+                "form_cues": exercise_data.get("form_cues", ""),
+            }
+            for i, workout_data in enumerate(plan_workouts)
+            for exercise_data in workout_data.get("exercises", [])
+        ]
+        if exercise_rows:
+            db.session.execute(db.insert(PlannedExercise).values(exercise_rows))
+
+    return plan_id
 
-    # Create training phases
-    for i, phase_data in enumerate(pending_plan.get("phases", [])):
-        tp = TrainingPhase(
-            plan_id=plan.id,
-            phase_name=phase_data["phase_name"],
-            phase_type=phase_data.get("phase_type", "progressive"),
-            week_start=phase_data["week_start"],
-            week_end=phase_data["week_end"],
-            description=phase_data.get("description", ""),
-            nutrition_guide=phase_data.get("nutrition_guide", ""),
-            order_index=i,
-        )
-        db.session.add(tp)
-
-    # Create planned workouts and exercises
-    for i, workout_data in enumerate(pending_plan.get("workouts", [])):
-        pw = PlannedWorkout(
-            plan_id=plan.id,
-            day_of_week=workout_data["day"],
-            workout_name=workout_data["name"],
-            order_index=i,
-        )
-        db.session.add(pw)
-        db.session.flush()
-
-        for exercise_data in workout_data.get("exercises", []):
-            lib_entry = ExerciseLibrary.query.filter(
-                db.func.lower(ExerciseLibrary.name) == exercise_data["name"].lower()
-            ).first()
-            pe = PlannedExercise(
-                planned_workout_id=pw.id,
-                exercise_name=exercise_data["name"],
-                exercise_library_id=lib_entry.id if lib_entry else None,
-                sets_prescribed=exercise_data["sets"],
-                reps_prescribed=str(exercise_data["reps"]),
-                rest_seconds=exercise_data.get("rest_seconds"),
-                notes=exercise_data.get("notes", ""),
-                exercise_type=exercise_data.get("type", "main"),
-                form_cues=exercise_data.get("form_cues", ""),
-            )
-            db.session.add(pe)
+
+@app.route("/generate-plan/confirm", methods=["POST"])
+@login_required
+def confirm_plan():
+    profile = get_profile()
+    pending = get_pending_plan(profile) if profile else None
+    if not pending or not profile:
+        flash("No plan to activate.", "error")
+        return redirect(url_for("generate_plan"))
+
+    start_workout_index = request.form.get("start_workout_index", 0, type=int)
+    activate_plan(profile.id, pending, start_workout_index)
 
     db.session.commit()
     flash("Workout plan activated!", "success")
@@ -1114,17 +1219,29 @@ def _parse_logged_sets_from_form():
     return exercise_names, set_numbers, weights, reps, rpes, set_notes, weights_b, reps_b
 
 
+def _library_ids_by_key(exercise_names):
+    """{exercise_name_key: ExerciseLibrary.id} for the library entries matching
+    any of `exercise_names`, in one indexed read; when several entries share a
+    key the oldest wins."""
+    keys = {exercise_name_key(n) for n in exercise_names} - {""}
+    library_ids = {}
+    if keys:
+        for lib_id, key in db.session.execute(
+            db.select(ExerciseLibrary.id, ExerciseLibrary.name_key)
+            .where(ExerciseLibrary.name_key.in_(keys))
+            .order_by(ExerciseLibrary.id)
+        ):
+            library_ids.setdefault(key, lib_id)
+    return library_ids
+
+
 def _build_logged_sets(session_id, exercise_names, set_numbers, weights, reps, rpes, set_notes,
                        weights_b=None, reps_b=None, skip_empty=False):
     """Create LoggedSet objects for the given session; returns list of LoggedSet instances."""
     if not exercise_names:
         return []
 
-    unique_lower = list({n.lower() for n in exercise_names})
-    lib_entries = ExerciseLibrary.query.filter(
-        db.func.lower(ExerciseLibrary.name).in_(unique_lower)
-    ).all()
-    lib_by_name = {e.name.lower(): e for e in lib_entries}
+    library_ids = _library_ids_by_key(exercise_names)
 
     logged_list = []
     for i in range(len(exercise_names)):
@@ -1166,11 +1283,10 @@ def _build_logged_sets(session_id, exercise_names, set_numbers, weights, reps, r
             except ValueError:
                 pass
 
-        lib_entry = lib_by_name.get(exercise_names[i].lower())
         logged = LoggedSet(
             session_id=session_id,
             exercise_name=exercise_names[i],
-            exercise_library_id=lib_entry.id if lib_entry else None,
+            exercise_library_id=library_ids.get(exercise_name_key(exercise_names[i])),
             set_number=int(set_numbers[i]) if i < len(set_numbers) and set_numbers[i] else 1,
             weight_lbs=weight_val,
             reps_completed=reps_val,
@@ -1183,11 +1299,89 @@ def _build_logged_sets(session_id, exercise_names, set_numbers, weights, reps, r
     return logged_list
 
 
+_SYNCED_SET_FIELDS = ("exercise_library_id", "weight_lbs", "reps_completed", "weight_b", "reps_b", "rpe", "notes")
+
+
+def _copy_set_fields(stored, logged):
+    """Copy logged's values onto the stored set; True if any changed."""
+    changed = False
+    for field in _SYNCED_SET_FIELDS:
+        value = getattr(logged, field)
+        if getattr(stored, field) != value:
+            setattr(stored, field, value)
+            changed = True
+    return changed
+
+
+def _sync_logged_sets(workout_session, logged_sets):
+    """Make the session's stored sets match `logged_sets` (from
+    _build_logged_sets), matched on (exercise_name, set_number): new sets are
+    inserted, changed ones updated in place and missing ones deleted, so a
+    pause/resume cycle only writes what changed. Flushes nothing; returns the
+    per-action row counts."""
+    existing = {}
+    stale = []
+    for stored in LoggedSet.query.filter_by(session_id=workout_session.id).order_by(LoggedSet.id):
+        key = (stored.exercise_name, stored.set_number)
+        if key in existing:
+            stale.append(stored)  # duplicate of a matched key
+        else:
+            existing[key] = stored
+
+    counts = {"inserted": 0, "updated": 0, "deleted": 0, "unchanged": 0}
+    for logged in logged_sets:
+        stored = existing.pop((logged.exercise_name, logged.set_number), None)
+        if stored is None:
+            db.session.add(logged)
+            counts["inserted"] += 1
+            continue
+        counts["updated" if _copy_set_fields(stored, logged) else "unchanged"] += 1
+
+    for stored in stale + list(existing.values()):
+        db.session.delete(stored)
+        counts["deleted"] += 1
+    return counts
+
+
+def _sync_counts_header(counts):
+    return " ".join(f"{action}={n}" for action, n in counts.items())
+
+
+def _set_session_fields(workout_session, status, *, overall_feeling, session_notes, elapsed_seconds,
+                        superset_exercises, phase_name):
+    """Apply a Log Workout / Save & Pause submission's session fields; the
+    session is taken to have ended now, after `elapsed_seconds`."""
+    end_time = datetime.now(timezone.utc)
+    workout_session.status = status
+    workout_session.end_time = end_time
+    workout_session.start_time = end_time - timedelta(seconds=elapsed_seconds)
+    workout_session.overall_feeling = overall_feeling
+    workout_session.session_notes = session_notes
+    workout_session.elapsed_seconds = elapsed_seconds
+    workout_session.superset_exercises = superset_exercises
+    workout_session.phase_name = phase_name
+
+
+def _complete_paused_sessions(user_id, keep=None):
+    """Complete the user's paused sessions other than `keep`, so only the
+    workout being paused stays resumable."""
+    query = WorkoutSession.query.filter_by(user_id=user_id, status=SESSION_STATUS_PAUSED)
+    if keep is not None:
+        query = query.filter(WorkoutSession.id != keep.id)
+    query.update({"status": SESSION_STATUS_COMPLETED, "end_time": datetime.now(timezone.utc)})
+
+
 def _upsert_workout_session(profile, status):
     """Create or update a WorkoutSession from the current request form.
 
     Returns the upserted WorkoutSession (flushed, not committed), or None if the
-    resume_session_id belongs to a different user.
+    resume_session_id belongs to a different user. A resumed session keeps its
+    sets; _sync_logged_sets() reconciles them with the form.
+
+    The form carries the page's client_token: if the page's synced sets made a
+    session before the page learned its id, the form saves that one. Either
+    way the token is recorded as finalized, so the page's queued sync calls
+    that land later are refused instead of starting another session.
     """
     planned_workout_id = request.form.get("planned_workout_id")
     overall_feeling = request.form.get("overall_feeling", type=int)
@@ -1196,44 +1390,40 @@ def _upsert_workout_session(profile, status):
     resume_session_id = request.form.get("resume_session_id", type=int)
     superset_exercises = json.dumps(request.form.getlist("superset_exercise"))
     phase_name = request.form.get("phase_name") or None
+    token = request.form.get("client_token", "")[:64] or None
 
-    end_time = datetime.now(timezone.utc)
-    start_time = end_time - timedelta(seconds=elapsed_seconds)
+    if not resume_session_id and token:
+        synced = _session_by_token(token)
+        if (synced is not None and synced.user_id == profile.id and synced.client_token == token
+                and synced.status == SESSION_STATUS_PAUSED):
+            resume_session_id = synced.id
 
     if resume_session_id:
         workout_session = WorkoutSession.query.get_or_404(resume_session_id)
         if workout_session.user_id != profile.id:
             return None
-        LoggedSet.query.filter_by(session_id=workout_session.id).delete()
-        workout_session.status = status
-        workout_session.end_time = end_time
-        workout_session.start_time = start_time
-        workout_session.overall_feeling = overall_feeling
-        workout_session.session_notes = session_notes
-        workout_session.elapsed_seconds = elapsed_seconds
-        workout_session.superset_exercises = superset_exercises
-        workout_session.phase_name = phase_name
+        workout_session.client_token = None  # the whole form is saved from here on
+        workout_session.finalized_token = token
         if planned_workout_id:
             workout_session.planned_workout_id = int(planned_workout_id)
     else:
         if status == SESSION_STATUS_PAUSED:
-            WorkoutSession.query.filter_by(
-                user_id=profile.id, status=SESSION_STATUS_PAUSED
-            ).update({"status": SESSION_STATUS_COMPLETED, "end_time": end_time})
+            _complete_paused_sessions(profile.id)
         workout_session = WorkoutSession(
             user_id=profile.id,
             planned_workout_id=int(planned_workout_id) if planned_workout_id else None,
             date=date.today(),
-            start_time=start_time,
-            end_time=end_time,
-            overall_feeling=overall_feeling,
-            session_notes=session_notes,
-            status=status,
-            elapsed_seconds=elapsed_seconds,
-            superset_exercises=superset_exercises,
-            phase_name=phase_name,
+            finalized_token=token,
         )
         db.session.add(workout_session)
+    _set_session_fields(
+        workout_session, status,
+        overall_feeling=overall_feeling,
+        session_notes=session_notes,
+        elapsed_seconds=elapsed_seconds,
+        superset_exercises=superset_exercises,
+        phase_name=phase_name,
+    )
     db.session.flush()
     return workout_session
 
@@ -1276,15 +1466,8 @@ def _build_workout_context(profile, planned_workout, active_plan, *, resume_sess
     main = [e for e in all_exercises if e.exercise_type == "main"]
     cooldown = [e for e in all_exercises if e.exercise_type == "cooldown"]
 
-    last_perf = {}
-    recent_perf = {}
-    for ex in all_exercises:
-        perf = get_last_performance(profile.id, ex.exercise_name)
-        if perf:
-            last_perf[ex.exercise_name] = perf
-        recent = get_recent_performance(profile.id, ex.exercise_name, limit=3)
-        if recent:
-            recent_perf[ex.exercise_name] = recent
+    recent_perf = get_performance_history(profile.id, [ex.exercise_name for ex in all_exercises], limit=3)
+    last_perf = {name: sessions[0] for name, sessions in recent_perf.items()}
 
     all_plan_workouts = []
     if active_plan:
@@ -1320,11 +1503,9 @@ def _build_workout_context(profile, planned_workout, active_plan, *, resume_sess
     plan_phases = []
     current_phase_name = None
     if active_plan:
-        try:
-            plan_data = json.loads(active_plan.plan_json or "{}")
-            plan_phases = [p.get("phase_name", "") for p in plan_data.get("phases", []) if p.get("phase_name")]
-        except Exception:
-            plan_phases = []
+        plan_phases = [
+            p.get("phase_name", "") for p in get_plan_data(active_plan).get("phases", []) if p.get("phase_name")
+        ]
         phase_info = get_plan_position(profile.id, active_plan)
         if phase_info:
             current_phase_name = phase_info.get("phase_name")
@@ -1360,11 +1541,14 @@ def _build_workout_context(profile, planned_workout, active_plan, *, resume_sess
                 'weight_b': ls.weight_b,
                 'reps_b': ls.reps_b,
             }
-        # Only show exercises that were present in the saved session — removals must not reappear
-        warmup = [e for e in warmup if e.exercise_name in resume_data]
-        main = [e for e in main if e.exercise_name in resume_data]
-        cooldown = [e for e in cooldown if e.exercise_name in resume_data]
-        all_exercises = warmup + main + cooldown
+        # Only show exercises that were present in the saved session — removals must not reappear.
+        # A session saved only set by set (client_token still set) holds just the sets entered
+        # so far, so it keeps the whole planned workout.
+        if resume_session.client_token is None:
+            warmup = [e for e in warmup if e.exercise_name in resume_data]
+            main = [e for e in main if e.exercise_name in resume_data]
+            cooldown = [e for e in cooldown if e.exercise_name in resume_data]
+            all_exercises = warmup + main + cooldown
 
     incoming_general_note, incoming_specific_note = _get_next_workout_notes(
         profile.id, planned_workout.workout_name
@@ -1407,10 +1591,9 @@ def workout_log():
         return redirect(url_for("index"))
 
     exercise_names, set_numbers, weights, reps, rpes, set_notes, weights_b, reps_b = _parse_logged_sets_from_form()
-    for ls in _build_logged_sets(
-            workout_session.id, exercise_names, set_numbers,
-            weights, reps, rpes, set_notes, weights_b, reps_b):
-        db.session.add(ls)
+    set_counts = _sync_logged_sets(workout_session, _build_logged_sets(
+        workout_session.id, exercise_names, set_numbers,
+        weights, reps, rpes, set_notes, weights_b, reps_b))
 
     workout_name = (
         workout_session.planned_workout.workout_name
@@ -1426,12 +1609,14 @@ def workout_log():
     update_streak(profile)
     db.session.commit()
 
-    return render_template(
+    response = make_response(render_template(
         "workout_done.html",
         session_obj=workout_session,
         logged_sets=sorted(workout_session.logged_sets, key=_exercise_order_key(workout_session)),
         exercise_type_map=_exercise_type_map(workout_session),
-    )
+    ))
+    response.headers["X-Logged-Sets"] = _sync_counts_header(set_counts)
+    return response
 
 
 @app.route("/workout/pause", methods=["POST"])
@@ -1446,14 +1631,15 @@ def workout_pause():
         return redirect(url_for("index"))
 
     exercise_names, set_numbers, weights, reps, rpes, set_notes, weights_b, reps_b = _parse_logged_sets_from_form()
-    for ls in _build_logged_sets(
-            workout_session.id, exercise_names, set_numbers,
-            weights, reps, rpes, set_notes, weights_b, reps_b):
-        db.session.add(ls)
+    set_counts = _sync_logged_sets(workout_session, _build_logged_sets(
+        workout_session.id, exercise_names, set_numbers,
+        weights, reps, rpes, set_notes, weights_b, reps_b))
 
     db.session.commit()
     flash("Workout paused. Resume it anytime from the dashboard.", "info")
-    return redirect(url_for("index"))
+    response = redirect(url_for("index"))
+    response.headers["X-Logged-Sets"] = _sync_counts_header(set_counts)
+    return response
 
 
 @app.route("/workout/resume/<int:session_id>")
@@ -1501,20 +1687,328 @@ def workout_finish_paused(session_id):
     return redirect(url_for("workout_today"))
 
 
-@app.route("/history")
+@app.route("/sw.js")
+def service_worker():
+    """The workout page's service worker (static/sw.js), served from the root
+    so its scope covers the pages it caches for offline use."""
+    response = send_file(os.path.join(app.static_folder, "sw.js"), mimetype="text/javascript")
+    response.headers["Cache-Control"] = "no-cache"
+    return response
+
+
+def _json_field(data, key):
+    """A JSON value as the string _build_logged_sets() parses ("" for missing/null)."""
+    value = data.get(key)
+    return "" if value is None else str(value)
+
+
+def _json_set_lists(set_ops):
+    """_parse_logged_sets_from_form()'s parallel lists, from JSON set dicts."""
+    return tuple(
+        [_json_field(op, key) for op in set_ops]
+        for key in ("exercise_name", "set_number", "weight", "reps", "rpe", "notes", "weight_b", "reps_b")
+    )
+
+
+def _parse_set_op(op):
+    """(seq, exercise_name, set_number) of one JSON set write; ValueError if malformed."""
+    if not isinstance(op, dict):
+        raise ValueError("each set must be an object")
+    try:
+        seq = int(op.get("seq"))
+        set_number = int(op.get("set_number"))
+    except (TypeError, ValueError):
+        raise ValueError("seq and set_number must be integers")
+    exercise_name = str(op.get("exercise_name") or "").strip()
+    if not exercise_name or seq < 1 or set_number < 1:
+        raise ValueError("exercise_name, seq and set_number are required")
+    return seq, exercise_name, set_number
+
+
+def _apply_set_op(workout_session, op, exercise_name, set_number):
+    """Insert, update or (deleted: true) delete one set of the session."""
+    stored = LoggedSet.query.filter_by(
+        session_id=workout_session.id, exercise_name=exercise_name, set_number=set_number
+    ).first()
+    if op.get("deleted"):
+        if stored is not None:
+            db.session.delete(stored)
+        return
+    logged = _build_logged_sets(workout_session.id, *_json_set_lists([op]))[0]
+    logged.exercise_name, logged.set_number = exercise_name, set_number
+    if stored is None:
+        db.session.add(logged)
+    else:
+        _copy_set_fields(stored, logged)
+
+
+def _client_date(value):
+    """The page's local date for a session it creates, so sets queued offline
+    keep the day they were lifted; today if missing, malformed or ahead."""
+    try:
+        return min(date.fromisoformat(str(value)), date.today())
+    except ValueError:
+        return date.today()
+
+
+def _session_by_token(token):
+    """The session a page's token is writing to, or whose form that page saved."""
+    return WorkoutSession.query.filter(
+        db.or_(WorkoutSession.client_token == token, WorkoutSession.finalized_token == token)
+    ).first()
+
+
+def _session_for_set(profile, session_id, token, data):
+    """The in-progress session a per-set call targets: by session_id, else by
+    the page's client token, else a new paused session carrying that token.
+    None if the session belongs to another user."""
+    if session_id:
+        workout_session = db.session.get(WorkoutSession, session_id)
+    else:
+        workout_session = _session_by_token(token)
+        if workout_session is None:
+            planned_workout_id = data.get("planned_workout_id")
+            workout_session = WorkoutSession(
+                user_id=profile.id,
+                planned_workout_id=int(planned_workout_id) if planned_workout_id else None,
+                date=_client_date(data.get("date")),
+                status=SESSION_STATUS_PAUSED,  # resumable from the dashboard until /workout/log finalizes it
+                phase_name=data.get("phase_name") or None,
+                client_token=token,
+            )
+            db.session.add(workout_session)
+            try:
+                db.session.flush()
+            except IntegrityError:
+                # Another request with the same token (a second tab, a retry) created it first
+                db.session.rollback()
+                workout_session = _session_by_token(token)
+            else:
+                _complete_paused_sessions(profile.id, keep=workout_session)  # this is the workout in progress now
+    if workout_session is None or workout_session.user_id != profile.id:
+        return None
+    return workout_session
+
+
+def _sync_conflict(workout_session, token, claim):
+    """Why the page holding `token` may no longer write to the session, or None.
+
+    A page owns the session it created, or one it claims when it resumes it
+    (claim: true, which restarts the seq count for the new page). Once the
+    session is finished, saved by a form post, or claimed by another page,
+    the old page's queued writes are refused rather than merged."""
+    if workout_session.status != SESSION_STATUS_PAUSED or workout_session.finalized_token == token:
+        return "finished"
+    if claim and workout_session.client_token != token:
+        workout_session.client_token = token
+        workout_session.client_seq = 0
+    if workout_session.client_token != token:
+        return "superseded"
+    return None
+
+
+def _sync_target(profile, data):
+    """(session, error response) for a per-set or batch call's JSON body."""
+    token = str(data.get("client_token") or "")[:64]
+    try:
+        session_id = int(data.get("session_id") or 0)
+        int(data.get("planned_workout_id") or 0)
+    except (TypeError, ValueError):
+        return None, (jsonify({"error": "ids must be integers"}), 400)
+    if not token:
+        return None, (jsonify({"error": "client_token is required"}), 400)
+
+    workout_session = _session_for_set(profile, session_id, token, data)
+    if workout_session is None:
+        return None, (jsonify({"error": "session not found"}), 404)
+    conflict = _sync_conflict(workout_session, token, bool(data.get("claim")))
+    if conflict:
+        return None, (jsonify({
+            "error": "session changed elsewhere", "conflict": conflict,
+            "session": {"id": workout_session.id, "status": workout_session.status,
+                        "seq": workout_session.client_seq},
+        }), 409)
+    return workout_session, None
+
+
+@app.route("/api/workout/set", methods=["POST"])
+@csrf.exempt
 @login_required
-def history():
+def api_workout_set():
+    """Record, update or delete one set of an in-progress workout as it is
+    entered. JSON body: client_token, session_id (once known), seq,
+    exercise_name, set_number, and weight/reps/weight_b/reps_b/rpe/notes,
+    or deleted: true.
+
+    seq must grow with every call the page makes for a session; a call at or
+    below the highest seq already applied is acknowledged without being
+    applied again, so retries are safe. /workout/log and /workout/pause then
+    only reconcile what is left (see _sync_logged_sets)."""
     profile = get_profile()
     if not profile:
-        return redirect(url_for("setup"))
+        return jsonify({"error": "no profile"}), 401
 
-    sessions = (
+    data = request.get_json(silent=True) or {}
+    try:
+        seq, exercise_name, set_number = _parse_set_op(data)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    workout_session, error = _sync_target(profile, data)
+    if error:
+        db.session.rollback()
+        return error
+    if seq <= workout_session.client_seq:
+        db.session.commit()  # a claim may still have moved the session to this page
+        return jsonify({"ok": True, "applied": False, "session_id": workout_session.id,
+                        "seq": workout_session.client_seq})
+
+    _apply_set_op(workout_session, data, exercise_name, set_number)
+    workout_session.client_seq = seq
+    db.session.commit()
+    return jsonify({"ok": True, "applied": True, "session_id": workout_session.id, "seq": seq})
+
+
+@app.route("/api/workout/sync", methods=["POST"])
+@csrf.exempt
+@login_required
+def api_workout_sync():
+    """Apply a page's queued writes in one transaction — how the workout
+    page catches up after losing its connection.
+
+    JSON body: client_token, session_id (once known), planned_workout_id,
+    phase_name, date, claim, and sets: a list of /api/workout/set bodies in
+    seq order. An optional finish object is the Log Workout / Save & Pause
+    form queued offline: seq, status ("completed" or "paused"),
+    overall_feeling, session_notes, elapsed_seconds, superset_exercises,
+    notes_for_next_general, notes_for_next_workout, and sets, the full set
+    list the session is synced to.
+
+    Writes at or below the session's seq are skipped as already applied.
+    Either the rest all commit or, on 400/404/409, none do; 409 means the
+    session changed under the page (finished, or claimed by another page)
+    and returns its current state."""
+    profile = get_profile()
+    if not profile:
+        return jsonify({"error": "no profile"}), 401
+
+    data = request.get_json(silent=True) or {}
+    if not isinstance(data, dict):
+        return jsonify({"error": "body must be a JSON object"}), 400
+    set_ops = data.get("sets") or []
+    finish = data.get("finish")
+    try:
+        if not isinstance(set_ops, list) or not (finish is None or isinstance(finish, dict)):
+            raise ValueError("sets must be a list and finish an object")
+        parsed = [(op, *_parse_set_op(op)) for op in set_ops]
+        if finish is not None:
+            finish_sets = finish.get("sets") or []
+            superset_exercises = finish.get("superset_exercises") or []
+            if not isinstance(finish_sets, list) or not all(isinstance(s, dict) for s in finish_sets):
+                raise ValueError("finish.sets must be a list of objects")
+            if not isinstance(superset_exercises, list):
+                raise ValueError("finish.superset_exercises must be a list")
+            finish_seq = int(finish.get("seq"))
+            elapsed_seconds = int(finish.get("elapsed_seconds") or 0)
+            overall_feeling = int(finish["overall_feeling"]) if finish.get("overall_feeling") else None
+    except (TypeError, ValueError) as e:
+        return jsonify({"error": str(e) or "malformed sync batch"}), 400
+    workout_session, error = _sync_target(profile, data)
+    if error:
+        db.session.rollback()
+        return error
+
+    applied = skipped = 0
+    for op, seq, exercise_name, set_number in parsed:
+        if seq <= workout_session.client_seq:
+            skipped += 1
+            continue
+        _apply_set_op(workout_session, op, exercise_name, set_number)
+        db.session.flush()  # later ops for the same set must find this one
+        workout_session.client_seq = seq
+        applied += 1
+
+    if finish is not None and finish_seq > workout_session.client_seq:
+        status = SESSION_STATUS_COMPLETED if finish.get("status") == SESSION_STATUS_COMPLETED else SESSION_STATUS_PAUSED
+        _set_session_fields(
+            workout_session, status,
+            overall_feeling=overall_feeling,
+            session_notes=str(finish.get("session_notes") or ""),
+            elapsed_seconds=elapsed_seconds,
+            superset_exercises=json.dumps([str(n) for n in superset_exercises]),
+            phase_name=data.get("phase_name") or None,
+        )
+        _sync_logged_sets(workout_session, _build_logged_sets(
+            workout_session.id, *_json_set_lists(finish_sets)))
+        workout_session.client_seq = finish_seq
+        if status == SESSION_STATUS_COMPLETED:
+            workout_session.finalized_token, workout_session.client_token = workout_session.client_token, None
+            _save_next_workout_notes(
+                profile.id,
+                workout_session.planned_workout.workout_name if workout_session.planned_workout else None,
+                str(finish.get("notes_for_next_general") or "").strip(),
+                str(finish.get("notes_for_next_workout") or "").strip(),
+            )
+            update_streak(profile)
+        else:
+            _complete_paused_sessions(profile.id, keep=workout_session)
+        applied += 1
+    elif finish is not None:
+        skipped += 1
+
+    db.session.commit()
+    return jsonify({"ok": True, "session_id": workout_session.id, "status": workout_session.status,
+                    "seq": workout_session.client_seq, "applied": applied, "skipped": skipped})
+
+
+HISTORY_PAGE_SIZE = 30
+
+
+def get_history_page(user_id, before=None, page_size=HISTORY_PAGE_SIZE):
+    """One page of a user's sessions, newest first, and the cursor for the next
+    page (None on the last). Keyset-paginated on (date, id) over
+    ix_workout_session_user_date, so any page costs the same however long
+    the history is. `before` is a cursor from a previous page ("<date>.<id>");
+    a missing or malformed cursor starts from the newest session."""
+    query = (
         WorkoutSession.query
-        .filter_by(user_id=profile.id)
-        .order_by(WorkoutSession.date.desc())
+        .options(db.joinedload(WorkoutSession.planned_workout))
+        .filter(WorkoutSession.user_id == user_id)
+    )
+    try:
+        before_date, before_id = before.split(".")
+        query = query.filter(
+            db.tuple_(WorkoutSession.date, WorkoutSession.id)
+            < (date.fromisoformat(before_date), int(before_id))
+        )
+    except (AttributeError, ValueError):
+        pass
+    sessions = (
+        query.order_by(WorkoutSession.date.desc(), WorkoutSession.id.desc())
+        .limit(page_size + 1)
         .all()
     )
-    return render_template("history.html", sessions=sessions)
+    if len(sessions) <= page_size:
+        return sessions, None
+    sessions = sessions[:page_size]
+    last = sessions[-1]
+    return sessions, f"{last.date.isoformat()}.{last.id}"
+
+
+@app.route("/history")
+@login_required
+def history():
+    profile = get_profile()
+    if not profile:
+        return redirect(url_for("setup"))
+
+    sessions, next_cursor = get_history_page(profile.id, request.args.get("before"))
+    if request.args.get("partial"):
+        # "Load more" / infinite scroll: just the next page's rows
+        return jsonify({
+            "html": render_template("history_rows.html", sessions=sessions),
+            "next": url_for("history", before=next_cursor) if next_cursor else None,
+        })
+    return render_template("history.html", sessions=sessions, next_cursor=next_cursor)
 
 
 @app.route("/history/<int:session_id>/delete", methods=["POST"])
@@ -1551,6 +2045,19 @@ def session_detail(session_id):
     )
 
 
+@app.route("/search")
+@login_required
+def search():
+    profile = get_profile()
+    if not profile:
+        return redirect(url_for("setup"))
+
+    query = request.args.get("q", "").strip()
+    page = request.args.get("page", 1, type=int)
+    hits, has_more = search_index.search(profile.id, query, page) if query else ([], False)
+    return render_template("search.html", query=query, hits=hits, page=max(page, 1), has_more=has_more)
+
+
 @app.route("/review")
 @login_required
 def review():
@@ -1621,15 +2128,24 @@ def generate_review():
     from ai import generate_progress_review
     try:
         review_result = generate_progress_review(profile, sessions_data, plan_name=active_plan.name)
+        suggestions_json = json.dumps(review_result)
 
-        ai_review = AIReview(
-            user_id=profile.id,
-            review_text=review_result.get("overall_assessment", ""),
-            suggestions_json=json.dumps(review_result),
-            data_summary=json.dumps({"sessions_count": len(sessions_data)}),
+        # A re-submit with unchanged sessions gets the cached review back (ai_cache.py)
+        last_review = (
+            AIReview.query
+            .filter_by(user_id=profile.id)
+            .order_by(AIReview.created_at.desc())
+            .first()
         )
-        db.session.add(ai_review)
-        db.session.commit()
+        if last_review is None or last_review.suggestions_json != suggestions_json:
+            ai_review = AIReview(
+                user_id=profile.id,
+                review_text=review_result.get("overall_assessment", ""),
+                suggestions_json=suggestions_json,
+                data_summary=json.dumps({"sessions_count": len(sessions_data)}),
+            )
+            db.session.add(ai_review)
+            db.session.commit()
         flash("Progress review generated!", "success")
     except Exception as e:
         flash(f"Error generating review: {str(e)}", "error")
@@ -1700,31 +2216,7 @@ def plan_history():
     if not profile:
         return redirect(url_for("setup"))
 
-    past_plans = (
-        WorkoutPlan.query
-        .filter_by(user_id=profile.id, status="inactive")
-        .order_by(WorkoutPlan.created_at.desc())
-        .all()
-    )
-
-    # Attach parsed plan_json and workout counts for display
-    plans_data = []
-    for p in past_plans:
-        try:
-            pj = json.loads(p.plan_json or "{}")
-        except Exception:
-            pj = {}
-        session_count = WorkoutSession.query.filter(
-            WorkoutSession.user_id == profile.id,
-            WorkoutSession.planned_workout_id.in_([w.id for w in p.planned_workouts]),
-            WorkoutSession.status == SESSION_STATUS_COMPLETED,
-        ).count()
-        plans_data.append({
-            "plan": p,
-            "plan_json": pj,
-            "session_count": session_count,
-            "workouts": PlannedWorkout.query.filter_by(plan_id=p.id).order_by(PlannedWorkout.order_index).all(),
-        })
+    plans_data = get_plan_list(profile.id, ["inactive"])
 
     return render_template("plan_history.html", plans_data=plans_data)
 
@@ -1886,32 +2378,39 @@ def api_add_exercise(workout_id):
     return jsonify({"id": new_ex.id, "ok": True}), 201
 
 
+EXERCISE_SEARCH_LIMIT = 50
+EXERCISE_SEARCH_MAX_LIMIT = 200
+
+
 @app.route("/api/plan/exercise-library")
 @login_required
 def api_exercise_library():
+    """The exercise picker's list: library entries, then the user's own
+    history-only names. ?q= searches it (prefix matches first) and ?limit=
+    caps the result; with neither, the whole list. Served from
+    exercise_catalog's in-memory index, with an ETag for conditional GETs."""
     profile = get_profile()
     if not profile:
         return jsonify([]), 401
 
-    lib_entries = ExerciseLibrary.query.order_by(ExerciseLibrary.name).all()
-    lib_names = {e.name for e in lib_entries}
-
-    # Also include exercise names from user's own history not already in library
-    history_names = {
-        row[0] for row in
-        db.session.query(LoggedSet.exercise_name)
-        .join(WorkoutSession, LoggedSet.session_id == WorkoutSession.id)
-        .filter(WorkoutSession.user_id == profile.id)
-        .distinct()
-        .all()
-    } - lib_names
-
-    result = [{"id": e.id, "name": e.name, "muscle_group": e.muscle_group,
-               "equipment": e.equipment} for e in lib_entries]
-    result += [{"id": None, "name": n, "muscle_group": None, "equipment": None}
-               for n in sorted(history_names)]
-
-    return jsonify(result)
+    versions = exercise_catalog.versions(db.session, profile.id)
+    etag = exercise_catalog.etag(profile.id, versions)
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+    else:
+        index = exercise_catalog.index(db.session, profile.id, versions)
+        query = request.args.get("q", "").strip()
+        limit = request.args.get("limit", type=int)
+        if query or limit is not None:
+            limit = EXERCISE_SEARCH_LIMIT if limit is None else limit
+            limit = min(max(limit, 1), EXERCISE_SEARCH_MAX_LIMIT)
+            response = jsonify(index.search(query, limit))
+        else:
+            response = jsonify(index.entries)
+    response.set_etag(etag)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True  # revalidate with If-None-Match every time
+    return response
 
 
 @app.route("/settings")
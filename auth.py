@@ -3,9 +3,11 @@ from flask import Blueprint, render_template, request, redirect, url_for, flash,
 from flask_login import login_user, logout_user, login_required, current_user
 from models import (
     db, Account, UserProfile, WorkoutPlan, PlannedWorkout, PlannedExercise,
-    WorkoutSession, LoggedSet, AIReview, FitnessTest, TrainingPhase,
+    WorkoutSession, LoggedSet, AIReview, FitnessTest, TrainingPhase, PlanJob,
 )
 from extensions import bcrypt, oauth_client, login_manager, limiter
+from claim_gate import unclaimed_gate
+from identity_cache import load_identity
 
 auth = Blueprint("auth", __name__)
 
@@ -28,7 +30,7 @@ def _email_whitelisted(email: str) -> bool:
 
 @login_manager.user_loader
 def load_user(user_id):
-    return Account.query.get(int(user_id))
+    return load_identity(int(user_id))
 
 
 # ---------------------------------------------------------------------------
@@ -41,7 +43,7 @@ def login():
     if current_user.is_authenticated:
         return redirect(url_for("index"))
 
-    unclaimed = Account.query.filter_by(email_claimed=False).first()
+    unclaimed = unclaimed_gate.pending(db.session)
 
     if request.method == "POST":
         email = request.form.get("email", "").strip().lower()
@@ -105,7 +107,7 @@ def logout():
 
 @auth.route("/claim-account", methods=["GET", "POST"])
 def claim_account():
-    unclaimed = Account.query.filter_by(email_claimed=False).first()
+    unclaimed = unclaimed_gate.pending(db.session) and Account.query.filter_by(email_claimed=False).first()
     if not unclaimed:
         return redirect(url_for("index"))
 
@@ -126,6 +128,7 @@ def claim_account():
             unclaimed.email = email
             unclaimed.password_hash = bcrypt.generate_password_hash(password).decode("utf-8")
             unclaimed.email_claimed = True
+            unclaimed_gate.mark_claimed(db.session)
             db.session.commit()
             login_user(unclaimed)
             flash("Profile claimed! Welcome to FitLocal.", "success")
@@ -202,7 +205,7 @@ def google_callback():
 
     # --- Claim mode: link Google to the unclaimed legacy account ---
     if mode == "claim":
-        unclaimed = Account.query.filter_by(email_claimed=False).first()
+        unclaimed = unclaimed_gate.pending(db.session) and Account.query.filter_by(email_claimed=False).first()
         if unclaimed:
             conflict = Account.query.filter(
                 Account.email == email, Account.id != unclaimed.id
@@ -213,6 +216,7 @@ def google_callback():
             unclaimed.email = email
             unclaimed.google_id = google_id
             unclaimed.email_claimed = True
+            unclaimed_gate.mark_claimed(db.session)
             db.session.commit()
             login_user(unclaimed)
             flash("Profile claimed! Welcome to FitLocal.", "success")
@@ -277,6 +281,7 @@ def delete_account():
             WorkoutSession.query.filter_by(user_id=profile.id).delete()
             AIReview.query.filter_by(user_id=profile.id).delete()
             FitnessTest.query.filter_by(user_id=profile.id).delete()
+            PlanJob.query.filter_by(user_id=profile.id).delete()
             if planned_workout_ids:
                 PlannedExercise.query.filter(
                     PlannedExercise.planned_workout_id.in_(planned_workout_ids)
@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+"""Benchmark plan activation: statements sent and SQLite write-lock hold time.
+
+Seeds LIBRARY exercise-library entries, then activates a WORKOUTS x EXERCISES
+pending plan ROUNDS times with each implementation:
+
+    per-row   the original confirm_plan body: a lower(name) library lookup and
+              a flush per exercise/workout, all after the first write
+    bulk      activate_plan(): one library read, then one multi-row INSERT
+              per table
+
+The lock is held from the transaction's first write statement until COMMIT
+returns, which is what a concurrent gunicorn worker waits on.
+
+Usage:
+    python bench_plan_activation.py [exercises_per_workout]
+"""
+import json
+import os
+import sys
+import tempfile
+import time
+from datetime import date
+
+sys.path.insert(0, os.path.dirname(__file__))
+
+_tmpdir = tempfile.mkdtemp(prefix="fitlocal-bench-")
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(_tmpdir, 'bench.db')}"
+
+from sqlalchemy import event  # noqa: E402
+
+import summaries  # noqa: E402
+from app import app, activate_plan, _session_offset_for_workout  # noqa: E402
+from models import (  # noqa: E402
+    db, Account, UserProfile, WorkoutPlan, PlannedWorkout, PlannedExercise, TrainingPhase, ExerciseLibrary,
+)
+
+WORKOUTS = 3
+EXERCISES = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+LIBRARY = 500
+ROUNDS = 30
+
+
+def _plan_json():
+    return json.dumps({
+        "plan_name": "Bench Plan", "description": "", "days_per_week": WORKOUTS, "total_weeks": 12,
+        "phases": [
+            {"phase_name": f"Phase {i + 1}", "phase_type": "progressive",
+             "week_start": i * 4 + 1, "week_end": i * 4 + 4}
+            for i in range(3)
+        ],
+        "workouts": [
+            {"day": f"Day {w + 1}", "name": f"Workout {w + 1}", "exercises": [
+                {"name": f"Exercise {(w * EXERCISES + e) % LIBRARY}", "sets": 3, "reps": "8-10",
+                 "rest_seconds": 90, "notes": "", "type": "main", "form_cues": ""}
+                for e in range(EXERCISES)
+            ]}
+            for w in range(WORKOUTS)
+        ],
+    })
+
+
+def _seed():
+    account = Account(email="bench@fitlocal.local", email_claimed=True)
+    db.session.add(account)
+    db.session.flush()
+    profile = UserProfile(account_id=account.id, name="Bench", age=30, sex="male",
+                          fitness_level="intermediate", goals="strength")
+    db.session.add(profile)
+    db.session.execute(db.insert(ExerciseLibrary), [{"name": f"Exercise {i}"} for i in range(LIBRARY)])
+    db.session.commit()
+    return profile.id
+
+
+def per_row(profile_id, pending, start_workout_index=0):
+    """The pre-bulk confirm_plan body."""
+    pending_plan = json.loads(pending.plan_json)
+    plan_phases = pending_plan.get("phases", [])
+    offset = _session_offset_for_workout(start_workout_index, plan_phases, pending_plan.get("days_per_week", 3))
+    db.session.delete(pending)
+    WorkoutPlan.query.filter_by(status="active", user_id=profile_id).update({"status": "inactive"})
+    plan = WorkoutPlan(
+        user_id=profile_id, name=pending_plan["plan_name"], description=pending_plan.get("description", ""),
+        days_per_week=pending_plan.get("days_per_week", 3), plan_json=json.dumps(pending_plan),
+        status="active", total_weeks=pending_plan.get("total_weeks", 12), current_week=1,
+        start_date=date.today(), session_offset=offset, **summaries.plan_summary_columns(pending_plan),
+    )
+    db.session.add(plan)
+    db.session.flush()
+    for i, phase_data in enumerate(plan_phases):
+        db.session.add(TrainingPhase(
+            plan_id=plan.id, phase_name=phase_data["phase_name"],
+            phase_type=phase_data.get("phase_type", "progressive"), week_start=phase_data["week_start"],
+            week_end=phase_data["week_end"], description=phase_data.get("description", ""),
+            nutrition_guide=phase_data.get("nutrition_guide", ""), order_index=i,
+        ))
+    for i, workout_data in enumerate(pending_plan.get("workouts", [])):
+        pw = PlannedWorkout(plan_id=plan.id, day_of_week=workout_data["day"],
+                            workout_name=workout_data["name"], order_index=i)
+        db.session.add(pw)
+        db.session.flush()
+        for exercise_data in workout_data.get("exercises", []):
+            lib_entry = ExerciseLibrary.query.filter(
+                db.func.lower(ExerciseLibrary.name) == exercise_data["name"].lower()
+            ).first()
+            db.session.add(PlannedExercise(
+                planned_workout_id=pw.id, exercise_name=exercise_data["name"],
+                exercise_library_id=lib_entry.id if lib_entry else None,
+                sets_prescribed=exercise_data["sets"], reps_prescribed=str(exercise_data["reps"]),
+                rest_seconds=exercise_data.get("rest_seconds"), notes=exercise_data.get("notes", ""),
+                exercise_type=exercise_data.get("type", "main"), form_cues=exercise_data.get("form_cues", ""),
+            ))
+    return plan.id
+
+
+def _run(fn, profile_id):
+    """Per activation: (statements, lock hold ms, total ms), averaged over ROUNDS."""
+    stats = {"statements": 0, "first_write": None}
+
+    def _record(conn, cursor, statement, parameters, context, executemany):
+        stats["statements"] += 1
+        if stats["first_write"] is None and not statement.lstrip().upper().startswith("SELECT"):
+            stats["first_write"] = time.perf_counter()
+
+    totals = [0, 0.0, 0.0]
+    event.listen(db.engine, "before_cursor_execute", _record)
+    try:
+        for _ in range(ROUNDS):
+            pending = WorkoutPlan(user_id=profile_id, name="Bench Plan", status="pending", plan_json=_plan_json())
+            db.session.add(pending)
+            db.session.commit()
+            db.session.expire_all()
+            stats.update(statements=0, first_write=None)
+            start = time.perf_counter()
+            fn(profile_id, pending)
+            db.session.commit()
+            end = time.perf_counter()
+            totals[0] += stats["statements"]
+            totals[1] += (end - stats["first_write"]) * 1000
+            totals[2] += (end - start) * 1000
+    finally:
+        event.remove(db.engine, "before_cursor_execute", _record)
+    return [t / ROUNDS for t in totals]
+
+
+def main():
+    with app.app_context():
+        print(f"Activating a {WORKOUTS} x {EXERCISES} plan against a {LIBRARY}-entry library, {ROUNDS} rounds")
+        profile_id = _seed()
+        print(f"{'':>10}{'statements':>12}{'lock held':>14}{'total':>12}")
+        for name, fn in (("per-row", per_row), ("bulk", activate_plan)):
+            statements, hold_ms, total_ms = _run(fn, profile_id)
+            print(f"{name:>10}{statements:>12.0f}{hold_ms:>11.2f} ms{total_ms:>9.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
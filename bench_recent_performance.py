@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+"""Benchmark the workout page's recent-performance lookup.
+
+Seeds a fresh database with SESSIONS completed sessions (EXERCISES exercises
+x 3 sets each), then times, for one workout's worth of exercises:
+
+    per-exercise  the original loop: for each exercise, a latest-session join
+                  over workout_session/logged_set plus a last-3-sessions query,
+                  each followed by a lazy load of the session's sets
+    windowed      get_performance_history(): one ROW_NUMBER() query over the
+                  exercise_performance summary
+
+Usage:
+    python bench_recent_performance.py [sessions]
+"""
+import os
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+
+sys.path.insert(0, os.path.dirname(__file__))
+
+_tmpdir = tempfile.mkdtemp(prefix="fitlocal-bench-")
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(_tmpdir, 'bench.db')}"
+
+from app import app, get_performance_history  # noqa: E402
+from models import (  # noqa: E402
+    db, Account, UserProfile, WorkoutSession, LoggedSet, SESSION_STATUS_COMPLETED,
+)
+
+SESSIONS = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+EXERCISES = [
+    "Back Squat", "Bench Press", "Barbell Row", "Overhead Press", "Romanian Deadlift",
+    "Pull-Up", "Dumbbell Curl", "Tricep Pushdown", "Lateral Raise", "Plank",
+]
+PER_WORKOUT = 6
+ROUNDS = 50
+
+
+def _seed():
+    account = Account(email="bench@fitlocal.local", email_claimed=True)
+    db.session.add(account)
+    db.session.flush()
+    profile = UserProfile(account_id=account.id, name="Bench", age=30, sex="male",
+                          fitness_level="intermediate", goals="strength")
+    db.session.add(profile)
+    db.session.flush()
+    sessions = db.metadata.tables["workout_session"]
+    sets = db.metadata.tables["logged_set"]
+    start = date.today() - timedelta(days=SESSIONS)
+    conn = db.session.connection()
+    for i in range(SESSIONS):
+        sid = conn.execute(sessions.insert().values(
+            user_id=profile.id, date=start + timedelta(days=i), status=SESSION_STATUS_COMPLETED,
+        )).inserted_primary_key[0]
+        # Each session trains a rotating six of the ten exercises
+        names = [EXERCISES[(i + k) % len(EXERCISES)] for k in range(PER_WORKOUT)]
+        conn.execute(sets.insert(), [
+            {"session_id": sid, "exercise_name": name, "set_number": n,
+             "weight_lbs": 100.0 + i % 50, "reps_completed": 8, "rpe": 8.0}
+            for name in names for n in (1, 2, 3)
+        ])
+    db.session.commit()
+    return profile.id
+
+
+def _sets_dict(session, exercise_name):
+    return {
+        s.set_number: {
+            "weight": s.weight_lbs, "reps": s.reps_completed, "weight_b": s.weight_b,
+            "reps_b": s.reps_b, "rpe": s.rpe, "notes": s.notes or "",
+        }
+        for s in session.logged_sets if s.exercise_name == exercise_name
+    }
+
+
+def per_exercise(user_id, names, limit=3):
+    """The pre-summary implementation: two queries (plus lazy loads) per exercise."""
+    last_perf, recent_perf = {}, {}
+    for name in names:
+        last = (
+            WorkoutSession.query.join(LoggedSet)
+            .filter(WorkoutSession.user_id == user_id, LoggedSet.exercise_name == name,
+                    WorkoutSession.status == SESSION_STATUS_COMPLETED)
+            .order_by(WorkoutSession.date.desc(), WorkoutSession.id.desc())
+            .first()
+        )
+        if last:
+            last_perf[name] = {"date": last.date, "sets": _sets_dict(last, name)}
+        recent = (
+            WorkoutSession.query
+            .filter(WorkoutSession.user_id == user_id,
+                    WorkoutSession.logged_sets.any(LoggedSet.exercise_name == name),
+                    WorkoutSession.status == SESSION_STATUS_COMPLETED)
+            .order_by(WorkoutSession.date.desc(), WorkoutSession.id.desc())
+            .limit(limit)
+            .all()
+        )
+        if recent:
+            recent_perf[name] = [{"date": s.date, "sets": _sets_dict(s, name)} for s in recent]
+    return recent_perf
+
+
+def windowed(user_id, names, limit=3):
+    return get_performance_history(user_id, names, limit=limit)
+
+
+def _time(fn, user_id, names):
+    fn(user_id, names)  # warm caches
+    db.session.expire_all()
+    start = time.perf_counter()
+    for _ in range(ROUNDS):
+        result = fn(user_id, names)
+        db.session.expire_all()
+    return (time.perf_counter() - start) / ROUNDS * 1000, result
+
+
+def main():
+    with app.app_context():
+        print(f"Seeding {SESSIONS} sessions x {PER_WORKOUT} exercises x 3 sets ...")
+        user_id = _seed()
+        names = EXERCISES[:PER_WORKOUT]
+        old_ms, old = _time(per_exercise, user_id, names)
+        new_ms, new = _time(windowed, user_id, names)
+        print(f"{'per-exercise':>14}: {old_ms:8.2f} ms per workout page")
+        print(f"{'windowed':>14}: {new_ms:8.2f} ms per workout page  ({old_ms / new_ms:.1f}x)")
+        print(f"Results identical: {old == new}")
+
+
+if __name__ == "__main__":
+    main()
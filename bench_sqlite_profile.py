@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+"""Benchmark SQLite read/write throughput under each engine profile.
+
+Mimics gunicorn's 2 workers x 2 threads: PROCESSES processes, each with
+THREADS threads, hammer one fresh database file for DURATION seconds. Writer
+threads log a session with ten sets per transaction (like /workout/log);
+reader threads run the dashboard's recent-session query.
+
+Usage:
+    python bench_sqlite_profile.py [seconds]
+"""
+import os
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date
+
+sys.path.insert(0, os.path.dirname(__file__))
+
+import sqlalchemy as sa  # noqa: E402
+from sqlalchemy.exc import OperationalError  # noqa: E402
+
+import sqlite_profile  # noqa: E402
+from models import db  # noqa: E402
+
+PROCESSES = 2
+THREADS = 2
+
+
+def _engine(path, profile):
+    uri = f"sqlite:///{path}"
+    engine = sa.create_engine(uri, **sqlite_profile.engine_options(profile, uri))
+    sqlite_profile.install_pragmas(engine, profile)
+    return engine
+
+
+def _writer(engine, deadline, counts):
+    sets = db.metadata.tables["logged_set"]
+    sessions = db.metadata.tables["workout_session"]
+    while time.perf_counter() < deadline:
+        try:
+            with engine.begin() as conn:
+                sid = conn.execute(sessions.insert().values(
+                    user_id=1, date=date.today(), status="completed",
+                )).inserted_primary_key[0]
+                conn.execute(sets.insert(), [
+                    {"session_id": sid, "exercise_name": "Bench Press", "set_number": n,
+                     "weight_lbs": 135.0, "reps_completed": 10}
+                    for n in range(1, 11)
+                ])
+            counts["writes"] += 1
+        except OperationalError:
+            counts["locked"] += 1
+
+
+def _reader(engine, deadline, counts):
+    query = sa.text(
+        "SELECT id, date FROM workout_session WHERE user_id = 1 AND status = 'completed' "
+        "ORDER BY date DESC, id DESC LIMIT 20"
+    )
+    while time.perf_counter() < deadline:
+        try:
+            with engine.connect() as conn:
+                conn.execute(query).fetchall()
+            counts["reads"] += 1
+        except OperationalError:
+            counts["locked"] += 1
+
+
+def _worker(path, profile, duration):
+    engine = _engine(path, profile)
+    deadline = time.perf_counter() + duration
+    counts = {"writes": 0, "reads": 0, "locked": 0}
+    threads = [
+        threading.Thread(target=_writer if i % 2 == 0 else _reader, args=(engine, deadline, counts))
+        for i in range(THREADS)
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    engine.dispose()
+    return counts
+
+
+def run(profile, duration):
+    fd, path = tempfile.mkstemp(suffix=f"_bench_{profile}.db")
+    os.close(fd)
+    setup = _engine(path, profile)
+    db.metadata.create_all(setup)
+    setup.dispose()
+    try:
+        with ProcessPoolExecutor(PROCESSES) as pool:
+            results = list(pool.map(_worker, [path] * PROCESSES, [profile] * PROCESSES, [duration] * PROCESSES))
+    finally:
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(path + suffix):
+                os.unlink(path + suffix)
+    return {k: sum(r[k] for r in results) for k in ("writes", "reads", "locked")}
+
+
+if __name__ == "__main__":
+    duration = float(sys.argv[1]) if len(sys.argv) > 1 else 5.0
+    print(f"{PROCESSES} processes x {THREADS} threads, {duration:.0f}s per profile")
+    print(f"{'profile':<12}{'writes/s':>10}{'reads/s':>10}{'locked':>8}")
+    for name in ("default", "production"):
+        r = run(name, duration)
+        print(f"{name:<12}{r['writes'] / duration:>10.0f}{r['reads'] / duration:>10.0f}{r['locked']:>8}")
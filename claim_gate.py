@@ -0,0 +1,65 @@
+"""
+Process-wide answer to "is the legacy migrated account still unclaimed?".
+
+Only migration 4 creates an unclaimed account, and only at boot; once its
+owner claims it the answer is "no" for the life of the database. So the gate
+is computed once per process at boot (refresh()) instead of querying the
+account table before every request.
+
+Claims can happen in another gunicorn worker, so claiming also bumps a
+generation marker kept in the SQLite file header (PRAGMA user_version). While
+the gate is open, pending() only compares that marker with the one it last
+saw and re-queries the account table when it has moved. Once pending()
+returns False it stays False; app.py then drops its before_request hook, so
+a claimed database pays nothing per request.
+"""
+import threading
+
+from models import Account
+
+
+def read_generation(conn):
+    """The claim generation marker stored in the database header."""
+    return conn.exec_driver_sql("PRAGMA user_version").scalar() or 0
+
+
+class ClaimGate:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._open = True
+        self._generation = None
+
+    @property
+    def is_open(self):
+        return self._open
+
+    def refresh(self, session):
+        """Re-query the account table; returns True if an account is unclaimed."""
+        conn = session.connection()
+        generation = read_generation(conn)
+        unclaimed = session.query(Account.id).filter_by(email_claimed=False).first() is not None
+        with self._lock:
+            self._open = unclaimed
+            self._generation = generation
+        return unclaimed
+
+    def pending(self, session):
+        """True while an unclaimed account may exist. Free once closed; while
+        open, one PRAGMA read unless another process has claimed since."""
+        if not self._open:
+            return False
+        if read_generation(session.connection()) == self._generation:
+            return True
+        return self.refresh(session)
+
+    def mark_claimed(self, session):
+        """Bump the generation marker inside the claiming transaction, so every
+        process re-checks the account table on its next request."""
+        session.flush()  # holds SQLite's write lock from here to commit
+        conn = session.connection()
+        conn.exec_driver_sql(f"PRAGMA user_version = {read_generation(conn) + 1}")
+        with self._lock:
+            self._generation = None
+
+
+unclaimed_gate = ClaimGate()
@@ -0,0 +1,147 @@
+"""
+Process-wide index of the plan editor's exercise picker list.
+
+The picker offers the whole exercise library plus any names from the user's
+own logged sets that the library lacks. Building that list takes a full read
+of the library and a DISTINCT scan of the user's logged_set names, so each
+process keeps it built instead, keyed by two change counters from the
+exercise_name_version table: scope 0 for the library and one scope per
+user. summaries.py triggers bump them on every library write and every
+change to a user's set names, from any process or script, so checking
+freshness is one primary-key read. The API route also turns the counters
+into an ETag, so an unchanged list costs the browser a 304.
+
+search() serves the picker's ?q= typing from the in-memory index: names
+whose key starts with the query first (in name order), then names with a
+word starting with it, then any other substring match. Keys are
+models.exercise_name_key(), so "Pull-Up", "pull_up" and "pull up" behave
+alike.
+"""
+import threading
+from bisect import bisect_left
+from collections import OrderedDict
+
+from models import (
+    db, ExerciseLibrary, ExerciseNameVersion, LoggedSet, WorkoutSession,
+    EXERCISE_NAMES_LIBRARY_SCOPE, exercise_name_key,
+)
+
+DEFAULT_MAX_USERS = 256
+
+
+class CatalogIndex:
+    """One user's picker list — library entries by name, then history-only
+    names — with its search keys. Treat entries as read-only; they are
+    shared between requests."""
+
+    def __init__(self, entries):
+        self.entries = tuple(entries)
+        self._keys = tuple(exercise_name_key(e["name"]) for e in self.entries)
+        self._by_key = sorted((key, i) for i, key in enumerate(self._keys))
+
+    def __len__(self):
+        return len(self.entries)
+
+    def search(self, query, limit):
+        """Up to `limit` entries matching `query`, best matches first."""
+        q = exercise_name_key(query)
+        if not q:
+            return list(self.entries[:limit])
+        matched = []
+        for key, i in self._by_key[bisect_left(self._by_key, (q,)):]:
+            if not key.startswith(q) or len(matched) >= limit:
+                break
+            matched.append(i)
+        if len(matched) < limit:
+            seen = set(matched)
+            words = []
+            others = []
+            for i, key in enumerate(self._keys):
+                if i in seen:
+                    continue
+                if " " + q in " " + key:
+                    words.append(i)
+                elif q in key:
+                    others.append(i)
+            matched += (words + others)[:limit - len(matched)]
+        return [self.entries[i] for i in matched]
+
+
+class ExerciseCatalog:
+    def __init__(self, max_users=DEFAULT_MAX_USERS):
+        self.max_users = max_users
+        self._library = (None, ())  # (library version, entries)
+        self._users = OrderedDict()  # user_id -> ((library version, user version), CatalogIndex)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def versions(self, session, user_id):
+        """(library version, user version) — one primary-key read."""
+        found = dict(session.execute(
+            db.select(ExerciseNameVersion.scope, ExerciseNameVersion.version)
+            .where(ExerciseNameVersion.scope.in_((EXERCISE_NAMES_LIBRARY_SCOPE, user_id)))
+        ).all())
+        return found.get(EXERCISE_NAMES_LIBRARY_SCOPE, 0), found.get(user_id, 0)
+
+    @staticmethod
+    def etag(user_id, versions):
+        return f"exercises-{user_id}-{versions[0]}-{versions[1]}"
+
+    def index(self, session, user_id, versions=None):
+        """The CatalogIndex for `user_id`, rebuilt only when a version moved.
+
+        Versions are read before the rows, so a write landing in between
+        leaves rows newer than their versions: the next call rebuilds
+        rather than serving stale names."""
+        if versions is None:
+            versions = self.versions(session, user_id)
+        with self._lock:
+            entry = self._users.get(user_id)
+            if entry is not None and entry[0] == versions:
+                self._users.move_to_end(user_id)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            library_version, library = self._library
+
+        if library_version != versions[0]:
+            library = tuple(
+                {"id": lib_id, "name": name, "muscle_group": muscle_group, "equipment": equipment}
+                for lib_id, name, muscle_group, equipment in session.execute(
+                    db.select(ExerciseLibrary.id, ExerciseLibrary.name,
+                              ExerciseLibrary.muscle_group, ExerciseLibrary.equipment)
+                    .order_by(ExerciseLibrary.name)
+                )
+            )
+        library_names = {e["name"] for e in library}
+        history_names = set(session.execute(
+            db.select(LoggedSet.exercise_name).distinct()
+            .join(WorkoutSession, LoggedSet.session_id == WorkoutSession.id)
+            .where(WorkoutSession.user_id == user_id)
+        ).scalars()) - library_names
+        index = CatalogIndex(
+            library + tuple({"id": None, "name": n, "muscle_group": None, "equipment": None}
+                            for n in sorted(history_names))
+        )
+
+        with self._lock:
+            self._library = (versions[0], library)
+            self._users[user_id] = (versions, index)
+            self._users.move_to_end(user_id)
+            while len(self._users) > self.max_users:
+                self._users.popitem(last=False)
+        return index
+
+    def clear(self):
+        with self._lock:
+            self._library = (None, ())
+            self._users.clear()
+            self.hits = self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            return {"users": len(self._users), "hits": self.hits, "misses": self.misses}
+
+
+exercise_catalog = ExerciseCatalog()
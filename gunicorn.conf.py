@@ -15,3 +15,10 @@ loglevel = "info"
 limit_request_line = 4096
 limit_request_fields = 100
 limit_request_field_size = 8190
+
+
+def on_starting(server):
+    """Apply pending schema migrations once, in the master, before any worker
+    forks — workers then skip straight past them at import."""
+    from migrate import migrate_app
+    migrate_app()
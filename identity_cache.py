@@ -0,0 +1,178 @@
+"""
+Identity loading for Flask-Login: the Account and its UserProfile together.
+
+Every authenticated page needs the account (Flask-Login's user_loader) and
+then the profile (app.get_profile). load_identity() fetches both in one
+joined query and wires them together, so current_user.profile is already
+loaded; Flask-Login keeps the account for the rest of the request.
+
+Optionally each worker also keeps a short-TTL LRU of the loaded column
+values (IDENTITY_CACHE_TTL seconds; 0, the default, disables it). A hit
+re-attaches the account and profile to the request's session without a
+query. Flushes and bulk writes that touch an account or profile evict it
+in this worker (profile edits, streak updates, password changes, claims,
+account deletion); other workers see the change once their entry expires,
+which is why the TTL should stay short.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import make_transient_to_detached
+from sqlalchemy.orm.util import identity_key
+from sqlalchemy.orm.attributes import set_committed_value
+
+from models import db, Account, UserProfile
+
+DEFAULT_MAX_ENTRIES = 1024
+
+
+def _columns(obj):
+    """Plain copy of a loaded instance's column values."""
+    return {attr.key: getattr(obj, attr.key) for attr in inspect(obj).mapper.column_attrs}
+
+
+def _attach(session, model, columns):
+    """A session-attached instance rebuilt from _columns(), without a query."""
+    obj = model(**columns)
+    make_transient_to_detached(obj)  # resets history, as if freshly loaded
+    return session.merge(obj, load=False)
+
+
+class IdentityCache:
+    def __init__(self, ttl=0, max_entries=DEFAULT_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # account_id -> (expires_at, account_columns, profile_columns)
+        self._lock = threading.Lock()
+        self._version = 0  # bumped by every eviction, so a racing load can't re-cache stale rows
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, account_id):
+        if self.ttl <= 0:
+            return None
+        with self._lock:
+            entry = self._entries.get(account_id)
+            if entry is not None and entry[0] > time.monotonic():
+                self._entries.move_to_end(account_id)
+                self.hits += 1
+                return entry[1], entry[2]
+            if entry is not None:
+                del self._entries[account_id]
+            self.misses += 1
+            return None
+
+    def version(self):
+        with self._lock:
+            return self._version
+
+    def put(self, account_id, account_columns, profile_columns, version):
+        """Cache a load that started at `version`; dropped if anything was
+        evicted since."""
+        if self.ttl <= 0:
+            return
+        with self._lock:
+            if version != self._version:
+                return
+            self._entries[account_id] = (time.monotonic() + self.ttl, account_columns, profile_columns)
+            self._entries.move_to_end(account_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def forget(self, account_id):
+        with self._lock:
+            self._entries.pop(account_id, None)
+            self._version += 1
+
+    def forget_all(self):
+        with self._lock:
+            self._entries.clear()
+            self._version += 1
+
+    def configure(self, ttl, max_entries=None):
+        with self._lock:
+            self.ttl = ttl
+            if max_entries is not None:
+                self.max_entries = max_entries
+            self._entries.clear()
+            self._version += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._version += 1
+            self.hits = self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+
+identities = IdentityCache()
+
+
+def load_identity(account_id, session=None):
+    """The Account for `account_id` with .profile already loaded, or None."""
+    session = session or db.session
+    cached = identities.get(account_id)
+    if cached is not None:
+        account = _attach(session, Account, cached[0])
+        profile = _attach(session, UserProfile, cached[1]) if cached[1] is not None else None
+    else:
+        version = identities.version()
+        row = session.execute(
+            db.select(Account, UserProfile)
+            .outerjoin(UserProfile, UserProfile.account_id == Account.id)
+            .where(Account.id == account_id)
+            .order_by(UserProfile.id)
+            .limit(1)
+        ).first()
+        if row is None:
+            return None
+        account, profile = row
+        identities.put(account_id, _columns(account),
+                       _columns(profile) if profile is not None else None, version)
+    set_committed_value(account, "profile", profile)
+    if profile is not None:
+        set_committed_value(profile, "account", account)
+    return account
+
+
+@event.listens_for(db.session, "after_flush")
+def _forget_flushed_identities(session, flush_context):
+    for obj in (*session.new, *session.dirty, *session.deleted):
+        if isinstance(obj, Account):
+            identities.forget(obj.id)
+        elif isinstance(obj, UserProfile) and obj.account_id is not None:
+            identities.forget(obj.account_id)
+    # load_identity() fixed account.profile at load time; a profile created
+    # or deleted since (the setup flow) must show through it before the commit
+    for obj in session.new:
+        _relink_profile(session, obj, obj)
+    for obj in session.deleted:
+        _relink_profile(session, obj, None)
+
+
+def _relink_profile(session, obj, profile):
+    if isinstance(obj, UserProfile) and obj.account_id is not None:
+        account = session.identity_map.get(identity_key(Account, obj.account_id))
+        if account is not None:
+            set_committed_value(account, "profile", profile)
+
+
+@event.listens_for(db.session, "do_orm_execute")
+def _forget_after_bulk_write(orm_execute_state):
+    # query.update()/delete() on accounts or profiles bypass the flush
+    if not orm_execute_state.is_select and any(
+        mapper.class_ in (Account, UserProfile) for mapper in orm_execute_state.all_mappers
+    ):
+        identities.forget_all()
@@ -1,198 +1,349 @@
 """
-One-time migration script for FitLocal.
+Versioned schema migrations for FitLocal.
 
-Adds new columns to existing tables and creates new tables.
-Since FitLocal is in early development, the simplest approach is to
-delete the database and let it recreate. But if you want to preserve
-existing data, run this script first.
+Each migration is registered with @migration(version, description) and runs
+at most once per database, in version order. Applied versions are recorded in
+the schema_version table, so once a database is current, bringing it up to
+date costs a single version check.
+
+Under gunicorn the on_starting hook (gunicorn.conf.py) runs this once in the
+master before any worker forks. app.py also calls migrate() at import time so
+`python app.py` and the CLI scripts work against a fresh database; a process
+that has already migrated an engine skips even the version check.
+
+Migrations must be idempotent: a fresh database gets every table from
+db.metadata.create_all() in migration 1, and the later column/index
+migrations then find nothing to do.
 
 Usage:
     python migrate.py
 """
-import sqlite3
-import os
-import sys
-
-DB_PATH = os.path.join(os.path.dirname(__file__), "instance", "fitlocal.db")
+import json
+
+from sqlalchemy.exc import OperationalError
+
+from models import (
+    db, Account, ExercisePerformance, PlanProgress, ExerciseNameVersion, PlanJob, AIResponse, AICacheCounter, AICall,
+    exercise_name_key,
+)
+import search_index
+import summaries
+
+MIGRATIONS = []
+
+# Engine URLs this process has already brought up to date
+_migrated = set()
+
+
+def migration(version, description):
+    """Register fn(conn) as schema migration `version`."""
+    def register(fn):
+        if any(v == version for v, _, _ in MIGRATIONS):
+            raise ValueError(f"Duplicate migration version {version}")
+        MIGRATIONS.append((version, description, fn))
+        MIGRATIONS.sort(key=lambda m: m[0])
+        return fn
+    return register
+
+
+def latest_version():
+    return MIGRATIONS[-1][0] if MIGRATIONS else 0
+
+
+def current_version(conn):
+    """Return the highest applied migration version, or 0 for an unversioned database."""
+    try:
+        return conn.exec_driver_sql("SELECT max(version) FROM schema_version").scalar() or 0
+    except OperationalError:
+        conn.rollback()
+        return 0
+
+
+def migrate(engine):
+    """Apply pending migrations to `engine`; returns the list of versions applied."""
+    key = str(engine.url)
+    if key in _migrated:
+        return []
+
+    target = latest_version()
+    with engine.connect() as conn:
+        if current_version(conn) >= target:
+            _migrated.add(key)
+            return []
+        conn.rollback()
+
+        # Take SQLite's write lock before re-reading the version: concurrent
+        # processes (workers, CLI scripts) queue up here and find the work done.
+        conn.exec_driver_sql("BEGIN IMMEDIATE")
+        conn.exec_driver_sql("""
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version INTEGER PRIMARY KEY,
+                description TEXT NOT NULL,
+                applied_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        version = current_version(conn)
+        applied = []
+        for v, description, fn in MIGRATIONS:
+            if v <= version:
+                continue
+            print(f"Applying migration {v}: {description}")
+            fn(conn)
+            conn.exec_driver_sql(
+                "INSERT INTO schema_version (version, description) VALUES (?, ?)",
+                (v, description),
+            )
+            applied.append(v)
+        conn.commit()
 
+    _migrated.add(key)
+    return applied
 
-def migrate():
-    if not os.path.exists(DB_PATH):
-        return  # Fresh install: db.create_all() in app.py handles table creation
 
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
+def migrate_app():
+    """Migrate the database configured for the Flask app, then drop the
+    engine's pooled connections so none are inherited across a fork."""
+    from app import app
+    with app.app_context():
+        applied = migrate(db.engine)
+        db.engine.dispose()
+    return applied
 
-    # Helper to check if a column exists
-    def column_exists(table, column):
-        cursor.execute(f"PRAGMA table_info({table})")
-        columns = [row[1] for row in cursor.fetchall()]
-        return column in columns
 
-    # Helper to check if a table exists
-    def table_exists(table):
-        cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?", (table,))
-        return cursor.fetchone() is not None
+# ---------------------------------------------------------------------------
+# Helpers
+# ---------------------------------------------------------------------------
 
-    print("Running FitLocal migration...")
+def _table_exists(conn, table):
+    return conn.exec_driver_sql(
+        "SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", (table,)
+    ).first() is not None
 
-    # --- UserProfile new columns ---
-    if not column_exists("user_profile", "current_streak"):
-        cursor.execute("ALTER TABLE user_profile ADD COLUMN current_streak INTEGER DEFAULT 0")
-        print("  Added user_profile.current_streak")
 
-    if not column_exists("user_profile", "longest_streak"):
-        cursor.execute("ALTER TABLE user_profile ADD COLUMN longest_streak INTEGER DEFAULT 0")
-        print("  Added user_profile.longest_streak")
+def _column_exists(conn, table, column):
+    return any(row[1] == column for row in conn.exec_driver_sql(f"PRAGMA table_info({table})"))
 
-    if not column_exists("user_profile", "last_workout_date"):
-        cursor.execute("ALTER TABLE user_profile ADD COLUMN last_workout_date DATE")
-        print("  Added user_profile.last_workout_date")
 
-    # --- WorkoutPlan new columns ---
-    if not column_exists("workout_plan", "total_weeks"):
-        cursor.execute("ALTER TABLE workout_plan ADD COLUMN total_weeks INTEGER DEFAULT 12")
-        print("  Added workout_plan.total_weeks")
+def _add_column(conn, table, column, ddl):
+    """ALTER TABLE ... ADD COLUMN unless the column already exists; returns True if added."""
+    if not _table_exists(conn, table) or _column_exists(conn, table, column):
+        return False
+    conn.exec_driver_sql(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}")
+    print(f"  Added {table}.{column}")
+    return True
 
-    if not column_exists("workout_plan", "current_week"):
-        cursor.execute("ALTER TABLE workout_plan ADD COLUMN current_week INTEGER DEFAULT 1")
-        print("  Added workout_plan.current_week")
 
-    if not column_exists("workout_plan", "start_date"):
-        cursor.execute("ALTER TABLE workout_plan ADD COLUMN start_date DATE")
-        print("  Added workout_plan.start_date")
+def _create_indexes(conn, table):
+    """Create `table`'s model indexes that are missing, skipping any whose
+    columns a later migration has yet to add."""
+    for index in db.metadata.tables[table].indexes:
+        if all(_column_exists(conn, table, column.name) for column in index.columns):
+            index.create(bind=conn, checkfirst=True)
 
-    if not column_exists("workout_plan", "session_offset"):
-        cursor.execute("ALTER TABLE workout_plan ADD COLUMN session_offset INTEGER NOT NULL DEFAULT 0")
-        print("  Added workout_plan.session_offset")
 
-    if not column_exists("workout_session", "superset_exercises"):
-        cursor.execute("ALTER TABLE workout_session ADD COLUMN superset_exercises TEXT")
-        print("  Added workout_session.superset_exercises")
+# ---------------------------------------------------------------------------
+# Migrations
+# ---------------------------------------------------------------------------
 
-    if not column_exists("workout_session", "phase_name"):
-        cursor.execute("ALTER TABLE workout_session ADD COLUMN phase_name VARCHAR(100)")
-        print("  Added workout_session.phase_name")
+@migration(1, "Create missing tables")
+def _create_tables(conn):
+    db.metadata.create_all(bind=conn)
 
-    if not column_exists("logged_set", "weight_b"):
-        cursor.execute("ALTER TABLE logged_set ADD COLUMN weight_b FLOAT")
-        print("  Added logged_set.weight_b")
 
-    if not column_exists("logged_set", "reps_b"):
-        cursor.execute("ALTER TABLE logged_set ADD COLUMN reps_b INTEGER")
-        print("  Added logged_set.reps_b")
+@migration(2, "Legacy column additions and backfills")
+def _legacy_columns(conn):
+    _add_column(conn, "user_profile", "account_id", "INTEGER REFERENCES account(id)")
+    _add_column(conn, "user_profile", "current_streak", "INTEGER DEFAULT 0")
+    _add_column(conn, "user_profile", "longest_streak", "INTEGER DEFAULT 0")
+    _add_column(conn, "user_profile", "last_workout_date", "DATE")
 
-    if not column_exists("workout_plan", "status"):
-        cursor.execute("ALTER TABLE workout_plan ADD COLUMN status VARCHAR(20) DEFAULT 'inactive'")
-        cursor.execute("""
+    _add_column(conn, "workout_plan", "total_weeks", "INTEGER DEFAULT 12")
+    _add_column(conn, "workout_plan", "current_week", "INTEGER DEFAULT 1")
+    _add_column(conn, "workout_plan", "start_date", "DATE")
+    _add_column(conn, "workout_plan", "session_offset", "INTEGER NOT NULL DEFAULT 0")
+    if _add_column(conn, "workout_plan", "status", "VARCHAR(20) DEFAULT 'inactive'"):
+        conn.exec_driver_sql("""
             UPDATE workout_plan SET status = CASE
                 WHEN is_active = 1 THEN 'active'
                 WHEN notes = 'pending' THEN 'pending'
                 ELSE 'inactive'
             END
         """)
-        print("  Added workout_plan.status and backfilled from is_active/notes")
-
-    # --- PlannedExercise new columns ---
-    if not column_exists("planned_exercise", "exercise_type"):
-        cursor.execute("ALTER TABLE planned_exercise ADD COLUMN exercise_type VARCHAR(20) DEFAULT 'main'")
-        print("  Added planned_exercise.exercise_type")
-
-    if not column_exists("planned_exercise", "form_cues"):
-        cursor.execute("ALTER TABLE planned_exercise ADD COLUMN form_cues TEXT")
-        print("  Added planned_exercise.form_cues")
-
-    # --- New tables ---
-    if not table_exists("fitness_test"):
-        cursor.execute("""
-            CREATE TABLE fitness_test (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL REFERENCES user_profile(id),
-                test_date DATE NOT NULL DEFAULT (date('now')),
-                pushups INTEGER,
-                pullups INTEGER,
-                wall_sit_seconds INTEGER,
-                toe_touch_inches FLOAT,
-                plank_seconds INTEGER,
-                vertical_jump_inches FLOAT,
-                notes TEXT
-            )
-        """)
-        print("  Created fitness_test table")
-
-    if not table_exists("training_phase"):
-        cursor.execute("""
-            CREATE TABLE training_phase (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                plan_id INTEGER NOT NULL REFERENCES workout_plan(id),
-                phase_name VARCHAR(100) NOT NULL,
-                phase_type VARCHAR(20) NOT NULL,
-                week_start INTEGER NOT NULL,
-                week_end INTEGER NOT NULL,
-                description TEXT,
-                nutrition_guide TEXT,
-                order_index INTEGER DEFAULT 0
-            )
-        """)
-        print("  Created training_phase table")
-
-    if not table_exists("exercise_library"):
-        cursor.execute("""
-            CREATE TABLE exercise_library (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                name VARCHAR(200) UNIQUE NOT NULL,
-                muscle_group VARCHAR(100),
-                equipment VARCHAR(100),
-                description TEXT,
-                form_cues TEXT,
-                difficulty VARCHAR(20)
-            )
-        """)
-        print("  Created exercise_library table")
-
-    if not table_exists("next_workout_note"):
-        cursor.execute("""
-            CREATE TABLE next_workout_note (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL REFERENCES user_profile(id),
-                workout_name VARCHAR(200),
-                note TEXT NOT NULL
-            )
-        """)
-        print("  Created next_workout_note table")
-
-    # --- Exercise library FK columns ---
-    if not column_exists("planned_exercise", "exercise_library_id"):
-        cursor.execute(
-            "ALTER TABLE planned_exercise ADD COLUMN exercise_library_id INTEGER REFERENCES exercise_library(id)"
+        print("  Backfilled workout_plan.status from is_active/notes")
+
+    _add_column(conn, "workout_session", "status", "VARCHAR(20) DEFAULT 'completed'")
+    _add_column(conn, "workout_session", "elapsed_seconds", "INTEGER DEFAULT 0")
+    _add_column(conn, "workout_session", "superset_exercises", "TEXT")
+    _add_column(conn, "workout_session", "phase_name", "VARCHAR(100)")
+
+    _add_column(conn, "planned_exercise", "exercise_type", "VARCHAR(20) DEFAULT 'main'")
+    _add_column(conn, "planned_exercise", "form_cues", "TEXT")
+    _add_column(conn, "planned_exercise", "order_index", "INTEGER DEFAULT 0")
+    _add_column(conn, "planned_exercise", "is_superset_default", "BOOLEAN DEFAULT 0")
+
+    _add_column(conn, "logged_set", "weight_b", "FLOAT")
+    _add_column(conn, "logged_set", "reps_b", "INTEGER")
+
+    # Exercise library FK columns; migration 9 backfills them by name_key
+    _add_column(conn, "planned_exercise", "exercise_library_id", "INTEGER REFERENCES exercise_library(id)")
+    _add_column(conn, "logged_set", "exercise_library_id", "INTEGER REFERENCES exercise_library(id)")
+
+
+@migration(3, "Secondary indexes for the hot query paths")
+def _hot_path_indexes(conn):
+    # create_all() only builds indexes for the tables it creates
+    for table in ("workout_session", "logged_set"):
+        _create_indexes(conn, table)
+
+
+@migration(4, "Link a legacy profile to a migrated account")
+def _link_legacy_profile(conn):
+    """Give the pre-auth UserProfile an unclaimed admin Account so its data
+    is not lost when auth is first enabled."""
+    if conn.exec_driver_sql("SELECT count(*) FROM account").scalar():
+        return
+    first = conn.exec_driver_sql(
+        "SELECT id, account_id FROM user_profile ORDER BY id LIMIT 1"
+    ).first()
+    if first is None or first.account_id is not None:
+        return
+    result = conn.execute(Account.__table__.insert().values(
+        email="local@fitlocal.local",
+        email_claimed=False,
+        is_admin=True,
+    ))
+    conn.exec_driver_sql(
+        "UPDATE user_profile SET account_id = ? WHERE id = ?",
+        (result.inserted_primary_key[0], first.id),
+    )
+    print("  Linked legacy profile to unclaimed account local@fitlocal.local")
+
+
+@migration(5, "Exercise performance summary table")
+def _exercise_performance(conn):
+    ExercisePerformance.__table__.create(bind=conn, checkfirst=True)
+    summaries.create_triggers(conn)
+    summaries.rebuild_exercise_performance(conn)
+
+
+@migration(6, "Plan progress counters")
+def _plan_progress(conn):
+    PlanProgress.__table__.create(bind=conn, checkfirst=True)
+    summaries.create_triggers(conn)
+    summaries.rebuild_plan_progress(conn)
+
+
+@migration(7, "Session aggregates and history index")
+def _session_aggregates(conn):
+    _add_column(conn, "workout_session", "set_count", "INTEGER NOT NULL DEFAULT 0")
+    _add_column(conn, "workout_session", "total_volume", "FLOAT NOT NULL DEFAULT 0")
+    _add_column(conn, "workout_session", "duration_seconds", "INTEGER")
+    _create_indexes(conn, "workout_session")
+    summaries.create_triggers(conn)
+    summaries.rebuild_session_aggregates(conn)
+
+
+@migration(8, "Plan summary columns")
+def _plan_summaries(conn):
+    _add_column(conn, "workout_plan", "phase_count", "INTEGER")
+    _add_column(conn, "workout_plan", "total_sessions", "INTEGER")
+    _add_column(conn, "workout_plan", "workout_names", "TEXT")
+    # One last pass over every plan_json; from here on confirm_plan fills them in
+    for plan_id, plan_json in conn.exec_driver_sql(
+        "SELECT id, plan_json FROM workout_plan WHERE status != 'pending' AND phase_count IS NULL"
+    ).fetchall():
+        try:
+            plan_data = json.loads(plan_json or "{}")
+        except ValueError:
+            plan_data = {}
+        if not isinstance(plan_data, dict):
+            plan_data = {}
+        columns = summaries.plan_summary_columns(plan_data)
+        conn.exec_driver_sql(
+            "UPDATE workout_plan SET phase_count = ?, total_sessions = ?, workout_names = ? WHERE id = ?",
+            (columns["phase_count"], columns["total_sessions"], columns["workout_names"], plan_id),
         )
-        print("  Added planned_exercise.exercise_library_id")
-        # Backfill FK where name matches
-        cursor.execute("""
-            UPDATE planned_exercise
-            SET exercise_library_id = (
-                SELECT id FROM exercise_library
-                WHERE lower(exercise_library.name) = lower(planned_exercise.exercise_name)
-            )
-        """)
-        print("  Backfilled planned_exercise.exercise_library_id where names match")
-
-    if not column_exists("logged_set", "exercise_library_id"):
-        cursor.execute("ALTER TABLE logged_set ADD COLUMN exercise_library_id INTEGER REFERENCES exercise_library(id)")
-        print("  Added logged_set.exercise_library_id")
-        cursor.execute("""
-            UPDATE logged_set
-            SET exercise_library_id = (
-                SELECT id FROM exercise_library
-                WHERE lower(exercise_library.name) = lower(logged_set.exercise_name)
-            )
-        """)
-        print("  Backfilled logged_set.exercise_library_id where names match")
 
-    conn.commit()
-    conn.close()
-    print("Migration complete!")
+
+@migration(9, "Normalized exercise library name keys")
+def _exercise_name_keys(conn):
+    # The same normalizer the app uses, callable from SQL on this connection
+    conn.connection.driver_connection.create_function(
+        "exercise_name_key", 1, exercise_name_key, deterministic=True
+    )
+    _add_column(conn, "exercise_library", "name_key", "VARCHAR(200)")
+    conn.exec_driver_sql("UPDATE exercise_library SET name_key = exercise_name_key(name) WHERE name_key IS NULL")
+    _create_indexes(conn, "exercise_library")
+
+    # Link unmatched rows with one join per table against the indexed keys
+    # (the oldest entry wins a shared key)
+    for table in ("planned_exercise", "logged_set"):
+        if not _table_exists(conn, table):
+            continue
+        linked = conn.exec_driver_sql(f"""
+            UPDATE {table}
+            SET exercise_library_id = lib.id
+            FROM (SELECT name_key, min(id) AS id FROM exercise_library GROUP BY name_key) AS lib
+            WHERE {table}.exercise_library_id IS NULL
+              AND lib.name_key = exercise_name_key({table}.exercise_name)
+        """).rowcount
+        if linked:
+            print(f"  Linked {linked} {table} rows to the exercise library by name_key")
+
+
+@migration(10, "Exercise picker version counters")
+def _exercise_name_versions(conn):
+    ExerciseNameVersion.__table__.create(bind=conn, checkfirst=True)
+    summaries.create_triggers(conn)
+
+
+@migration(11, "Full-text search index")
+def _search_index(conn):
+    search_index.create_search_index(conn)
+    search_index.rebuild_search_index(conn)
+
+
+@migration(12, "Per-set logging columns")
+def _per_set_logging(conn):
+    _add_column(conn, "workout_session", "client_token", "VARCHAR(64)")
+    _add_column(conn, "workout_session", "client_seq", "INTEGER NOT NULL DEFAULT 0")
+    _create_indexes(conn, "workout_session")
+
+
+@migration(13, "Plan generation jobs")
+def _plan_jobs(conn):
+    PlanJob.__table__.create(bind=conn, checkfirst=True)
+
+
+@migration(14, "Streamed plan job progress")
+def _plan_job_progress(conn):
+    _add_column(conn, "plan_job", "progress_json", "TEXT NOT NULL DEFAULT '[]'")
+
+
+@migration(15, "AI response cache")
+def _ai_response_cache(conn):
+    AIResponse.__table__.create(bind=conn, checkfirst=True)
+    AICacheCounter.__table__.create(bind=conn, checkfirst=True)
+
+
+@migration(16, "AI call token usage")
+def _ai_calls(conn):
+    AICall.__table__.create(bind=conn, checkfirst=True)
+
+
+@migration(17, "AI response claim ids")
+def _ai_response_claim_id(conn):
+    _add_column(conn, "ai_response", "claim_id", "VARCHAR(32)")
+
+
+@migration(18, "Form-saved workout page tokens")
+def _finalized_tokens(conn):
+    _add_column(conn, "workout_session", "finalized_token", "VARCHAR(64)")
+    _create_indexes(conn, "workout_session")
 
 
 if __name__ == "__main__":
-    migrate()
+    # Import through the module name so this shares the registry app.py uses
+    from migrate import migrate_app as _migrate_app
+    _migrate_app()
+    print(f"Schema is at version {latest_version()}.")
@@ -1,9 +1,26 @@
+import json
+import re
+import unicodedata
+
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import UserMixin
 from datetime import datetime, date, timezone
+from sqlalchemy import event
 
 db = SQLAlchemy()
 
+SESSION_STATUS_COMPLETED = 'completed'
+SESSION_STATUS_PAUSED = 'paused'
+
+PLAN_JOB_QUEUED = 'queued'
+PLAN_JOB_RUNNING = 'running'
+PLAN_JOB_SUCCEEDED = 'succeeded'
+PLAN_JOB_FAILED = 'failed'
+
+AI_RESPONSE_PENDING = 'pending'
+AI_RESPONSE_READY = 'ready'
+AI_RESPONSE_FAILED = 'failed'
+
 
 class Account(db.Model, UserMixin):
     __tablename__ = "account"
@@ -57,6 +74,10 @@ class WorkoutPlan(db.Model):
     current_week = db.Column(db.Integer, default=1)
     start_date = db.Column(db.Date, nullable=True)
     session_offset = db.Column(db.Integer, default=0)
+    # List-page summary of plan_json, extracted at activation (summaries.plan_summary_columns)
+    phase_count = db.Column(db.Integer)
+    total_sessions = db.Column(db.Integer)
+    workout_names = db.Column(db.Text)  # JSON list of workout names, in plan order
 
     planned_workouts = db.relationship("PlannedWorkout", backref="plan", cascade="all, delete-orphan")
     phases = db.relationship(
@@ -64,6 +85,10 @@ class WorkoutPlan(db.Model):
         order_by="TrainingPhase.order_index",
     )
 
+    @property
+    def workout_name_list(self):
+        return json.loads(self.workout_names) if self.workout_names else []
+
 
 class PlannedWorkout(db.Model):
     __tablename__ = "planned_workout"
@@ -96,6 +121,17 @@ class PlannedExercise(db.Model):
 
 class WorkoutSession(db.Model):
     __tablename__ = "workout_session"
+    __table_args__ = (
+        # Completed-session lookups: last/recent performance, calendar, dashboard stats
+        db.Index("ix_workout_session_user_status_date", "user_id", "status", "date", "id"),
+        # Plan position: per-phase counts over a plan's workouts
+        db.Index("ix_workout_session_user_workout_phase", "user_id", "planned_workout_id", "phase_name"),
+        # History: keyset pages on (date, id), newest first
+        db.Index("ix_workout_session_user_date", "user_id", "date", "id"),
+        # Per-set logging: the page's token finds the session its first set created
+        db.Index("ix_workout_session_client_token", "client_token", unique=True),
+        db.Index("ix_workout_session_finalized_token", "finalized_token", unique=True),
+    )
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey("user_profile.id"), nullable=False)
     planned_workout_id = db.Column(db.Integer, db.ForeignKey("planned_workout.id"), nullable=True)
@@ -108,6 +144,19 @@ class WorkoutSession(db.Model):
     elapsed_seconds = db.Column(db.Integer, default=0)
     superset_exercises = db.Column(db.Text, nullable=True)  # JSON list of exercise names
     phase_name = db.Column(db.String(100), nullable=True)
+    # Aggregates for the history list, kept current by triggers (summaries.py)
+    # whenever the session's sets or times change — never written directly.
+    set_count = db.Column(db.Integer, nullable=False, default=0)
+    total_volume = db.Column(db.Float, nullable=False, default=0)  # sum of weight x reps, both sides
+    duration_seconds = db.Column(db.Integer)  # end_time - start_time; null until both are set
+    # Per-set logging (POST /api/workout/set): the workout page's token, kept
+    # until a whole form is saved, and the highest client sequence number
+    # applied, so retried or reordered calls are ignored.
+    client_token = db.Column(db.String(64), nullable=True)
+    client_seq = db.Column(db.Integer, nullable=False, default=0)
+    # The token of the page whose form post saved the session: that page's
+    # sync calls still in its queue are refused rather than starting a new session
+    finalized_token = db.Column(db.String(64), nullable=True)
 
     logged_sets = db.relationship("LoggedSet", backref="session", cascade="all, delete-orphan")
     planned_workout = db.relationship("PlannedWorkout")
@@ -115,6 +164,10 @@ class WorkoutSession(db.Model):
 
 class LoggedSet(db.Model):
     __tablename__ = "logged_set"
+    __table_args__ = (
+        db.Index("ix_logged_set_session_id", "session_id"),
+        db.Index("ix_logged_set_exercise_session", "exercise_name", "session_id"),
+    )
     id = db.Column(db.Integer, primary_key=True)
     session_id = db.Column(db.Integer, db.ForeignKey("workout_session.id"), nullable=False)
     exercise_name = db.Column(db.String(200), nullable=False)
@@ -130,6 +183,51 @@ class LoggedSet(db.Model):
     exercise_library = db.relationship("ExerciseLibrary")
 
 
+class ExercisePerformance(db.Model):
+    """Per-(user, exercise, session) copy of a completed session's sets, so the
+    workout page's last/recent performance lookups are one indexed range read
+    instead of a workout_session/logged_set join per exercise. Rebuilt by
+    summaries.py whenever a session or its sets change — never written directly."""
+    __tablename__ = "exercise_performance"
+    __table_args__ = (
+        db.Index("ix_exercise_performance_recent", "user_id", "exercise_name", "date", "session_id"),
+    )
+    user_id = db.Column(db.Integer, db.ForeignKey("user_profile.id"), primary_key=True)
+    exercise_name = db.Column(db.String(200), primary_key=True)
+    session_id = db.Column(db.Integer, db.ForeignKey("workout_session.id"), primary_key=True)
+    date = db.Column(db.Date)
+    # {"<set_number>": [weight_lbs, reps_completed, weight_b, reps_b, rpe, notes], ...}
+    sets_json = db.Column(db.Text, nullable=False)
+
+
+class PlanProgress(db.Model):
+    """Completed-session counters per (plan, phase tag), so plan position is
+    resolved from a handful of rows instead of counting sessions. The last_*
+    columns describe the most recent completed session (by date, then id) in
+    that phase. Untagged sessions are counted under phase_name "". Rebuilt by
+    triggers (summaries.py) — never written directly."""
+    __tablename__ = "plan_progress"
+    plan_id = db.Column(db.Integer, db.ForeignKey("workout_plan.id"), primary_key=True)
+    phase_name = db.Column(db.String(100), primary_key=True)
+    completed_count = db.Column(db.Integer, nullable=False, default=0)
+    last_planned_workout_id = db.Column(db.Integer, db.ForeignKey("planned_workout.id"))
+    last_date = db.Column(db.Date)
+    last_session_id = db.Column(db.Integer)
+
+
+EXERCISE_NAMES_LIBRARY_SCOPE = 0
+
+
+class ExerciseNameVersion(db.Model):
+    """Change counters for the exercise picker's name lists: scope 0 is the
+    exercise library, any other scope is a user_profile.id whose logged_set
+    names it versions. Bumped by triggers (summaries.py) — never written
+    directly; a missing row is version 0."""
+    __tablename__ = "exercise_name_version"
+    scope = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+
 class AIReview(db.Model):
     __tablename__ = "ai_review"
     id = db.Column(db.Integer, primary_key=True)
@@ -140,6 +238,80 @@ class AIReview(db.Model):
     data_summary = db.Column(db.Text)
 
 
+class PlanJob(db.Model):
+    """A plan generation request, run in the background (see plan_jobs.py).
+    params_json holds the generate form's inputs; progress_json the current
+    attempt's streamed phases and workouts; a succeeded job's plan_id is the
+    pending WorkoutPlan it created."""
+    __tablename__ = "plan_job"
+    __table_args__ = (
+        db.Index("ix_plan_job_user_status", "user_id", "status"),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey("user_profile.id"), nullable=False)
+    status = db.Column(db.String(20), nullable=False, default=PLAN_JOB_QUEUED)
+    stage = db.Column(db.String(100))  # progress shown while running
+    # [[kind, data], ...]: the plan's parts as they streamed in (ai.PlanStreamParser events)
+    progress_json = db.Column(db.Text, nullable=False, default="[]")
+    params_json = db.Column(db.Text, nullable=False, default="{}")
+    plan_id = db.Column(db.Integer)  # not a foreign key: activation deletes the pending plan
+    error = db.Column(db.Text)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
+    started_at = db.Column(db.DateTime)
+    heartbeat_at = db.Column(db.DateTime)  # refreshed while running; a stale one means the worker died
+    finished_at = db.Column(db.DateTime)
+
+
+class AIResponse(db.Model):
+    """A cached model response (see ai_cache.py), keyed by the sha256 of the
+    request. A pending row is the single-flight lock: the worker that wrote
+    it is calling the model, claimed_at dates its lease and claim_id names
+    the claim, which that worker's later writes must match. A failed row
+    holds the call's error for the requests that were waiting on it."""
+    __tablename__ = "ai_response"
+    __table_args__ = (
+        db.Index("ix_ai_response_last_used", "last_used_at"),
+    )
+    key = db.Column(db.String(64), primary_key=True)
+    model = db.Column(db.String(100), nullable=False)
+    status = db.Column(db.String(20), nullable=False, default=AI_RESPONSE_PENDING)
+    response_text = db.Column(db.Text)
+    size_bytes = db.Column(db.Integer, nullable=False, default=0)
+    hits = db.Column(db.Integer, nullable=False, default=0)
+    claim_id = db.Column(db.String(32))
+    claimed_at = db.Column(db.DateTime, nullable=False)
+    expires_at = db.Column(db.DateTime)
+    last_used_at = db.Column(db.DateTime)
+
+
+class AICacheCounter(db.Model):
+    """Lookup counters for the AI response cache, shared by every worker:
+    hits, misses (upstream calls), coalesced (waited on another worker's
+    identical call) and evictions."""
+    __tablename__ = "ai_cache_counter"
+    name = db.Column(db.String(20), primary_key=True)
+    value = db.Column(db.Integer, nullable=False, default=0)
+
+
+class AICall(db.Model):
+    """Token usage of one model call (see ai.py). input_tokens counts only the
+    uncached input: cache_creation_input_tokens were written to the API's
+    prompt cache and cache_read_input_tokens were read from it.
+    first_token_ms is set for streamed calls."""
+    __tablename__ = "ai_call"
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(20), nullable=False)  # "plan" or "review"
+    model = db.Column(db.String(100), nullable=False)
+    input_tokens = db.Column(db.Integer, nullable=False, default=0)
+    output_tokens = db.Column(db.Integer, nullable=False, default=0)
+    cache_creation_input_tokens = db.Column(db.Integer, nullable=False, default=0)
+    cache_read_input_tokens = db.Column(db.Integer, nullable=False, default=0)
+    first_token_ms = db.Column(db.Integer)
+    duration_ms = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
+
+
 class FitnessTest(db.Model):
     __tablename__ = "fitness_test"
     id = db.Column(db.Integer, primary_key=True)
@@ -175,12 +347,34 @@ class NextWorkoutNote(db.Model):
     note = db.Column(db.Text, nullable=False)
 
 
+def exercise_name_key(name):
+    """Matching key for an exercise name: Unicode-normalized, case-folded,
+    apostrophes dropped and any other run of punctuation/whitespace collapsed
+    to one space, so "Pull-Up", "pull up" and " PULL_UP " all give "pull up"."""
+    if not name:
+        return ""
+    key = unicodedata.normalize("NFKC", name).casefold()
+    key = re.sub(r"['\u2019]", "", key)
+    return re.sub(r"[\W_]+", " ", key).strip()
+
+
+def _name_key_default(context):
+    # Core and bulk inserts (db.insert(ExerciseLibrary), [{"name": ...}]) bypass the ORM event below
+    return exercise_name_key(context.get_current_parameters().get("name"))
+
+
 class ExerciseLibrary(db.Model):
     __tablename__ = "exercise_library"
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(200), unique=True, nullable=False)
+    name_key = db.Column(db.String(200), index=True, default=_name_key_default)  # exercise_name_key(name)
     muscle_group = db.Column(db.String(100))
     equipment = db.Column(db.String(100))
     description = db.Column(db.Text)
     form_cues = db.Column(db.Text)
     difficulty = db.Column(db.String(20))
+
+
+@event.listens_for(ExerciseLibrary.name, "set")
+def _sync_name_key(target, value, oldvalue, initiator):
+    target.name_key = exercise_name_key(value)
@@ -0,0 +1,132 @@
+"""
+Process-wide cache of parsed WorkoutPlan.plan_json.
+
+plan_json is a large LLM-generated blob that never changes once a plan is
+active, yet the dashboard, calendar, workout page and plan history all need
+it parsed. Each plan is parsed once per process and handed out as an
+immutable structure (FrozenDict / tuple), so callers cannot corrupt the
+shared copy.
+
+Entries are keyed by (plan_id, sha1 of the JSON text), so an edited plan is
+a new key rather than a stale hit. The cache is an LRU bounded by the
+estimated in-memory size of the parsed plans (PLAN_CACHE_MAX_BYTES), and
+stats() reports hits, misses and evictions.
+"""
+import hashlib
+import json
+import sys
+import threading
+from collections import OrderedDict
+
+DEFAULT_MAX_BYTES = 16 * 1024 * 1024
+
+
+class FrozenDict(dict):
+    """A dict that refuses mutation after construction."""
+
+    def _immutable(self, *args, **kwargs):
+        raise TypeError("cached plan data is read-only; copy it before modifying")
+
+    __setitem__ = __delitem__ = __ior__ = _immutable
+    clear = pop = popitem = setdefault = update = _immutable
+
+    def __reduce__(self):
+        return (FrozenDict, (dict(self),))
+
+
+def freeze(value):
+    """Recursively convert parsed JSON into FrozenDict / tuple."""
+    if isinstance(value, dict):
+        return FrozenDict((k, freeze(v)) for k, v in value.items())
+    if isinstance(value, list):
+        return tuple(freeze(v) for v in value)
+    return value
+
+
+def _sizeof(value):
+    """Approximate memory held by a frozen JSON structure."""
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(_sizeof(k) + _sizeof(v) for k, v in value.items())
+    elif isinstance(value, tuple):
+        size += sum(_sizeof(v) for v in value)
+    return size
+
+
+EMPTY_PLAN = FrozenDict()
+
+
+class PlanCache:
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # key -> (data, size)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, plan_id, plan_json):
+        """Parsed, frozen plan_json; EMPTY_PLAN when empty, malformed or not an object."""
+        if not plan_json:
+            return EMPTY_PLAN
+        key = (plan_id, hashlib.sha1(plan_json.encode("utf-8")).hexdigest())
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+
+        # Parse outside the lock; a concurrent miss on the same key just
+        # parses twice and the second insert replaces the first.
+        try:
+            data = json.loads(plan_json)
+        except ValueError:
+            data = None
+        data = freeze(data) if isinstance(data, dict) else EMPTY_PLAN
+        size = _sizeof(data)
+
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old[1]
+            if size <= self.max_bytes:
+                self._entries[key] = (data, size)
+                self._bytes += size
+            self._evict()
+        return data
+
+    def _evict(self):
+        while self._bytes > self.max_bytes and self._entries:
+            _, (_, size) = self._entries.popitem(last=False)
+            self._bytes -= size
+            self.evictions += 1
+
+    def resize(self, max_bytes):
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+            self.hits = self.misses = self.evictions = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+
+parsed_plans = PlanCache()
@@ -0,0 +1,242 @@
+"""
+Background plan generation.
+
+Generating a plan is one long model call (ai.generate_workout_plan), far too
+slow to hold one of gunicorn's few request threads for. POST
+/generate-plan/generate records a PlanJob row and returns at once; a small
+per-process thread pool runs the job, and the page polls
+/api/plan/jobs/<id> until it finishes. The model call streams: each phase
+and workout is recorded in progress_json as soon as it is complete, and each
+poll returns the ones the page has not seen yet, so the plan fills in as it
+is written without any request waiting on the model.
+A succeeded job leaves the pending WorkoutPlan exactly as the synchronous
+route used to; a failed one keeps the error for the page to show.
+
+Jobs live in the database, not in the pool, so they survive the process
+that started them. A job is claimed with a conditional UPDATE, so only one
+thread in any worker runs it. While it runs, a heartbeat refreshes
+heartbeat_at; if the worker is killed mid-call, the heartbeat goes stale and
+the next status poll, in whichever worker serves it, re-runs the job (up to
+MAX_ATTEMPTS claims, then fails it). Each of the running thread's writes is
+conditioned on the attempt it claimed, so a worker that was only slow, not
+dead, cannot overwrite the re-run's job row or plan.
+"""
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+from models import (
+    db, PlanJob, UserProfile, FitnessTest, WorkoutPlan,
+    PLAN_JOB_QUEUED, PLAN_JOB_RUNNING, PLAN_JOB_SUCCEEDED, PLAN_JOB_FAILED,
+)
+
+HEARTBEAT_SECONDS = 30
+LEASE = timedelta(seconds=4 * HEARTBEAT_SECONDS)
+MAX_ATTEMPTS = 2
+
+STAGE_QUEUED = "Waiting to start"
+STAGE_GENERATING = "Generating your plan"
+STAGE_SAVING = "Saving your plan"
+
+
+def _now():
+    # Naive UTC, as the DateTime columns store it
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def job_status(job, since=0, attempt=None):
+    """The status endpoint's JSON for a job, with its streamed events from
+    index `since` on. A page that last saw another attempt (the job was re-run
+    since) gets the current attempt's events from the top, and "reset"."""
+    end = job.finished_at or _now()
+    reset = attempt is not None and attempt != job.attempts
+    return {
+        "id": job.id,
+        "status": job.status,
+        "stage": job.stage,
+        "attempts": job.attempts,
+        "elapsed_seconds": max(int((end - job.created_at).total_seconds()), 0) if job.created_at else 0,
+        "done": job.status in (PLAN_JOB_SUCCEEDED, PLAN_JOB_FAILED),
+        "error": job.error,
+        "plan_id": job.plan_id,
+        "events": job_events(job)[0 if reset else max(since, 0):],
+        "reset": reset,
+    }
+
+
+def job_events(job):
+    """The job's streamed [kind, data] events so far."""
+    return json.loads(job.progress_json or "[]")
+
+
+def _stale(job):
+    """True if the running job's worker has stopped heartbeating."""
+    return job.heartbeat_at is None or job.heartbeat_at < _now() - LEASE
+
+
+def _claim(job_id):
+    """Take the job for this thread: the attempt number it now holds, or
+    None if another thread holds it."""
+    now = _now()
+    attempt = db.session.execute(
+        db.update(PlanJob)
+        .where(PlanJob.id == job_id, PlanJob.attempts < MAX_ATTEMPTS, db.or_(
+            PlanJob.status == PLAN_JOB_QUEUED,
+            db.and_(PlanJob.status == PLAN_JOB_RUNNING,
+                    db.or_(PlanJob.heartbeat_at.is_(None), PlanJob.heartbeat_at < now - LEASE)),
+        ))
+        .values(status=PLAN_JOB_RUNNING, stage=STAGE_GENERATING, attempts=PlanJob.attempts + 1,
+                started_at=now, heartbeat_at=now, progress_json="[]")
+        .returning(PlanJob.attempts)
+    ).scalar()
+    db.session.commit()
+    return attempt
+
+
+def _holds(job_id, attempt):
+    """WHERE clause for a write by the thread running `attempt`: once the job
+    was re-claimed (this worker's heartbeat lapsed), the old thread's writes
+    match nothing."""
+    return db.and_(PlanJob.id == job_id, PlanJob.attempts == attempt, PlanJob.status == PLAN_JOB_RUNNING)
+
+
+def _update(job_id, attempt, **values):
+    """Update the job and commit, with anything else pending, if `attempt`
+    still holds it; otherwise roll it all back and return False."""
+    held = db.session.execute(db.update(PlanJob).where(_holds(job_id, attempt)).values(**values)).rowcount == 1
+    if held:
+        db.session.commit()
+    else:
+        db.session.rollback()
+    return held
+
+
+def save_pending_plan(user_id, plan_data):
+    """Replace the user's pending plan with `plan_data`; returns the new
+    plan. Not committed."""
+    WorkoutPlan.query.filter_by(user_id=user_id, status="pending").delete()
+    pending = WorkoutPlan(
+        user_id=user_id,
+        name=plan_data["plan_name"],
+        description=plan_data.get("description", ""),
+        days_per_week=plan_data.get("days_per_week", 3),
+        plan_json=json.dumps(plan_data),
+        status="pending",
+        total_weeks=plan_data.get("total_weeks", 12),
+    )
+    db.session.add(pending)
+    db.session.flush()
+    return pending
+
+
+class PlanJobRunner:
+    def __init__(self, max_workers=1):
+        self.max_workers = max_workers
+        self._executor = None
+        self._futures = {}  # job_id -> Future, for jobs this process has queued
+        self._lock = threading.Lock()
+
+    def configure(self, max_workers):
+        self.max_workers = max(int(max_workers), 1)
+
+    def submit(self, app, job_id):
+        """Run the job on this process's pool, unless it is already queued here."""
+        with self._lock:
+            future = self._futures.get(job_id)
+            if future is not None and not future.done():
+                return future
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers,
+                                                    thread_name_prefix="plan-job")
+            future = self._futures[job_id] = self._executor.submit(self.run, app, job_id)
+            return future
+
+    def ensure(self, app, job):
+        """Make sure a live worker holds the job: queue it here if it is
+        waiting or its worker died, or fail it once out of attempts."""
+        if job.status == PLAN_JOB_QUEUED or (job.status == PLAN_JOB_RUNNING and _stale(job)):
+            if job.attempts < MAX_ATTEMPTS:
+                self.submit(app, job.id)
+            else:
+                job.status = PLAN_JOB_FAILED
+                job.stage = None
+                job.error = "Plan generation stopped before finishing. Please try again."
+                job.finished_at = _now()
+                db.session.commit()
+
+    def drain(self, timeout=None):
+        """Wait for every job this process has queued to finish."""
+        with self._lock:
+            futures = list(self._futures.values())
+        for future in futures:
+            future.result(timeout=timeout)
+
+    def run(self, app, job_id):
+        with app.app_context():
+            try:
+                attempt = _claim(job_id)
+                if attempt is None:
+                    return
+                stop = threading.Event()
+                heartbeat = threading.Thread(target=self._heartbeat, args=(app, job_id, attempt, stop),
+                                             name=f"plan-job-{job_id}-heartbeat", daemon=True)
+                heartbeat.start()
+                try:
+                    self._generate(job_id, attempt)
+                finally:
+                    stop.set()
+                    heartbeat.join()
+            finally:
+                db.session.remove()
+                with self._lock:
+                    self._futures.pop(job_id, None)
+
+    @staticmethod
+    def _heartbeat(app, job_id, attempt, stop):
+        while not stop.wait(HEARTBEAT_SECONDS):
+            with app.app_context():
+                _update(job_id, attempt, heartbeat_at=_now())
+                db.session.remove()
+
+    @staticmethod
+    def _generate(job_id, attempt):
+        from ai import generate_workout_plan
+
+        job = db.session.get(PlanJob, job_id)
+        params = json.loads(job.params_json or "{}")
+        profile = db.session.get(UserProfile, job.user_id)
+        fitness_test = (db.session.get(FitnessTest, params["fitness_test_id"])
+                        if params.get("fitness_test_id") else None)
+        # Detached, so the model call holds no transaction (or SQLite read snapshot) open
+        for obj in (profile, fitness_test):
+            if obj is not None:
+                db.session.expunge(obj)
+        db.session.commit()
+
+        progress = []
+
+        def on_event(kind, data):
+            # Publish each streamed phase/workout for the events endpoint
+            progress.append([kind, data])
+            workouts = sum(1 for k, _ in progress if k == "workout")
+            _update(job_id, attempt, progress_json=json.dumps(progress), heartbeat_at=_now(),
+                    stage=f"{workouts} workout{'s' if workouts != 1 else ''} ready" if workouts else STAGE_GENERATING)
+
+        try:
+            plan_data = generate_workout_plan(
+                profile, fitness_test=fitness_test,
+                prior_review=params.get("prior_review"), extra_context=params.get("extra_context"),
+                on_event=on_event, refresh=params.get("regenerate", False),
+            )
+            _update(job_id, attempt, stage=STAGE_SAVING, heartbeat_at=_now())
+            # The plan and the job's success commit together, or not at all if
+            # the job was re-claimed meanwhile (the new attempt's plan wins)
+            pending = save_pending_plan(job.user_id, plan_data)
+            _update(job_id, attempt, status=PLAN_JOB_SUCCEEDED, plan_id=pending.id, stage=None, finished_at=_now())
+        except Exception as e:
+            db.session.rollback()
+            _update(job_id, attempt, status=PLAN_JOB_FAILED, stage=None, error=str(e), finished_at=_now())
+
+
+plan_job_runner = PlanJobRunner()
@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+"""CLI script to recompute the derived summary tables from scratch.
+
+Triggers keep exercise_performance, plan_progress, the workout_session
+aggregates, the exercise-name versions and the search index current on
+every write; run this after restoring a backup taken without them, or to
+repair a database edited with triggers disabled.
+
+Usage:
+    python rebuild_summaries.py
+"""
+import sys
+import os
+
+sys.path.insert(0, os.path.dirname(__file__))
+
+from dotenv import load_dotenv  # noqa: E402
+load_dotenv()
+
+from app import app  # noqa: E402
+from models import db  # noqa: E402
+import search_index  # noqa: E402
+import summaries  # noqa: E402
+
+
+def rebuild_summaries():
+    with app.app_context():
+        with db.engine.begin() as conn:
+            summaries.create_triggers(conn)
+            summaries.rebuild_exercise_performance(conn)
+            summaries.rebuild_plan_progress(conn)
+            summaries.rebuild_session_aggregates(conn)
+            summaries.bump_exercise_name_versions(conn)
+            search_index.create_search_index(conn)
+            search_index.rebuild_search_index(conn)
+            performance = conn.exec_driver_sql("SELECT count(*) FROM exercise_performance").scalar()
+            progress = conn.exec_driver_sql("SELECT count(*) FROM plan_progress").scalar()
+    print(f"Rebuilt {performance} exercise_performance and {progress} plan_progress rows "
+          f"and the workout_session aggregates, reindexed search, and invalidated the exercise "
+          f"picker indexes.")
+
+
+if __name__ == "__main__":
+    rebuild_summaries()
@@ -0,0 +1,256 @@
+"""
+Full-text search over a user's training log, on an SQLite FTS5 table.
+
+search_index holds one document per searchable row:
+
+    session  a workout_session: workout and exercise names, session notes
+    set      a logged_set with notes: exercise name, set notes
+    note     a next_workout_note: workout name, note
+    review   an ai_review: review text
+
+Each document's rowid is the source row's id * 8 + its kind code, so the
+triggers below replace or drop it with a rowid lookup, inside the writing
+transaction, on every path (ORM flushes, bulk deletes, raw SQL). The owner
+column holds "u<user_id>", which makes "this user's hits" part of the FTS
+match rather than a filter over every user's hits. The table and triggers
+are created with the schema (metadata after_create) and by migration 11;
+rebuild_search_index() repopulates it from scratch.
+
+search() ranks hits with bm25 (names weigh twice as much as notes) and pages
+through them with LIMIT/OFFSET.
+"""
+import re
+
+from markupsafe import Markup, escape
+from sqlalchemy import DDL, event, text
+
+from models import db
+
+SEARCH_PAGE_SIZE = 20
+
+KIND_SESSION = 1
+KIND_SET = 2
+KIND_NOTE = 3
+KIND_REVIEW = 4
+KIND_NAMES = {KIND_SESSION: "session", KIND_SET: "set", KIND_NOTE: "note", KIND_REVIEW: "review"}
+
+CREATE_TABLE = """
+    CREATE VIRTUAL TABLE IF NOT EXISTS search_index USING fts5(
+        owner, title, body,
+        kind UNINDEXED, ref_id UNINDEXED, session_id UNINDEXED, date UNINDEXED,
+        tokenize = 'porter unicode61 remove_diacritics 2'
+    )
+"""
+
+_INSERT = "INSERT INTO search_index (rowid, owner, title, body, kind, ref_id, session_id, date)"
+
+# Document SELECTs; {where} narrows them to the rows being re-indexed
+_SESSION_SELECT = f"""
+    SELECT ws.id * 8 + {KIND_SESSION}, 'u' || ws.user_id,
+           trim(coalesce(pw.workout_name, '') || ' ' || coalesce((
+               SELECT group_concat(exercise_name, ' ')
+               FROM (SELECT DISTINCT exercise_name FROM logged_set WHERE session_id = ws.id)
+           ), '')),
+           coalesce(ws.session_notes, ''), {KIND_SESSION}, ws.id, ws.id, ws.date
+    FROM workout_session ws
+    LEFT JOIN planned_workout pw ON pw.id = ws.planned_workout_id
+    WHERE {{where}}
+"""
+
+_SET_SELECT = f"""
+    SELECT ls.id * 8 + {KIND_SET}, 'u' || ws.user_id, ls.exercise_name, ls.notes,
+           {KIND_SET}, ls.id, ws.id, ws.date
+    FROM logged_set ls
+    JOIN workout_session ws ON ws.id = ls.session_id
+    WHERE coalesce(ls.notes, '') != '' AND {{where}}
+"""
+
+_NOTE_SELECT = f"""
+    SELECT id * 8 + {KIND_NOTE}, 'u' || user_id, coalesce(workout_name, ''), note,
+           {KIND_NOTE}, id, NULL, NULL
+    FROM next_workout_note
+    WHERE {{where}}
+"""
+
+_REVIEW_SELECT = f"""
+    SELECT id * 8 + {KIND_REVIEW}, 'u' || user_id, '', coalesce(review_text, ''),
+           {KIND_REVIEW}, id, NULL, date(created_at)
+    FROM ai_review
+    WHERE {{where}}
+"""
+
+
+def _reindex_session(session_id):
+    """Trigger body: replace the session document for `session_id`."""
+    return f"""
+        DELETE FROM search_index WHERE rowid = {session_id} * 8 + {KIND_SESSION};
+        {_INSERT} {_SESSION_SELECT.format(where=f"ws.id = {session_id}")};
+    """
+
+
+def _reindex_set(ref):
+    """Trigger body: replace ref's set document (none when it has no notes)."""
+    return f"""
+        DELETE FROM search_index WHERE rowid = {ref}.id * 8 + {KIND_SET};
+        {_INSERT} {_SET_SELECT.format(where=f"ls.id = {ref}.id")};
+    """
+
+
+def _first_of_name(ref):
+    """WHEN clause: ref is the session's only set of its exercise, so the
+    session document's exercise names change."""
+    return f"""NOT EXISTS (
+        SELECT 1 FROM logged_set
+        WHERE exercise_name = {ref}.exercise_name AND session_id = {ref}.session_id AND id != {ref}.id
+    )"""
+
+
+SEARCH_TRIGGERS = [
+    f"""
+    CREATE TRIGGER IF NOT EXISTS search_session_insert
+    AFTER INSERT ON workout_session BEGIN
+        {_reindex_session("NEW.id")}
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS search_session_update
+    AFTER UPDATE OF user_id, date, planned_workout_id, session_notes ON workout_session BEGIN
+        {_reindex_session("NEW.id")}
+        DELETE FROM search_index WHERE rowid IN (
+            SELECT id * 8 + {KIND_SET} FROM logged_set WHERE session_id = NEW.id
+        );
+        {_INSERT} {_SET_SELECT.format(where="ls.session_id = NEW.id")};
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS search_session_delete
+    AFTER DELETE ON workout_session BEGIN
+        DELETE FROM search_index WHERE rowid = OLD.id * 8 + {KIND_SESSION};
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS search_set_insert
+    AFTER INSERT ON logged_set BEGIN
+        {_reindex_set("NEW")}
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS search_set_insert_name
+    AFTER INSERT ON logged_set WHEN {_first_of_name("NEW")} BEGIN
+        {_reindex_session("NEW.session_id")}
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS search_set_update
+    AFTER UPDATE OF exercise_name, notes, session_id ON logged_set BEGIN
+        {_reindex_set("NEW")}
+        {_reindex_session("OLD.session_id")}
+        {_reindex_session("NEW.session_id")}
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS search_set_delete
+    AFTER DELETE ON logged_set BEGIN
+        DELETE FROM search_index WHERE rowid = OLD.id * 8 + {KIND_SET};
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS search_set_delete_name
+    AFTER DELETE ON logged_set WHEN {_first_of_name("OLD")} BEGIN
+        {_reindex_session("OLD.session_id")}
+    END
+    """,
+] + [
+    trigger
+    for table, kind, select in (
+        ("next_workout_note", KIND_NOTE, _NOTE_SELECT),
+        ("ai_review", KIND_REVIEW, _REVIEW_SELECT),
+    )
+    for trigger in (
+        f"""
+        CREATE TRIGGER IF NOT EXISTS search_{table}_insert
+        AFTER INSERT ON {table} BEGIN
+            {_INSERT} {select.format(where="id = NEW.id")};
+        END
+        """,
+        f"""
+        CREATE TRIGGER IF NOT EXISTS search_{table}_update
+        AFTER UPDATE ON {table} BEGIN
+            DELETE FROM search_index WHERE rowid = OLD.id * 8 + {kind};
+            {_INSERT} {select.format(where="id = NEW.id")};
+        END
+        """,
+        f"""
+        CREATE TRIGGER IF NOT EXISTS search_{table}_delete
+        AFTER DELETE ON {table} BEGIN
+            DELETE FROM search_index WHERE rowid = OLD.id * 8 + {kind};
+        END
+        """,
+    )
+]
+
+# The triggers reference several tables, so create them once the whole schema exists
+event.listen(db.metadata, "after_create", DDL(CREATE_TABLE).execute_if(dialect="sqlite"))
+for _ddl in SEARCH_TRIGGERS:
+    event.listen(db.metadata, "after_create", DDL(_ddl).execute_if(dialect="sqlite"))
+# Not a metadata table, so drop_all() would otherwise leave it behind
+event.listen(db.metadata, "before_drop", DDL("DROP TABLE IF EXISTS search_index").execute_if(dialect="sqlite"))
+
+
+def create_search_index(conn):
+    conn.execute(text(CREATE_TABLE))
+    for ddl in SEARCH_TRIGGERS:
+        conn.execute(text(ddl))
+
+
+def rebuild_search_index(conn):
+    """Repopulate every search document from the source tables."""
+    conn.execute(text("DELETE FROM search_index"))
+    for select in (_SESSION_SELECT, _SET_SELECT, _NOTE_SELECT, _REVIEW_SELECT):
+        conn.execute(text(f"{_INSERT} {select.format(where='1 = 1')}"))
+
+
+def match_expression(query):
+    """The user's words as an FTS5 query: every word must match, each as a
+    prefix, with FTS5 operators and punctuation taken literally. None when
+    the query has no words."""
+    words = re.findall(r"\w+", query or "")
+    if not words:
+        return None
+    return " ".join(f'"{word}"*' for word in words)
+
+
+_MARK_OPEN, _MARK_CLOSE = "\x02", "\x03"
+
+
+def _highlight(snippet):
+    """Escape a snippet() result, then turn its match markers into <mark>."""
+    return Markup(str(escape(snippet)).replace(_MARK_OPEN, "<mark>").replace(_MARK_CLOSE, "</mark>"))
+
+
+def search(user_id, query, page=1, page_size=SEARCH_PAGE_SIZE):
+    """One page of `user_id`'s documents matching `query`, best first, and
+    whether another page follows. Each hit is a dict with kind, ref_id,
+    session_id, date, title and a highlighted snippet of the body."""
+    expression = match_expression(query)
+    if expression is None:
+        return [], False
+    page = max(page, 1)
+    rows = db.session.execute(
+        text(f"""
+            SELECT kind, ref_id, session_id, date, title,
+                   snippet(search_index, 2, '{_MARK_OPEN}', '{_MARK_CLOSE}', '…', 16)
+            FROM search_index
+            WHERE search_index MATCH :match
+            ORDER BY bm25(search_index, 0.0, 2.0, 1.0), rowid DESC
+            LIMIT :limit OFFSET :offset
+        """),
+        {"match": f'owner:"u{int(user_id)}" AND ({expression})',
+         "limit": page_size + 1, "offset": (page - 1) * page_size},
+    ).all()
+    hits = [
+        {"kind": KIND_NAMES.get(kind), "ref_id": ref_id, "session_id": session_id,
+         "date": date, "title": title, "snippet": _highlight(snippet)}
+        for kind, ref_id, session_id, date, title, snippet in rows[:page_size]
+    ]
+    return hits, len(rows) > page_size
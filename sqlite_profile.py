@@ -0,0 +1,89 @@
+"""
+SQLite engine profiles for FitLocal.
+
+gunicorn runs several workers x threads against one SQLite file, so every new
+connection gets the PRAGMAs of the selected profile, and the SQLAlchemy pool
+is sized for that concurrency. Select a profile with SQLITE_PROFILE
+("production" by default, "default" for stock SQLite behaviour).
+
+    production  WAL journal (readers never block the writer), a 5 s
+                busy_timeout instead of failing with "database is locked",
+                synchronous=NORMAL (durable at checkpoints; safe with WAL),
+                256 MB mmap, 16 MB page cache, temp tables in memory.
+    default     SQLite's own defaults and SQLAlchemy's default pool.
+"""
+from sqlalchemy import event
+
+SQLITE_PROFILES = {
+    "production": {
+        "pragmas": {
+            "journal_mode": "WAL",
+            "busy_timeout": 5000,
+            "synchronous": "NORMAL",
+            "mmap_size": 256 * 1024 * 1024,
+            "cache_size": -16000,  # negative = KiB
+            "temp_store": "MEMORY",
+        },
+        "engine_options": {
+            "pool_size": 5,
+            "max_overflow": 5,
+            "pool_timeout": 10,
+            "connect_args": {"timeout": 5},
+        },
+    },
+    "default": {
+        "pragmas": {},
+        "engine_options": {},
+    },
+}
+
+
+def _is_file_database(uri):
+    return uri.startswith("sqlite") and ":memory:" not in uri and uri.rstrip("/") not in ("sqlite:", "sqlite")
+
+
+def get_profile(name):
+    try:
+        return SQLITE_PROFILES[name]
+    except KeyError:
+        raise ValueError(
+            f"Unknown SQLITE_PROFILE {name!r}; expected one of {', '.join(SQLITE_PROFILES)}"
+        ) from None
+
+
+def engine_options(name, uri):
+    """SQLALCHEMY_ENGINE_OPTIONS for the profile. In-memory and non-SQLite
+    databases keep SQLAlchemy's defaults (their pools take no size options)."""
+    if not _is_file_database(uri):
+        return {}
+    options = dict(get_profile(name)["engine_options"])
+    if "connect_args" in options:
+        options["connect_args"] = dict(options["connect_args"])
+    return options
+
+
+def install_pragmas(engine, name):
+    """Apply the profile's PRAGMAs to every new DBAPI connection of `engine`."""
+    if engine.dialect.name != "sqlite":
+        return
+    pragmas = get_profile(name)["pragmas"]
+    if not pragmas:
+        return
+    in_memory = not _is_file_database(str(engine.url))
+
+    @event.listens_for(engine, "connect")
+    def _set_pragmas(dbapi_conn, connection_record):
+        cursor = dbapi_conn.cursor()
+        for pragma, value in pragmas.items():
+            if in_memory and pragma in ("journal_mode", "mmap_size"):
+                continue
+            cursor.execute(f"PRAGMA {pragma}={value}")
+        cursor.close()
+
+
+def current_pragmas(conn):
+    """Read back the tuned PRAGMAs from a live connection (for tests and benchmarks)."""
+    return {
+        pragma: conn.exec_driver_sql(f"PRAGMA {pragma}").scalar()
+        for pragma in SQLITE_PROFILES["production"]["pragmas"]
+    }
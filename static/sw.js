@@ -0,0 +1,66 @@
+// FitLocal service worker: keeps the workout page usable without a connection.
+//
+// Workout pages (/workout/...) are fetched from the network first and the
+// last good copy is kept, so the page -- with the last/recent performance
+// data rendered into it -- still opens when the gym Wi-Fi drops. Static
+// assets are served from the cache and refreshed behind it. Set entries
+// themselves are queued in IndexedDB by the page (see workout_today.html),
+// not here. Logging out empties the cache, since it holds training data.
+const CACHE = 'fitlocal-offline-v1';
+const PRECACHE = ['/workout/today', '/static/style.css'];
+
+self.addEventListener('install', function(event) {
+    event.waitUntil(
+        caches.open(CACHE)
+            .then(cache => cache.addAll(PRECACHE))
+            .catch(function() {})  // e.g. not logged in yet: pages are cached as they are visited
+            .then(() => self.skipWaiting())
+    );
+});
+
+self.addEventListener('activate', function(event) {
+    event.waitUntil(
+        caches.keys()
+            .then(keys => Promise.all(keys.filter(key => key !== CACHE).map(key => caches.delete(key))))
+            .then(() => self.clients.claim())
+    );
+});
+
+function networkFirst(request) {
+    return fetch(request).then(function(response) {
+        // Keep only real pages: not errors, and not the login page a lapsed session redirects to
+        if (response.ok && !response.redirected) {
+            const copy = response.clone();
+            caches.open(CACHE).then(cache => cache.put(request, copy));
+        }
+        return response;
+    }, function() {
+        return caches.match(request).then(cached => cached || caches.match('/workout/today'))
+            .then(cached => cached || Response.error());
+    });
+}
+
+function staleWhileRevalidate(request) {
+    const refreshed = fetch(request).then(function(response) {
+        if (response.ok) {
+            const copy = response.clone();
+            caches.open(CACHE).then(cache => cache.put(request, copy));
+        }
+        return response;
+    });
+    return caches.match(request).then(cached => cached || refreshed);
+}
+
+self.addEventListener('fetch', function(event) {
+    const request = event.request;
+    const url = new URL(request.url);
+    if (request.method !== 'GET' || url.origin !== self.location.origin) return;
+
+    if (url.pathname === '/logout') {
+        event.respondWith(caches.delete(CACHE).then(() => fetch(request)));
+    } else if (url.pathname.startsWith('/workout/') && request.mode === 'navigate') {
+        event.respondWith(networkFirst(request));
+    } else if (url.pathname.startsWith('/static/')) {
+        event.respondWith(staleWhileRevalidate(request));
+    }
+});
@@ -0,0 +1,332 @@
+"""
+Derived summary tables, kept in step with the rows they are computed from.
+
+    exercise_performance  each completed session's sets, per (session, exercise)
+    plan_progress         completed-session count and last workout, per (plan, phase)
+    workout_session       set_count, total_volume and duration_seconds, per session
+    workout_plan          phase_count, total_sessions and workout_names, per plan
+    exercise_name_version change counters for the library and each user's set names
+
+The workout_plan columns are extracted once, when a plan is activated (see
+plan_summary_columns below). For the rest, SQLite triggers on logged_set,
+workout_session, workout_plan and exercise_library rebuild the affected rows
+inside the writing transaction, so every path — ORM flushes, bulk
+query.update()/delete(), raw SQL in scripts — keeps them current. The
+triggers are created with the tables (metadata after_create) and by
+migrate.py for existing databases; rebuild_summaries.py recomputes them all
+from scratch.
+"""
+import json
+
+from sqlalchemy import DDL, event, text
+
+from models import db, SESSION_STATUS_COMPLETED, EXERCISE_NAMES_LIBRARY_SCOPE
+
+# One summary row per (session, exercise): the completed session's sets as
+# {"<set_number>": [weight_lbs, reps_completed, weight_b, reps_b, rpe, notes]}
+_SUMMARY_SELECT = f"""
+    SELECT ws.user_id, ls.exercise_name, ws.id, ws.date,
+           json_group_object(ls.set_number, json_array(
+               ls.weight_lbs, ls.reps_completed, ls.weight_b, ls.reps_b, ls.rpe, coalesce(ls.notes, '')
+           ))
+    FROM workout_session ws
+    JOIN logged_set ls ON ls.session_id = ws.id
+    WHERE ws.status = '{SESSION_STATUS_COMPLETED}' AND {{where}}
+    GROUP BY ws.id, ls.exercise_name
+"""
+
+_SUMMARY_INSERT = "INSERT INTO exercise_performance (user_id, exercise_name, session_id, date, sets_json)"
+
+
+def _resummarize_exercise(ref):
+    """Trigger body: rebuild the summary row for (ref.session_id, ref.exercise_name)."""
+    return f"""
+        DELETE FROM exercise_performance
+        WHERE session_id = {ref}.session_id AND exercise_name = {ref}.exercise_name;
+        {_SUMMARY_INSERT}
+        {_SUMMARY_SELECT.format(where=f"ws.id = {ref}.session_id AND ls.exercise_name = {ref}.exercise_name")};
+    """
+
+
+EXERCISE_PERFORMANCE_TRIGGERS = [
+    f"""
+    CREATE TRIGGER IF NOT EXISTS exercise_performance_set_insert
+    AFTER INSERT ON logged_set BEGIN
+        {_resummarize_exercise("NEW")}
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS exercise_performance_set_update
+    AFTER UPDATE ON logged_set BEGIN
+        {_resummarize_exercise("OLD")}
+        {_resummarize_exercise("NEW")}
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS exercise_performance_set_delete
+    AFTER DELETE ON logged_set BEGIN
+        {_resummarize_exercise("OLD")}
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS exercise_performance_session_update
+    AFTER UPDATE OF user_id, date, status ON workout_session BEGIN
+        DELETE FROM exercise_performance WHERE session_id = OLD.id;
+        {_SUMMARY_INSERT}
+        {_SUMMARY_SELECT.format(where="ws.id = NEW.id")};
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS exercise_performance_session_delete
+    AFTER DELETE ON workout_session BEGIN
+        DELETE FROM exercise_performance WHERE session_id = OLD.id;
+    END
+    """,
+]
+
+# Per (plan, phase tag): completed count, plus the latest session's workout,
+# date and id. With exactly one max() aggregate, SQLite takes the bare columns
+# from the row holding that max.
+_PROGRESS_SELECT = f"""
+    SELECT pw.plan_id AS plan_id, coalesce(ws.phase_name, '') AS phase_name,
+           count(*) AS completed_count, ws.planned_workout_id AS last_planned_workout_id,
+           ws.date AS last_date, ws.id AS last_session_id,
+           max(ws.date || '#' || substr('000000000000' || ws.id, -12)) AS last_key
+    FROM workout_session ws
+    JOIN planned_workout pw ON pw.id = ws.planned_workout_id
+    JOIN workout_plan wp ON wp.id = pw.plan_id AND wp.user_id = ws.user_id
+    WHERE ws.status = '{SESSION_STATUS_COMPLETED}' AND {{where}}
+    GROUP BY pw.plan_id, coalesce(ws.phase_name, '')
+"""
+
+_PROGRESS_INSERT = """
+    INSERT INTO plan_progress
+        (plan_id, phase_name, completed_count, last_planned_workout_id, last_date, last_session_id)
+    SELECT plan_id, phase_name, completed_count, last_planned_workout_id, last_date, last_session_id
+    FROM ({select})
+"""
+
+
+def _recount_phase(ref):
+    """Trigger body: rebuild the plan_progress row for ref's (plan, phase tag)."""
+    plan_id = f"(SELECT plan_id FROM planned_workout WHERE id = {ref}.planned_workout_id)"
+    phase = f"coalesce({ref}.phase_name, '')"
+    select = _PROGRESS_SELECT.format(
+        where=f"pw.plan_id = {plan_id} AND coalesce(ws.phase_name, '') = {phase}"
+    )
+    return f"""
+        DELETE FROM plan_progress WHERE plan_id = {plan_id} AND phase_name = {phase};
+        {_PROGRESS_INSERT.format(select=select)};
+    """
+
+
+PLAN_PROGRESS_TRIGGERS = [
+    f"""
+    CREATE TRIGGER IF NOT EXISTS plan_progress_session_insert
+    AFTER INSERT ON workout_session WHEN NEW.planned_workout_id IS NOT NULL BEGIN
+        {_recount_phase("NEW")}
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS plan_progress_session_update
+    AFTER UPDATE OF user_id, planned_workout_id, date, status, phase_name ON workout_session BEGIN
+        {_recount_phase("OLD")}
+        {_recount_phase("NEW")}
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS plan_progress_session_delete
+    AFTER DELETE ON workout_session WHEN OLD.planned_workout_id IS NOT NULL BEGIN
+        {_recount_phase("OLD")}
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS plan_progress_plan_delete
+    AFTER DELETE ON workout_plan BEGIN
+        DELETE FROM plan_progress WHERE plan_id = OLD.id;
+    END
+    """,
+]
+
+# Session aggregates for the history list. Updating workout_session from a
+# trigger only sets these columns, so it fires none of the UPDATE OF triggers
+# above (and SQLite does not recurse into triggers by default).
+_AGGREGATE_SET = """
+    set_count = (SELECT count(*) FROM logged_set WHERE session_id = workout_session.id),
+    total_volume = (
+        SELECT coalesce(sum(coalesce(weight_lbs, 0) * coalesce(reps_completed, 0)
+                            + coalesce(weight_b, 0) * coalesce(reps_b, 0)), 0)
+        FROM logged_set WHERE session_id = workout_session.id
+    )
+"""
+
+_DURATION_SET = """
+    duration_seconds = CAST(round((julianday(end_time) - julianday(start_time)) * 86400) AS INTEGER)
+"""
+
+
+def _reaggregate_session(ref):
+    """Trigger body: recompute the set aggregates of ref's session."""
+    return f"UPDATE workout_session SET {_AGGREGATE_SET} WHERE id = {ref}.session_id;"
+
+
+SESSION_AGGREGATE_TRIGGERS = [
+    f"""
+    CREATE TRIGGER IF NOT EXISTS session_aggregates_set_insert
+    AFTER INSERT ON logged_set BEGIN
+        {_reaggregate_session("NEW")}
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS session_aggregates_set_update
+    AFTER UPDATE ON logged_set BEGIN
+        {_reaggregate_session("OLD")}
+        {_reaggregate_session("NEW")}
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS session_aggregates_set_delete
+    AFTER DELETE ON logged_set BEGIN
+        {_reaggregate_session("OLD")}
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS session_aggregates_session_insert
+    AFTER INSERT ON workout_session BEGIN
+        UPDATE workout_session SET {_DURATION_SET} WHERE id = NEW.id;
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS session_aggregates_session_times
+    AFTER UPDATE OF start_time, end_time ON workout_session BEGIN
+        UPDATE workout_session SET {_DURATION_SET} WHERE id = NEW.id;
+    END
+    """,
+]
+
+# Exercise picker versions (exercise_catalog.py): any library change bumps
+# scope 0, any change to a user's logged_set names bumps that user's scope.
+_BUMP_VERSION = """
+    ON CONFLICT(scope) DO UPDATE SET version = version + 1;
+"""
+
+
+def _bump_user_names(ref):
+    """Trigger body: bump the name version of ref's session's user."""
+    return f"""
+        INSERT INTO exercise_name_version (scope, version)
+        SELECT user_id, 1 FROM workout_session WHERE id = {ref}.session_id
+        {_BUMP_VERSION}
+    """
+
+
+_BUMP_LIBRARY = f"""
+    INSERT INTO exercise_name_version (scope, version) VALUES ({EXERCISE_NAMES_LIBRARY_SCOPE}, 1)
+    {_BUMP_VERSION}
+"""
+
+EXERCISE_NAME_VERSION_TRIGGERS = [
+    f"""
+    CREATE TRIGGER IF NOT EXISTS exercise_names_set_insert
+    AFTER INSERT ON logged_set BEGIN
+        {_bump_user_names("NEW")}
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS exercise_names_set_rename
+    AFTER UPDATE OF exercise_name, session_id ON logged_set BEGIN
+        {_bump_user_names("OLD")}
+        {_bump_user_names("NEW")}
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS exercise_names_set_delete
+    AFTER DELETE ON logged_set BEGIN
+        {_bump_user_names("OLD")}
+    END
+    """,
+] + [
+    f"""
+    CREATE TRIGGER IF NOT EXISTS exercise_names_library_{op.lower()}
+    AFTER {op} ON exercise_library BEGIN
+        {_BUMP_LIBRARY}
+    END
+    """
+    for op in ("INSERT", "UPDATE", "DELETE")
+]
+
+SUMMARY_TRIGGERS = (
+    EXERCISE_PERFORMANCE_TRIGGERS + PLAN_PROGRESS_TRIGGERS + SESSION_AGGREGATE_TRIGGERS
+    + EXERCISE_NAME_VERSION_TRIGGERS
+)
+
+
+def _has_session_aggregates(ddl, target, bind, **kw):
+    # create_all() on a pre-aggregate database leaves workout_session as it
+    # was; migration 7 adds the columns and then these triggers.
+    return any(row[1] == "set_count" for row in bind.exec_driver_sql("PRAGMA table_info(workout_session)"))
+
+
+# Triggers reference several tables, so create them once the whole schema exists
+for _ddl in EXERCISE_PERFORMANCE_TRIGGERS + PLAN_PROGRESS_TRIGGERS + EXERCISE_NAME_VERSION_TRIGGERS:
+    event.listen(db.metadata, "after_create", DDL(_ddl).execute_if(dialect="sqlite"))
+for _ddl in SESSION_AGGREGATE_TRIGGERS:
+    event.listen(db.metadata, "after_create", DDL(_ddl).execute_if(
+        dialect="sqlite", callable_=_has_session_aggregates,
+    ))
+
+
+def create_triggers(conn):
+    for ddl in SUMMARY_TRIGGERS:
+        conn.execute(text(ddl))
+
+
+def rebuild_exercise_performance(conn):
+    """Recompute every exercise_performance row from logged_set in one statement."""
+    conn.execute(text("DELETE FROM exercise_performance"))
+    conn.execute(text(f"{_SUMMARY_INSERT} {_SUMMARY_SELECT.format(where='1 = 1')}"))
+
+
+def rebuild_plan_progress(conn):
+    """Recompute every plan_progress row from workout_session in one statement."""
+    conn.execute(text("DELETE FROM plan_progress"))
+    conn.execute(text(_PROGRESS_INSERT.format(select=_PROGRESS_SELECT.format(where="1 = 1"))))
+
+
+def rebuild_session_aggregates(conn):
+    """Recompute every workout_session's set aggregates and duration in one statement."""
+    conn.execute(text(f"UPDATE workout_session SET {_AGGREGATE_SET}, {_DURATION_SET}"))
+
+
+def bump_exercise_name_versions(conn):
+    """Move every exercise-name version on, so each process rebuilds its picker index."""
+    conn.execute(text("UPDATE exercise_name_version SET version = version + 1"))
+    conn.execute(text(_BUMP_LIBRARY))
+
+
+# ---------------------------------------------------------------------------
+# Plan summary columns
+# ---------------------------------------------------------------------------
+# plan_json is immutable once a plan is activated, so its list-page summary is
+# extracted then (confirm_plan) rather than by triggers; migration 8 backfills
+# older plans.
+
+def plan_total_sessions(plan_data):
+    """Total expected sessions for a plan (phases × weeks × days_per_week)."""
+    phases = plan_data.get("phases", [])
+    days_per_week = plan_data.get("days_per_week", 3)
+    if phases:
+        return sum(
+            (p.get("week_end", p.get("week_start", 1)) - p.get("week_start", 1) + 1) * days_per_week
+            for p in phases
+        )
+    return len(plan_data.get("workouts", []))
+
+
+def plan_summary_columns(plan_data):
+    """WorkoutPlan summary column values for a parsed plan_json."""
+    return {
+        "phase_count": len(plan_data.get("phases", [])),
+        "total_sessions": plan_total_sessions(plan_data),
+        "workout_names": json.dumps([w.get("name", "") for w in plan_data.get("workouts", [])]),
+    }
@@ -3,7 +3,7 @@ import json
 import os
 import sys
 import tempfile
-from datetime import date
+from datetime import date, timedelta
 from werkzeug.datastructures import MultiDict
 
 # Point at a fresh temp DB BEFORE importing app (engine is created at import time)
@@ -2235,19 +2235,28 @@ print("\n--- AI: extra_context in plan generation prompt ---")
 import unittest.mock as _mock
 _stub_plan = json.dumps({
     "plan_name": "Test Plan", "description": "", "days_per_week": 3,
-    "total_weeks": 12, "phases": [], "workouts": [],
+    "total_weeks": 12, "phases": [], "workouts": [
+        {"day": "Workout A", "name": "Full Body", "exercises": [{"name": "Push-up", "sets": 3, "reps": "10"}]},
+    ],
 })
+
+
+def _stream_response(mock_client, text, chunk_size=40, stop_reason="end_turn"):
+    """Make mock_client's messages.stream() yield `text` in chunks."""
+    stream = mock_client.return_value.messages.stream.return_value.__enter__.return_value
+    stream.text_stream = [text[i:i + chunk_size] for i in range(0, len(text), chunk_size)]
+    stream.get_final_message.return_value.stop_reason = stop_reason
+
+
 try:
     with _mock.patch("ai.get_client") as _mock_client:
-        _msg = _mock.MagicMock()
-        _msg.content = [_mock.MagicMock(text=_stub_plan)]
-        _mock_client.return_value.messages.create.return_value = _msg
+        _stream_response(_mock_client, _stub_plan)
         with app.app_context():
             from ai import generate_workout_plan
             _profile = UserProfile.query.first()
             _extra = "Add more variety, I was getting bored at the end of the last 12 weeks"
             generate_workout_plan(_profile, extra_context=_extra)
-            _call = _mock_client.return_value.messages.create.call_args
+            _call = _mock_client.return_value.messages.stream.call_args
             _prompt = _call.kwargs["messages"][0]["content"]
             check("extra_context text appears in plan generation prompt", _extra in _prompt)
 except Exception as _e:
@@ -2346,15 +2355,2039 @@ check("Legend (build_phase_color_map) omits old plan phase names",
 check("Old session colored by phase index in its own plan (not grey)",
       _session_color == PHASE_COLORS[1])  # "Vintage Peak" is index 1 → PHASE_COLORS[1]
 
+# ── Query plans: hot paths use the secondary indexes ──────────────────────────
+print("\n--- Query Plans: Secondary Indexes ---")
+
+from sqlalchemy import event as _sa_event
+
+
+def _captured_sql(fn):
+    """Run fn() and return the (statement, parameters) pairs it sent to SQLite."""
+    _stmts = []
+
+    def _rec(conn, cursor, statement, parameters, context, executemany):
+        _stmts.append((statement, parameters))
+
+    _sa_event.listen(db.engine, "before_cursor_execute", _rec)
+    try:
+        fn()
+    finally:
+        _sa_event.remove(db.engine, "before_cursor_execute", _rec)
+    return _stmts
+
+
+def _full_scans(stmts):
+    """EXPLAIN QUERY PLAN each captured SELECT; return plan lines that full-scan
+    workout_session or logged_set."""
+    scans = []
+    for _stmt, _params in stmts:
+        if not _stmt.lstrip().upper().startswith("SELECT"):
+            continue
+        _rows = db.session.connection().exec_driver_sql(
+            "EXPLAIN QUERY PLAN " + _stmt, _params
+        ).fetchall()
+        for _row in _rows:
+            _detail = _row[3]
+            if _detail.startswith(("SCAN workout_session", "SCAN logged_set")):
+                scans.append(_detail)
+    return scans
+
+
+with app.app_context():
+    from sqlalchemy import inspect as _sa_inspect
+    from app import (
+        get_last_performance as _qp_glp, get_recent_performance as _qp_grp,
+        resolve_plan_position as _qp_rpp, build_month_calendar as _qp_bmc,
+        get_mini_calendar as _qp_gmc, get_active_plan as _qp_gap,
+    )
+    _insp = _sa_inspect(db.engine)
+    _ws_idx = {i["name"] for i in _insp.get_indexes("workout_session")}
+    _ls_idx = {i["name"] for i in _insp.get_indexes("logged_set")}
+    check("workout_session has (user_id, status, date, id) index",
+          "ix_workout_session_user_status_date" in _ws_idx)
+    check("workout_session has (user_id, planned_workout_id, phase_name) index",
+          "ix_workout_session_user_workout_phase" in _ws_idx)
+    check("logged_set has (session_id) index", "ix_logged_set_session_id" in _ls_idx)
+    check("logged_set has (exercise_name, session_id) index", "ix_logged_set_exercise_session" in _ls_idx)
+
+    _qp_profile = UserProfile.query.first()
+    _qp_plan = _qp_gap(_qp_profile.id)
+    _qp_today = date.today()
+    for _label, _fn in [
+        ("get_last_performance", lambda: _qp_glp(_qp_profile.id, "Bench Press")),
+        ("get_recent_performance", lambda: _qp_grp(_qp_profile.id, "Bench Press", limit=3)),
+        ("resolve_plan_position", lambda: _qp_rpp(_qp_profile.id, _qp_plan)),
+        ("build_month_calendar", lambda: _qp_bmc(_qp_profile.id, _qp_today.year, _qp_today.month)),
+        ("get_mini_calendar", lambda: _qp_gmc(_qp_profile.id)),
+    ]:
+        _stmts = _captured_sql(_fn)
+        _scans = _full_scans(_stmts)
+        check(f"{_label} issues queries ({len(_stmts)})", len(_stmts) > 0)
+        check(f"{_label} never full-scans workout_session/logged_set {_scans or ''}", not _scans)
+
+# ── Schema migrations: versioned, run-once ─────────────────────────────────────
+print("\n--- Schema Migrations ---")
+
+import sqlite3 as _sqlite3
+import threading as _threading
+import sqlalchemy as _sa
+import migrate as _migrate_mod
+
+# A pre-auth, pre-status database: tables exist but lack later columns, and
+# the single profile has no account yet.
+_legacy_fd, _legacy_path = tempfile.mkstemp(suffix="_fitlocal_legacy.db")
+os.close(_legacy_fd)
+_legacy = _sqlite3.connect(_legacy_path)
+_legacy.executescript("""
+    CREATE TABLE account (id INTEGER PRIMARY KEY, email VARCHAR(255) UNIQUE NOT NULL,
+        password_hash VARCHAR(255), google_id VARCHAR(255), created_at DATETIME,
+        is_admin BOOLEAN, email_claimed BOOLEAN);
+    CREATE TABLE user_profile (id INTEGER PRIMARY KEY, name VARCHAR(100) NOT NULL, age INTEGER NOT NULL,
+        sex VARCHAR(20) NOT NULL, fitness_level VARCHAR(20) NOT NULL, goals TEXT NOT NULL,
+        created_at DATETIME, updated_at DATETIME);
+    CREATE TABLE workout_plan (id INTEGER PRIMARY KEY, user_id INTEGER NOT NULL, name VARCHAR(200) NOT NULL,
+        description TEXT, days_per_week INTEGER, plan_json TEXT NOT NULL, is_active BOOLEAN,
+        created_at DATETIME, notes TEXT);
+    CREATE TABLE workout_session (id INTEGER PRIMARY KEY, user_id INTEGER NOT NULL, planned_workout_id INTEGER,
+        date DATE, start_time DATETIME, end_time DATETIME, overall_feeling INTEGER, session_notes TEXT);
+    CREATE TABLE logged_set (id INTEGER PRIMARY KEY, session_id INTEGER NOT NULL, exercise_name VARCHAR(200) NOT NULL,
+        set_number INTEGER NOT NULL, weight_lbs FLOAT, reps_completed INTEGER, rpe INTEGER, notes TEXT);
+    INSERT INTO user_profile (name, age, sex, fitness_level, goals) VALUES ('Legacy', 40, 'Male', 'Beginner', 'Move');
+    INSERT INTO workout_plan (user_id, name, plan_json, is_active) VALUES (1, 'Old', '{}', 1);
+""")
+_legacy.commit()
+_legacy.close()
+
+_legacy_engine = _sa.create_engine(f"sqlite:///{_legacy_path}")
+_applied = _migrate_mod.migrate(_legacy_engine)
+check("Legacy DB: every migration applied in order", _applied == [v for v, _, _ in _migrate_mod.MIGRATIONS])
+with _legacy_engine.connect() as _lc:
+    _ws_cols = {r[1] for r in _lc.exec_driver_sql("PRAGMA table_info(workout_session)")}
+    check("Legacy DB: workout_session gained status/phase_name",
+          {"status", "phase_name", "elapsed_seconds"} <= _ws_cols)
+    check("Legacy DB: workout_plan.status backfilled from is_active",
+          _lc.exec_driver_sql("SELECT status FROM workout_plan").scalar() == "active")
+    check("Legacy DB: missing tables created",
+          _lc.exec_driver_sql("SELECT 1 FROM sqlite_master WHERE name='exercise_library'").first() is not None)
+    check("Legacy DB: hot-path index created",
+          _lc.exec_driver_sql(
+              "SELECT 1 FROM sqlite_master WHERE name='ix_workout_session_user_status_date'"
+          ).first() is not None)
+    _linked = _lc.exec_driver_sql(
+        "SELECT a.email, a.email_claimed FROM user_profile p JOIN account a ON a.id = p.account_id"
+    ).first()
+    check("Legacy DB: profile linked to an unclaimed account",
+          _linked is not None and _linked[0] == "local@fitlocal.local" and not _linked[1])
+    check("Legacy DB: schema_version recorded at latest",
+          _lc.exec_driver_sql("SELECT max(version) FROM schema_version").scalar()
+          == _migrate_mod.latest_version())
+
+# Same process, same engine: no queries at all
+check("Re-migrating a migrated engine in-process is a no-op", _migrate_mod.migrate(_legacy_engine) == [])
+
+# A new process (simulated by forgetting the engine) pays exactly one version check
+_migrate_mod._migrated.discard(str(_legacy_engine.url))
+_mig_stmts = []
+
+
+def _mig_rec(conn, cursor, statement, parameters, context, executemany):
+    _mig_stmts.append(statement)
+
+
+_sa_event.listen(_legacy_engine, "before_cursor_execute", _mig_rec)
+_second = _migrate_mod.migrate(_legacy_engine)
+_sa_event.remove(_legacy_engine, "before_cursor_execute", _mig_rec)
+check("Up-to-date DB applies nothing", _second == [])
+check(f"Up-to-date DB costs a single version check ({len(_mig_stmts)} statements)", len(_mig_stmts) == 1)
+_legacy_engine.dispose()
+os.unlink(_legacy_path)
+
+# Two processes booting at once against a fresh file serialize on the lock
+_race_fd, _race_path = tempfile.mkstemp(suffix="_fitlocal_race.db")
+os.close(_race_fd)
+# Two spellings of the same file, so the in-process "already migrated" memo
+# cannot short-circuit the second engine.
+_race_engines = [
+    _sa.create_engine(f"sqlite:///{_race_path}"),
+    _sa.create_engine(f"sqlite:///{os.path.join(os.path.dirname(_race_path), '.', os.path.basename(_race_path))}"),
+]
+_race_errors = []
+
+
+def _race(engine):
+    try:
+        _migrate_mod.migrate(engine)
+    except Exception as _re_exc:  # noqa: BLE001
+        _race_errors.append(_re_exc)
+
+
+_race_threads = [_threading.Thread(target=_race, args=(e,)) for e in _race_engines]
+for _t in _race_threads:
+    _t.start()
+for _t in _race_threads:
+    _t.join()
+with _race_engines[0].connect() as _rc:
+    _race_rows = _rc.exec_driver_sql("SELECT count(*) FROM schema_version").scalar()
+check(f"Concurrent boots raise no errors {_race_errors or ''}", not _race_errors)
+check("Concurrent boots record each migration exactly once", _race_rows == len(_migrate_mod.MIGRATIONS))
+for _e in _race_engines:
+    _e.dispose()
+os.unlink(_race_path)
+
+# ── SQLite engine profile ──────────────────────────────────────────────────────
+print("\n--- SQLite Engine Profile ---")
+
+import sqlite_profile as _sp
+
+with app.app_context():
+    _live = _sp.current_pragmas(db.session.connection())
+    check(f"Production profile active by default ({app.config['SQLITE_PROFILE']})",
+          app.config["SQLITE_PROFILE"] == "production")
+    check("journal_mode=WAL on app connections", str(_live["journal_mode"]).lower() == "wal")
+    check("busy_timeout=5000 on app connections", _live["busy_timeout"] == 5000)
+    check("synchronous=NORMAL on app connections", _live["synchronous"] == 1)
+    check("temp_store=MEMORY on app connections", _live["temp_store"] == 2)
+    check("cache_size tuned on app connections", _live["cache_size"] == -16000)
+    check("Pool sized for workers x threads", db.engine.pool.size() == 5)
+
+check("Default profile leaves engine options alone",
+      _sp.engine_options("default", "sqlite:///x.db") == {})
+check("In-memory databases get no pool options",
+      _sp.engine_options("production", "sqlite:///:memory:") == {})
+try:
+    _sp.engine_options("turbo", "sqlite:///x.db")
+    check("Unknown profile rejected", False)
+except ValueError:
+    check("Unknown profile rejected", True)
+
+_default_engine = _sa.create_engine("sqlite:///" + _db_path)
+_sp.install_pragmas(_default_engine, "default")
+with _default_engine.connect() as _dc:
+    check("Default profile keeps SQLite's temp_store (0) and synchronous (FULL)",
+          _dc.exec_driver_sql("PRAGMA temp_store").scalar() == 0
+          and _dc.exec_driver_sql("PRAGMA synchronous").scalar() == 2)
+_default_engine.dispose()
+
+# ── Exercise performance summary table ─────────────────────────────────────────
+print("\n--- Exercise Performance Summary ---")
+
+from models import ExercisePerformance as _EP
+
+with app.app_context():
+    from app import get_performance_history as _gph, _build_workout_context as _bwc
+    _ep_profile = UserProfile.query.first()
+    _ep_completed = WorkoutSession.query.filter_by(user_id=_ep_profile.id, status="completed").all()
+    _ep_expected = {
+        (s.id, ls.exercise_name) for s in _ep_completed for ls in s.logged_sets
+    }
+    _ep_rows = {(r.session_id, r.exercise_name) for r in _EP.query.filter_by(user_id=_ep_profile.id)}
+    check("Summary has a row per completed (session, exercise)", _ep_rows == _ep_expected)
+    _ep_paused_ids = {s.id for s in WorkoutSession.query.filter_by(status="paused")}
+    check("Paused sessions are not summarized", not any(sid in _ep_paused_ids for sid, _ in _ep_rows))
+
+    # Matches the join it replaces, for every exercise the user has logged
+    _ep_names = sorted({name for _, name in _ep_expected})
+    _ep_hist = _gph(_ep_profile.id, _ep_names, limit=3)
+    _ep_mismatch = []
+    for _name in _ep_names:
+        _ref = (
+            WorkoutSession.query.join(LoggedSet)
+            .filter(WorkoutSession.user_id == _ep_profile.id, LoggedSet.exercise_name == _name,
+                    WorkoutSession.status == "completed")
+            .order_by(WorkoutSession.date.desc(), WorkoutSession.id.desc()).first()
+        )
+        _ref_sets = {ls.set_number: (ls.weight_lbs, ls.reps_completed, ls.weight_b, ls.reps_b, ls.rpe)
+                     for ls in _ref.logged_sets if ls.exercise_name == _name}
+        _got = _ep_hist[_name][0]
+        _got_sets = {k: (v["weight"], v["reps"], v["weight_b"], v["reps_b"], v["rpe"])
+                     for k, v in _got["sets"].items()}
+        if _got["date"] != _ref.date or _got_sets != _ref_sets:
+            _ep_mismatch.append(_name)
+    check(f"Summary lookups match the logged_set join {_ep_mismatch or ''}", not _ep_mismatch)
+    check("History is capped at the requested limit", all(len(v) <= 3 for v in _ep_hist.values()))
+    _ep_order_mismatch = []
+    for _name in _ep_names:
+        _ref_dates = [
+            s.date for s in WorkoutSession.query
+            .filter(WorkoutSession.user_id == _ep_profile.id,
+                    WorkoutSession.logged_sets.any(LoggedSet.exercise_name == _name),
+                    WorkoutSession.status == "completed")
+            .order_by(WorkoutSession.date.desc(), WorkoutSession.id.desc()).limit(3)
+        ]
+        if [sess["date"] for sess in _ep_hist[_name]] != _ref_dates:
+            _ep_order_mismatch.append(_name)
+    check(f"Recent sessions match the last-3 query, newest first {_ep_order_mismatch or ''}",
+          not _ep_order_mismatch)
+    check("Zero limit returns no history", _gph(_ep_profile.id, _ep_names, limit=0) == {})
+
+    _ep_stmts = _captured_sql(lambda: _gph(_ep_profile.id, _ep_names, limit=3))
+    check(f"All exercises' history in one query ({len(_ep_stmts)})", len(_ep_stmts) == 1)
+    check("History query ranks with ROW_NUMBER()",
+          any("row_number() over" in _st.lower() for _st, _ in _ep_stmts))
+    check("History read never touches logged_set",
+          all("logged_set" not in _st for _st, _ in _ep_stmts))
+
+    _ep_plan = _qp_gap(_ep_profile.id)
+    _ep_pw = PlannedWorkout.query.filter_by(plan_id=_ep_plan.id).order_by(PlannedWorkout.order_index).first()
+    with app.test_request_context():
+        _ep_ctx_stmts = _captured_sql(lambda: _bwc(_ep_profile, _ep_pw, _ep_plan))
+    _ep_perf_stmts = [_st for _st, _ in _ep_ctx_stmts if "exercise_performance" in _st or "logged_set" in _st]
+    check(f"Workout page reads performance in one query ({len(_ep_perf_stmts)})", len(_ep_perf_stmts) == 1)
+    _ep_pw_id = _ep_pw.id
+    _ep_first_ex = PlannedExercise.query.filter_by(planned_workout_id=_ep_pw_id).first().exercise_name
+
+# Logging, pausing, finishing and deleting keep the summary in step
+_ep_form = [
+    ("planned_workout_id", str(_ep_pw_id)), ("overall_feeling", "4"), ("session_notes", ""),
+    ("session_elapsed_seconds", "60"), ("resume_session_id", ""),
+    ("exercise_name", _ep_first_ex), ("set_number", "1"), ("weight", "321"), ("reps", "3"),
+    ("rpe", "9"), ("set_notes", "summary probe"),
+]
+client.post("/workout/pause", data=MultiDict(_ep_form))
+with app.app_context():
+    _ep_paused = WorkoutSession.query.filter_by(status="paused").order_by(WorkoutSession.id.desc()).first()
+    _ep_paused_id = _ep_paused.id
+    check("Pausing writes no summary rows", _EP.query.filter_by(session_id=_ep_paused_id).count() == 0)
+client.post(f"/workout/finish-paused/{_ep_paused_id}")
+with app.app_context():
+    _ep_row = _EP.query.filter_by(session_id=_ep_paused_id, exercise_name=_ep_first_ex).first()
+    check("Finishing a paused session summarizes it",
+          _ep_row is not None and json.loads(_ep_row.sets_json)["1"][0] == 321.0)
+    check("Finished session appears in recent performance",
+          any(sess["sets"].get(1, {}).get("notes") == "summary probe"
+              for sess in _gph(_ep_profile.id, [_ep_first_ex], limit=100)[_ep_first_ex]))
+
+# A new paused session auto-completes the previous paused one through a bulk UPDATE
+client.post("/workout/pause", data=MultiDict(_ep_form))
+with app.app_context():
+    _ep_first_paused = WorkoutSession.query.filter_by(status="paused").order_by(WorkoutSession.id.desc()).first().id
+client.post("/workout/pause", data=MultiDict(_ep_form))
+with app.app_context():
+    check("Auto-completed paused session is summarized",
+          _EP.query.filter_by(session_id=_ep_first_paused).count() == 1)
+    _ep_second_paused = WorkoutSession.query.filter_by(status="paused").first().id
+client.post(f"/workout/finish-paused/{_ep_second_paused}")
+
+client.post(f"/history/{_ep_paused_id}/delete")
+with app.app_context():
+    check("Deleting a session removes its summary rows",
+          _EP.query.filter_by(session_id=_ep_paused_id).count() == 0)
+
+# ── Plan progress counters ─────────────────────────────────────────────────────
+print("\n--- Plan Progress Counters ---")
+
+from models import PlanProgress as _PP
+import summaries as _summaries
+
+
+def _pp_expected(plan):
+    """(phase tag, count, last workout id) per phase, straight from workout_session."""
+    sessions = (
+        WorkoutSession.query.join(PlannedWorkout)
+        .filter(PlannedWorkout.plan_id == plan.id, WorkoutSession.user_id == plan.user_id,
+                WorkoutSession.status == "completed")
+        .order_by(WorkoutSession.date, WorkoutSession.id).all()
+    )
+    out = {}
+    for sess in sessions:
+        count, _ = out.get(sess.phase_name or "", (0, None))
+        out[sess.phase_name or ""] = (count + 1, sess.planned_workout_id)
+    return out
+
+
+def _pp_rows(plan):
+    return {r.phase_name: (r.completed_count, r.last_planned_workout_id)
+            for r in _PP.query.filter_by(plan_id=plan.id)}
+
+
+with app.app_context():
+    _pp_profile = UserProfile.query.first()
+    _pp_plan = _qp_gap(_pp_profile.id)
+    check("Counters match a recount of completed sessions", _pp_rows(_pp_plan) == _pp_expected(_pp_plan))
+
+    _pp_stmts = _captured_sql(lambda: _qp_rpp(_pp_profile.id, _pp_plan))
+    check(f"resolve_plan_position runs two queries ({len(_pp_stmts)})", len(_pp_stmts) == 2)
+    check("resolve_plan_position never reads workout_session",
+          all("workout_session" not in _st for _st, _ in _pp_stmts))
+
+    _pp_before = _qp_rpp(_pp_profile.id, _pp_plan)
+    _pp_pw = PlannedWorkout.query.filter_by(plan_id=_pp_plan.id).order_by(PlannedWorkout.order_index).first()
+    _pp_phase = _pp_before["phase_data"]["phase_name"] if _pp_before["phase_data"] else None
+    _pp_sess = WorkoutSession(user_id=_pp_profile.id, planned_workout_id=_pp_pw.id,
+                              date=date.today() + timedelta(days=400), status="completed",
+                              phase_name=_pp_phase)
+    db.session.add(_pp_sess)
+    db.session.commit()
+    _pp_after = _qp_rpp(_pp_profile.id, _pp_plan)
+    check("Logging a session bumps the phase count",
+          _pp_after["workouts_done_in_phase"] == _pp_before["workouts_done_in_phase"] + 1
+          or _pp_after["phase_index"] != _pp_before["phase_index"])
+    check("Counters follow inserts", _pp_rows(_pp_plan) == _pp_expected(_pp_plan))
+
+    _pp_sess.status = "paused"
+    db.session.commit()
+    check("Counters follow status changes", _pp_rows(_pp_plan) == _pp_expected(_pp_plan))
+    _pp_sess.status = "completed"
+    _pp_sess.phase_name = "Progress Probe"
+    db.session.commit()
+    check("Counters follow phase retagging",
+          _pp_rows(_pp_plan) == _pp_expected(_pp_plan) and _pp_rows(_pp_plan)["Progress Probe"][0] == 1)
+    WorkoutSession.query.filter_by(id=_pp_sess.id).delete()
+    db.session.commit()
+    check("Counters follow bulk deletes", _pp_rows(_pp_plan) == _pp_expected(_pp_plan))
+    check("Position is back where it started", _qp_rpp(_pp_profile.id, _pp_plan) == _pp_before)
+
+    with db.engine.begin() as _pp_conn:
+        _pp_conn.exec_driver_sql("DELETE FROM plan_progress")
+        _summaries.rebuild_plan_progress(_pp_conn)
+    check("Rebuild reproduces the trigger-maintained counters",
+          _pp_rows(_pp_plan) == _pp_expected(_pp_plan))
+
+# ── Request-scoped memo ────────────────────────────────────────────────────────
+print("\n--- Request-Scoped Memo ---")
+
+
+def _page_lookups(path):
+    """GET path; count the profile, active-plan and plan-progress lookups it ran."""
+    with app.app_context():
+        _stmts = [_st for _st, _ in _captured_sql(lambda: client.get(path))]
+    return {
+        "profile": sum(1 for _st in _stmts if "FROM user_profile" in _st and "account_id = ?" in _st),
+        "active_plan": sum(1 for _st in _stmts if "FROM workout_plan" in _st and "workout_plan.status = ?" in _st),
+        "position": sum(1 for _st in _stmts if "FROM plan_progress" in _st),
+    }
+
+
+for _path in ("/", "/workout/today", "/calendar"):
+    _lookups = _page_lookups(_path)
+    for _what, _n in _lookups.items():
+        check(f"GET {_path} resolves {_what} at most once ({_n})", _n <= 1)
+check("GET / resolves the plan position exactly once", _page_lookups("/")["position"] == 1)
+
+with app.app_context():
+    from app import get_active_plan as _rm_gap, get_plan_data as _rm_gpd
+    _rm_profile = UserProfile.query.first()
+    with app.test_request_context():
+        _rm_plan = _rm_gap(_rm_profile.id)
+        check("Memo hands back the same active plan", _rm_gap(_rm_profile.id) is _rm_plan)
+        _qp_rpp(_rm_profile.id, _rm_plan)
+        check("Repeat plan and position lookups run no queries",
+              not _captured_sql(lambda: (_rm_gap(_rm_profile.id), _qp_rpp(_rm_profile.id, _rm_plan))))
+        check("Parsed plan_json is shared within the request", _rm_gpd(_rm_plan) is _rm_gpd(_rm_plan))
+
+        _rm_plan.status = "inactive"
+        db.session.flush()
+        check("A flushed write drops the memo", _rm_gap(_rm_profile.id) is None)
+        WorkoutPlan.query.filter_by(id=_rm_plan.id).update({"status": "active"})
+        check("A bulk update drops the memo", _rm_gap(_rm_profile.id) is not None)
+        db.session.commit()
+    with app.test_request_context():
+        _rm_stmts = _captured_sql(lambda: (_rm_gap(_rm_profile.id), _rm_gap(_rm_profile.id)))
+        check(f"Each request starts with an empty memo ({len(_rm_stmts)})", len(_rm_stmts) == 1)
+    check("No memo outside a request",
+          len(_captured_sql(lambda: (_rm_gap(_rm_profile.id), _rm_gap(_rm_profile.id)))) == 2)
+
+# ── Parsed plan cache ──────────────────────────────────────────────────────────
+print("\n--- Parsed Plan Cache ---")
+
+from plan_cache import PlanCache as _PlanCache, FrozenDict as _FrozenDict, parsed_plans as _parsed_plans
+
+_pc = _PlanCache(max_bytes=1024 * 1024)
+_pc_json = json.dumps({"plan_name": "Cache Probe", "phases": [{"phase_name": "A"}], "workouts": [{"name": "W"}]})
+_pc_first = _pc.get(1, _pc_json)
+_pc_again = _pc.get(1, _pc_json)
+check("Repeat lookup returns the cached object", _pc_again is _pc_first)
+check("Hit and miss are counted", _pc.stats()["hits"] == 1 and _pc.stats()["misses"] == 1)
+check("Parsed plan is a FrozenDict with tuples", isinstance(_pc_first, _FrozenDict)
+      and isinstance(_pc_first["phases"], tuple) and isinstance(_pc_first["phases"][0], _FrozenDict))
+try:
+    _pc_first["plan_name"] = "changed"
+    _pc_mutated = True
+except TypeError:
+    _pc_mutated = False
+check("Cached plan rejects mutation", not _pc_mutated and _pc_first["plan_name"] == "Cache Probe")
+check("Frozen plan still serializes", json.loads(json.dumps(_pc_first)) == json.loads(_pc_json))
+check("Edited plan_json is a new entry", _pc.get(1, _pc_json.replace("Probe", "Edit"))["plan_name"] == "Cache Edit")
+check("Malformed or empty plan_json parses to an empty plan",
+      _pc.get(2, "{not json") == {} and _pc.get(3, None) == {} and _pc.get(4, "[1, 2]") == {})
+check("Size accounting tracks entries", _pc.stats()["bytes"] > 0 and _pc.stats()["entries"] == 4)
+
+_pc_one = _PlanCache()
+_pc_one.get(1, _pc_json)
+_pc_small = _PlanCache(max_bytes=_pc_one.stats()["bytes"] * 5 // 2)  # room for two plans
+for _i in range(6):
+    _pc_small.get(_i, _pc_json)
+_pc_stats = _pc_small.stats()
+check("LRU stays under its byte budget", _pc_stats["bytes"] <= _pc_stats["max_bytes"])
+check("Evictions are counted", _pc_stats["evictions"] > 0)
+check("Least recently used entries are evicted first",
+      _pc_stats["entries"] == 2 and _pc_small.get(5, _pc_json) is not None and _pc_small.stats()["hits"] == 1)
+
+_parsed_plans.clear()
+for _path in ("/", "/calendar", "/plan/history"):
+    client.get(_path)
+_pc_warm = _parsed_plans.stats()
+for _path in ("/", "/calendar", "/plan/history"):
+    client.get(_path)
+_pc_after = _parsed_plans.stats()
+check(f"Pages reuse parsed plans after the first visit ({_pc_after})",
+      _pc_after["misses"] == _pc_warm["misses"] and _pc_after["hits"] > _pc_warm["hits"])
+
+# ── Unclaimed account gate ─────────────────────────────────────────────────────
+print("\n--- Unclaimed Account Gate ---")
+
+from app import redirect_unclaimed_account as _rua, install_claim_gate as _install_gate
+from claim_gate import unclaimed_gate as _gate, read_generation as _read_gen
+
+
+def _gate_hooked():
+    return _rua in app.before_request_funcs.get(None, [])
+
+
+def _gate_sql(path, c=client):
+    with app.app_context():
+        _stmts = _captured_sql(lambda: c.get(path))
+    return [_st for _st, _ in _stmts if "user_version" in _st or "WHERE account.email_claimed" in _st]
+
+
+check("No unclaimed account at boot: gate is off the request path", not _gate_hooked())
+check("Claimed database: zero gate queries per request", _gate_sql("/") == [])
+
+
+def _open_gate():
+    with app.app_context():
+        _legacy = Account(email="local@fitlocal.local", email_claimed=False)
+        db.session.add(_legacy)
+        db.session.commit()
+        _install_gate()
+        return _legacy.id
+
+
+_ug_id = _open_gate()
+check("Unclaimed account installs the gate", _gate_hooked() and _gate.is_open)
+r = client.get("/")
+check("Unclaimed account redirects to /claim-account",
+      r.status_code == 302 and "/claim-account" in r.headers.get("Location", ""))
+_ug_sql = _gate_sql("/")
+check(f"Open gate reads only the generation marker ({_ug_sql})",
+      len(_ug_sql) == 1 and "user_version" in _ug_sql[0])
+
+# Another worker claims: this process notices through the generation marker
+with app.app_context(), db.engine.begin() as _ug_conn:
+    _ug_conn.exec_driver_sql("UPDATE account SET email_claimed = 1 WHERE id = ?", (_ug_id,))
+    _ug_conn.exec_driver_sql(f"PRAGMA user_version = {_read_gen(_ug_conn) + 1}")
+r = client.get("/")
+check("Claim by another process is picked up", r.status_code == 200 and not _gate.is_open)
+check("Closed gate drops itself from the request path", not _gate_hooked())
+check("Closed gate makes no further queries", _gate_sql("/") == [])
+
+# Claiming through /claim-account bumps the marker and closes the gate
+with app.app_context():
+    db.session.delete(db.session.get(Account, _ug_id))
+    db.session.commit()
+_ug_id = _open_gate()
+with app.app_context(), db.engine.connect() as _ug_conn:
+    _ug_gen = _read_gen(_ug_conn)
+_ug_client = app.test_client()
+r = _ug_client.post("/claim-account", data={
+    "email": "claimed@fitlocal.test", "password": "claimpass1", "confirm_password": "claimpass1",
+})
+with app.app_context():
+    with db.engine.connect() as _ug_conn:
+        check("Claiming bumps the generation marker", _read_gen(_ug_conn) == _ug_gen + 1)
+    check("Claim is saved", db.session.get(Account, _ug_id).email_claimed)
+check("Claimed owner lands on the app", _ug_client.get("/").status_code in (200, 302)
+      and not _gate.is_open and not _gate_hooked())
+r = _ug_client.get("/claim-account")
+check("Claim page redirects away once claimed", r.status_code == 302 and "/claim-account" not in r.headers["Location"])
+with app.app_context():
+    db.session.delete(db.session.get(Account, _ug_id))
+    db.session.commit()
+
+# ── Identity cache ─────────────────────────────────────────────────────────────
+print("\n--- Identity Cache ---")
+
+from identity_cache import identities as _identities, load_identity as _load_identity
+
+
+def _identity_sql(path, c=client):
+    with app.app_context():
+        _stmts = _captured_sql(lambda: c.get(path))
+    return [_st for _st, _ in _stmts if "FROM account" in _st or "FROM user_profile" in _st]
+
+
+_ic_sql = _identity_sql("/calendar")
+check(f"Account and profile load in one joined query ({len(_ic_sql)})",
+      len(_ic_sql) == 1 and "JOIN user_profile" in _ic_sql[0])
+
+with app.app_context():
+    _ic_account = _load_identity(test_account_id)
+    _ic_profile_sql = _captured_sql(lambda: _ic_account.profile)
+    check("Loaded account carries its profile without a lazy load",
+          _ic_account.profile is not None and _ic_account.profile.account_id == test_account_id
+          and _ic_profile_sql == [])
+    check("Unknown account loads as None", _load_identity(999999) is None)
+
+_identities.configure(30)
+_identity_sql("/calendar")
+_ic_sql = _identity_sql("/calendar")
+check(f"TTL cache: repeat request makes no identity queries ({_ic_sql})", _ic_sql == [])
+check("TTL cache counts the hit", _identities.stats()["hits"] >= 1)
+
+with app.app_context():
+    _ic_name = UserProfile.query.filter_by(account_id=test_account_id).first().name
+client.post("/setup", data={
+    "name": "Cache Probe", "age": "35", "sex": "Male",
+    "fitness_level": "Intermediate", "goals": "Build muscle, get lean",
+})
+check("Profile edit evicts the cached identity", _identity_sql("/calendar") != [])
+with app.app_context():
+    check("Cached profile reflects the edit",
+          _load_identity(test_account_id).profile.name == "Cache Probe")
+client.post("/setup", data={
+    "name": _ic_name, "age": "35", "sex": "Male",
+    "fitness_level": "Intermediate", "goals": "Build muscle, get lean",
+})
+
+with app.app_context():
+    _load_identity(test_account_id)
+    UserProfile.query.filter_by(account_id=test_account_id).update({"age": 36})
+    db.session.commit()
+    check("Bulk profile update evicts the cache",
+          _load_identity(test_account_id).profile.age == 36)
+    UserProfile.query.filter_by(account_id=test_account_id).update({"age": 35})
+    db.session.commit()
+
+# A profile created after the identity loaded shows through it before the commit
+with app.app_context():
+    _ic_fresh = Account(email="fresh@fitlocal.test", email_claimed=True)
+    db.session.add(_ic_fresh)
+    db.session.commit()
+    _ic_fresh_account = _load_identity(_ic_fresh.id)
+    _ic_new_profile = UserProfile(account_id=_ic_fresh.id, name="Fresh", age=30, sex="Female",
+                                  fitness_level="Beginner", goals="Move more")
+    db.session.add(_ic_new_profile)
+    db.session.flush()
+    check("Profile created in the same request is visible", _ic_fresh_account.profile is _ic_new_profile)
+    db.session.delete(_ic_new_profile)
+    db.session.flush()
+    check("Profile deleted in the same request is gone", _ic_fresh_account.profile is None)
+    db.session.delete(_ic_fresh_account)
+    db.session.commit()
+
+# Deleting an account removes it from the cache
+_ic_client = app.test_client()
+with app.app_context():
+    _ic_doomed = Account(email="doomed@fitlocal.test", email_claimed=True)
+    db.session.add(_ic_doomed)
+    db.session.commit()
+    _ic_doomed_id = _ic_doomed.id
+with _ic_client.session_transaction() as sess:
+    sess['_user_id'] = str(_ic_doomed_id)
+    sess['_fresh'] = True
+_ic_client.get("/settings/delete-account")
+_ic_client.post("/settings/delete-account", data={"confirm_email": "doomed@fitlocal.test"})
+with app.app_context():
+    check("Deleted account is not served from the cache", _load_identity(_ic_doomed_id) is None)
+r = _ic_client.get("/")
+check("Deleted account's session is logged out",
+      r.status_code == 302 and "/login" in r.headers.get("Location", ""))
+
+_identities.configure(0)
+_identities.clear()
+
+# ── Session index ──────────────────────────────────────────────────────────────
+print("\n--- Session Index ---")
+
+from app import get_session_index as _gsi, get_mini_calendar as _gmc, build_month_calendar as _bmc
+
+with app.app_context():
+    _si_profile = UserProfile.query.filter_by(account_id=test_account_id).first()
+    _si_sessions = WorkoutSession.query.filter_by(user_id=_si_profile.id).all()
+    _si_start = min(s.date for s in _si_sessions)
+    _si_end = max(s.date for s in _si_sessions)
+    _si_index = _gsi(_si_profile.id, _si_start, _si_end)
+    _si_expected = {}
+    for _s in sorted(_si_sessions, key=lambda s: (s.date, s.id)):
+        _si_expected.setdefault(_s.date, []).append((
+            _s.id, _s.status, _s.phase_name,
+            _s.planned_workout.workout_name if _s.planned_workout else None,
+            _s.planned_workout.plan_id if _s.planned_workout else None,
+        ))
+    _si_got = {d: [(s["id"], s["status"], s["phase_name"], s["workout_name"], s["plan_id"]) for s in day]
+               for d, day in _si_index.items()}
+    check("Session index matches per-session lookups", _si_got == _si_expected)
+    check("Status filter keeps only those statuses",
+          all(s["status"] == "completed"
+              for day in _gsi(_si_profile.id, _si_start, _si_end, statuses=("completed",)).values()
+              for s in day))
+    check("Empty range has no days",
+          _gsi(_si_profile.id, _si_end + timedelta(days=1), _si_end + timedelta(days=30)) == {})
+
+    _si_stmts = _captured_sql(lambda: _gmc(_si_profile.id))
+    check(f"Mini calendar reads sessions in one query ({len(_si_stmts)})", len(_si_stmts) == 1)
+
+    db.session.expire_all()
+    _si_stmts = _captured_sql(lambda: _bmc(_si_profile.id, _si_end.year, _si_end.month))
+    _si_session_stmts = [_st for _st, _ in _si_stmts if "FROM workout_session" in _st]
+    check(f"Month calendar reads sessions in one query ({len(_si_session_stmts)})", len(_si_session_stmts) == 1)
+    check("Month calendar makes no per-session planned_workout loads",
+          not any(_st.lstrip().startswith("SELECT planned_workout.") for _st, _ in _si_stmts))
+
+# ── History pages and session aggregates ───────────────────────────────────────
+print("\n--- History Pagination ---")
+
+from app import get_history_page as _ghp
+
+with app.app_context():
+    _hp_profile = UserProfile.query.filter_by(account_id=test_account_id).first()
+    _hp_bad = []
+    for _s in WorkoutSession.query.filter_by(user_id=_hp_profile.id):
+        _vol = sum((ls.weight_lbs or 0) * (ls.reps_completed or 0) + (ls.weight_b or 0) * (ls.reps_b or 0)
+                   for ls in _s.logged_sets)
+        _dur = (round((_s.end_time - _s.start_time).total_seconds())
+                if _s.start_time and _s.end_time else None)
+        _expected = (len(_s.logged_sets), round(_vol, 3), _dur)
+        if (_s.set_count, round(_s.total_volume, 3), _s.duration_seconds) != _expected:
+            _hp_bad.append(_s.id)
+    check(f"Session aggregates match their sets and times {_hp_bad or ''}", not _hp_bad)
+
+    _hp_session = WorkoutSession.query.filter_by(user_id=_hp_profile.id).first()
+    _hp_before = (_hp_session.set_count, _hp_session.total_volume)
+    db.session.add(LoggedSet(session_id=_hp_session.id, exercise_name="Aggregate Probe",
+                             set_number=99, weight_lbs=100, reps_completed=5))
+    db.session.commit()
+    check("Logging a set updates the session's aggregates",
+          (_hp_session.set_count, _hp_session.total_volume) == (_hp_before[0] + 1, _hp_before[1] + 500))
+    LoggedSet.query.filter_by(session_id=_hp_session.id, exercise_name="Aggregate Probe").delete()
+    db.session.commit()
+    check("Deleting a set restores them", (_hp_session.set_count, _hp_session.total_volume) == _hp_before)
+
+    # Walking every page visits each session once, newest first
+    _hp_expected = [s.id for s in WorkoutSession.query.filter_by(user_id=_hp_profile.id)
+                    .order_by(WorkoutSession.date.desc(), WorkoutSession.id.desc())]
+    _hp_seen, _hp_cursor, _hp_pages = [], None, 0
+    while True:
+        _hp_page, _hp_cursor = _ghp(_hp_profile.id, _hp_cursor, page_size=2)
+        _hp_seen += [s.id for s in _hp_page]
+        _hp_pages += 1
+        if not _hp_cursor or _hp_pages > len(_hp_expected):
+            break
+    check(f"Keyset pages cover the history in order ({_hp_pages} pages)", _hp_seen == _hp_expected)
+    check("Malformed cursor starts from the newest session",
+          [s.id for s in _ghp(_hp_profile.id, "not-a-cursor", page_size=2)[0]] == _hp_expected[:2])
+
+    db.session.expire_all()
+    _hp_stmts = _captured_sql(lambda: client.get("/history"))
+_hp_lazy = [_st for _st, _ in _hp_stmts
+            if "FROM logged_set" in _st or _st.lstrip().startswith("SELECT planned_workout.")]
+check(f"History page does no per-session loads ({len(_hp_lazy)})", not _hp_lazy)
+check("History page reads sessions in one query",
+      len([_st for _st, _ in _hp_stmts if "FROM workout_session" in _st]) == 1)
+
+with app.app_context():
+    _, _hp_first_cursor = _ghp(_hp_profile.id, page_size=1)
+r = client.get(f"/history?before={_hp_first_cursor}&partial=1")
+_hp_json = r.get_json()
+check("Partial history returns the next page's rows as JSON",
+      r.status_code == 200 and "link-row" in _hp_json["html"] and "<h1>" not in _hp_json["html"])
+
+# ── Plan lists ─────────────────────────────────────────────────────────────────
+print("\n--- Plan Lists ---")
+
+from app import get_plan_list as _gpl
+import summaries as _summaries_pl
+
+with app.app_context():
+    _pl_profile = UserProfile.query.filter_by(account_id=test_account_id).first()
+    _pl_plans = WorkoutPlan.query.filter(WorkoutPlan.user_id == _pl_profile.id,
+                                         WorkoutPlan.status.in_(["active", "inactive"])).all()
+    check(f"Test user has past plans to list ({len(_pl_plans)})", len(_pl_plans) >= 2)
+    _pl_bad = [p.id for p in _pl_plans
+               if {"phase_count": p.phase_count, "total_sessions": p.total_sessions,
+                   "workout_names": p.workout_names} != _summaries_pl.plan_summary_columns(json.loads(p.plan_json))]
+    check(f"Activated plans carry their summary columns {_pl_bad or ''}", not _pl_bad)
+
+    _pl_entries = _gpl(_pl_profile.id, ["active", "inactive"])
+    _pl_count_bad = []
+    for _entry in _pl_entries:
+        _ref = WorkoutSession.query.filter(
+            WorkoutSession.user_id == _pl_profile.id,
+            WorkoutSession.planned_workout_id.in_([w.id for w in _entry["plan"].planned_workouts]),
+            WorkoutSession.status == "completed",
+        ).count()
+        if _ref != _entry["session_count"]:
+            _pl_count_bad.append(_entry["plan"].id)
+    check(f"Grouped session counts match per-plan counts {_pl_count_bad or ''}", not _pl_count_bad)
+    check("Workouts are listed in plan order",
+          all([w.order_index for w in e["workouts"]] == sorted(w.order_index for w in e["workouts"])
+              for e in _pl_entries))
+
+    db.session.expire_all()
+    _pl_one = _captured_sql(lambda: _gpl(_pl_profile.id, ["active"]))
+    db.session.expire_all()
+    _pl_all = _captured_sql(lambda: _gpl(_pl_profile.id, ["active", "inactive"]))
+    check(f"Plan list query count does not grow with plans ({len(_pl_one)} vs {len(_pl_all)})",
+          len(_pl_all) == len(_pl_one))
+
+    db.session.expire_all()
+    _parsed_plans.clear()
+    _pl_stmts = _captured_sql(lambda: client.get("/plan/history"))
+check("Plan history parses no plan_json", _parsed_plans.stats()["misses"] == 0)
+check(f"Plan history runs a constant handful of queries ({len(_pl_stmts)})", len(_pl_stmts) <= 10)
+
+# An older activation has no TrainingPhase rows; its badges come from plan_json
+with app.app_context():
+    _pl_legacy = WorkoutPlan(
+        user_id=_pl_profile.id, name="Legacy Phases Plan", description="", days_per_week=3, total_weeks=4,
+        status="inactive", plan_json=json.dumps({"plan_name": "Legacy Phases Plan", "phases": [
+            {"phase_name": "Legacy Base", "phase_type": "progressive", "week_start": 1, "week_end": 4}]}),
+    )
+    db.session.add(_pl_legacy)
+    db.session.commit()
+    _pl_legacy_id = _pl_legacy.id
+check("Plan without phase rows shows plan_json phases in history",
+      b"Legacy Base (Wks 1" in client.get("/plan/history").data)
+check("Plan without phase rows shows plan_json phases on the generate page",
+      b"Legacy Base (Wks 1" in client.get("/generate-plan").data)
+with app.app_context():
+    db.session.delete(db.session.get(WorkoutPlan, _pl_legacy_id))
+    db.session.commit()
+
+# ── Bulk plan activation ───────────────────────────────────────────────────────
+print("\n--- Bulk Plan Activation ---")
+
+from app import activate_plan as _activate_plan
+
+
+def _bulk_plan_json(n_workouts, n_exercises):
+    return json.dumps({
+        "plan_name": "Bulk Plan", "description": "", "days_per_week": n_workouts, "total_weeks": 4,
+        "phases": [
+            {"phase_name": "Base", "phase_type": "progressive", "week_start": 1, "week_end": 2},
+            {"phase_name": "Deload", "phase_type": "recovery", "week_start": 3, "week_end": 4},
+        ],
+        "workouts": [
+            {"day": f"Day {w + 1}", "name": f"Bulk {w + 1}", "exercises": [
+                {"name": "LAT PULLDOWN" if e == 0 else f"Bulk Move {w}-{e}", "sets": 3, "reps": "8-10",
+                 "rest_seconds": 90, "type": "main"}
+                for e in range(n_exercises)
+            ]}
+            for w in range(n_workouts)
+        ],
+    })
+
+
+with app.app_context():
+    _ba_account = Account(email="bulk@fitlocal.test", email_claimed=True)
+    db.session.add(_ba_account)
+    db.session.flush()
+    _ba_profile = UserProfile(account_id=_ba_account.id, name="Bulk", age=30, sex="Male",
+                              fitness_level="Intermediate", goals="Strength")
+    db.session.add(_ba_profile)
+    db.session.flush()
+
+    def _ba_activate(n_workouts, n_exercises):
+        pending = WorkoutPlan(user_id=_ba_profile.id, name="Bulk Plan", status="pending",
+                              plan_json=_bulk_plan_json(n_workouts, n_exercises))
+        db.session.add(pending)
+        db.session.commit()
+        _ids = []
+        _stmts = _captured_sql(lambda: _ids.append(_activate_plan(_ba_profile.id, pending, 1)))
+        db.session.commit()
+        return _ids[0], _stmts
+
+    _ba_small_id, _ba_small = _ba_activate(1, 2)
+    _ba_id, _ba_stmts = _ba_activate(3, 20)
+    check(f"Activation statements don't grow with exercises ({len(_ba_small)} vs {len(_ba_stmts)})",
+          len(_ba_stmts) == len(_ba_small))
+    _ba_plan = db.session.get(WorkoutPlan, _ba_id)
+    _ba_workouts = PlannedWorkout.query.filter_by(plan_id=_ba_id).order_by(PlannedWorkout.order_index).all()
+    check("Workouts are created in plan order",
+          [w.workout_name for w in _ba_workouts] == ["Bulk 1", "Bulk 2", "Bulk 3"])
+    check("Each workout gets its own exercises",
+          all([e.exercise_name for e in w.planned_exercises][1:] == [f"Bulk Move {i}-{e}" for e in range(1, 20)]
+              for i, w in enumerate(_ba_workouts)))
+    _ba_lib = ExerciseLibrary.query.filter_by(name="Lat Pulldown").first()
+    check("Library ids are matched case-insensitively",
+          all(e.exercise_library_id == _ba_lib.id for w in _ba_workouts for e in w.planned_exercises
+              if e.exercise_name == "LAT PULLDOWN")
+          and all(e.exercise_library_id is None for w in _ba_workouts for e in w.planned_exercises
+                  if e.exercise_name != "LAT PULLDOWN"))
+    check("Phases are created in order", [p.phase_name for p in _ba_plan.phases] == ["Base", "Deload"])
+    check("New plan is the only active one, with its summary and offset",
+          WorkoutPlan.query.filter_by(user_id=_ba_profile.id, status="active").count() == 1
+          and _ba_plan.status == "active" and _ba_plan.phase_count == 2 and _ba_plan.session_offset == 1
+          and db.session.get(WorkoutPlan, _ba_small_id).status == "inactive")
+    check("Pending plan is consumed",
+          WorkoutPlan.query.filter_by(user_id=_ba_profile.id, status="pending").count() == 0)
+    _ba_first_write = next(i for i, (_st, _) in enumerate(_ba_stmts) if not _st.lstrip().upper().startswith("SELECT"))
+    check("All reads happen before the first write",
+          all(not _st.lstrip().upper().startswith("SELECT") for _st, _ in _ba_stmts[_ba_first_write:]))
+
+print("\n--- Exercise Name Keys ---")
+from models import exercise_name_key as _name_key
+from app import _library_ids_by_key, _build_logged_sets
+
+check("Name keys fold case, punctuation and spacing",
+      _name_key("Pull-Up") == _name_key("pull up") == _name_key("  PULL_UP ") == "pull up")
+check("Name keys drop apostrophes", _name_key("Farmer's Walk") == _name_key("Farmers Walk") == "farmers walk")
+check("Distinct exercises keep distinct keys", _name_key("Pull-Up") != _name_key("Pullover"))
+
+with app.app_context():
+    _nk_lib = ExerciseLibrary(name="Romanian Deadlift (RDL)", muscle_group="Hamstrings")
+    db.session.add(_nk_lib)
+    db.session.execute(db.insert(ExerciseLibrary), [{"name": "Chin-Up"}, {"name": "T-Bar Row"}])
+    db.session.commit()
+    check("ORM inserts fill name_key", _nk_lib.name_key == "romanian deadlift rdl")
+    check("Core inserts fill name_key",
+          {e.name_key for e in ExerciseLibrary.query.filter(ExerciseLibrary.name.in_(["Chin-Up", "T-Bar Row"]))}
+          == {"chin up", "t bar row"})
+    _nk_lib.name = "Romanian Deadlift"
+    db.session.commit()
+    check("Renaming an entry re-keys it", _nk_lib.name_key == "romanian deadlift")
+
+    _nk_chin = ExerciseLibrary.query.filter_by(name="Chin-Up").first()
+    _nk_ids = _library_ids_by_key(["chin ups", "CHIN UP", "chin_up", "Romanian  deadlift", "Nordic Curl"])
+    check("Lookups match name variants",
+          _nk_ids == {"chin up": _nk_chin.id, "romanian deadlift": _nk_lib.id})
+    _nk_plan = [r[-1] for r in db.session.execute(_sa.text(
+        "EXPLAIN QUERY PLAN SELECT id, name_key FROM exercise_library WHERE name_key IN ('chin up', 'x')"
+    ))]
+    check(f"Lookups use the name_key index {_nk_plan}",
+          any("ix_exercise_library_name_key" in _d for _d in _nk_plan))
+
+    _nk_sets = _build_logged_sets(None, ["chin up", "Nordic Curl"], ["1", "1"], ["0", "0"], ["8", "5"], [], [])
+    check("Logged sets link to the library through name variants",
+          [_s.exercise_library_id for _s in _nk_sets] == [_nk_chin.id, None])
+    db.session.rollback()
+
+# Migration 9 on a database that predates name_key
+_nk_fd, _nk_path = tempfile.mkstemp(suffix="_fitlocal_namekey.db")
+os.close(_nk_fd)
+_nk_engine = _sa.create_engine(f"sqlite:///{_nk_path}")
+_migrate_mod.migrate(_nk_engine)
+with _nk_engine.begin() as _nc:
+    _nc.exec_driver_sql("DROP INDEX ix_exercise_library_name_key")
+    _nc.exec_driver_sql("DELETE FROM schema_version WHERE version >= 9")
+    _nc.exec_driver_sql("INSERT INTO exercise_library (name) VALUES ('Bench Press'), ('Pull-Up')")
+    _nc.exec_driver_sql(
+        "INSERT INTO logged_set (session_id, exercise_name, set_number) "
+        "VALUES (1, 'bench  press', 1), (1, 'PULL UPS', 1), (1, 'pull up', 1), (1, 'Dips', 1)"
+    )
+_migrate_mod._migrated.discard(str(_nk_engine.url))
+check("Name-key migration applies", _migrate_mod.migrate(_nk_engine)[:1] == [9])
+with _nk_engine.connect() as _nc:
+    check("Migration backfills library name keys",
+          _nc.exec_driver_sql("SELECT name_key FROM exercise_library ORDER BY id").scalars().all()
+          == ["bench press", "pull up"])
+    check("Migration recreates the name_key index",
+          _nc.exec_driver_sql(
+              "SELECT 1 FROM sqlite_master WHERE name='ix_exercise_library_name_key'"
+          ).first() is not None)
+    check("Migration links unmatched sets by name key",
+          _nc.exec_driver_sql("SELECT exercise_library_id FROM logged_set ORDER BY id").scalars().all()
+          == [1, None, 2, None])
+_nk_engine.dispose()
+os.unlink(_nk_path)
+
+print("\n--- Exercise Picker API ---")
+from exercise_catalog import exercise_catalog as _catalog, CatalogIndex as _CatalogIndex
+
+_ep_url = "/api/plan/exercise-library"
+with app.app_context():
+    _ep_profile_id = UserProfile.query.filter_by(account_id=test_account_id).first().id
+    db.session.execute(db.insert(ExerciseLibrary), [
+        {"name": "Pullover", "muscle_group": "Back"},
+        {"name": "Band Pull-Apart", "muscle_group": "Shoulders"},
+        {"name": "Pull-Up", "muscle_group": "Back"},
+    ])
+    db.session.commit()
+
+_catalog.clear()
+r = client.get(_ep_url)
+_ep_etag = r.headers.get("ETag")
+check("Picker list carries an ETag and must be revalidated",
+      r.status_code == 200 and _ep_etag and "no-cache" in r.headers.get("Cache-Control", ""))
+with app.app_context():
+    _ep_stmts = _captured_sql(lambda: client.get(_ep_url, headers={"If-None-Match": _ep_etag}))
+    r = client.get(_ep_url, headers={"If-None-Match": _ep_etag})
+check("Unchanged list answers If-None-Match with an empty 304", r.status_code == 304 and r.data == b"")
+check(f"304 reads only the version counters ({len(_ep_stmts)} statements)",
+      not any("FROM exercise_library" in _st or "FROM logged_set" in _st for _st, _ in _ep_stmts))
+
+r = client.get(_ep_url + "?q=pull")
+_ep_names = [e["name"] for e in r.get_json()]
+check(f"Search puts prefix matches first, then word matches ({_ep_names})",
+      _ep_names[:2] == ["Pull-Up", "Pullover"] and "Band Pull-Apart" in _ep_names[2:])
+check("Search normalizes the query like names",
+      [e["name"] for e in client.get(_ep_url + "?q=PULL_U").get_json()][:1] == ["Pull-Up"])
+check("Search honours the limit", len(client.get(_ep_url + "?q=pull&limit=1").get_json()) == 1)
+check("Limit is clamped", len(client.get(_ep_url + "?limit=0").get_json()) == 1)
+check("Repeat searches are served from the index", _catalog.stats()["hits"] >= 4)
+
+with app.app_context():
+    db.session.add(ExerciseLibrary(name="Pull-Up Negative"))
+    db.session.commit()
+r = client.get(_ep_url + "?q=pull", headers={"If-None-Match": _ep_etag})
+check("A library change moves the ETag and rebuilds the index",
+      r.status_code == 200 and r.headers.get("ETag") != _ep_etag
+      and "Pull-Up Negative" in [e["name"] for e in r.get_json()])
+
+_ep_etag = client.get(_ep_url).headers.get("ETag")
+with app.app_context():
+    _ep_ws = WorkoutSession(user_id=_ep_profile_id, date=date.today(), status="completed")
+    db.session.add(_ep_ws)
+    db.session.flush()
+    db.session.add(LoggedSet(session_id=_ep_ws.id, exercise_name="Zercher Carry", set_number=1))
+    db.session.commit()
+r = client.get(_ep_url + "?q=zerch")
+check("Logging a new exercise name moves the ETag and is searchable",
+      r.headers.get("ETag") != _ep_etag and [e["name"] for e in r.get_json()] == ["Zercher Carry"])
+with app.app_context():
+    _ep_versions = _catalog.versions(db.session, _ep_profile_id)
+    _ep_other = _catalog.versions(db.session, _ep_profile_id + 1000)
+check("Set changes only move their own user's version", _ep_versions[1] > 0 and _ep_other[1] == 0)
+
+_ep_index = _CatalogIndex([{"name": n} for n in ("Arrow Drill", "Row", "Upright Row", "Rowing Machine")])
+check("Index search order: prefix, then word prefix, then substring",
+      [e["name"] for e in _ep_index.search("row", 10)] == ["Row", "Rowing Machine", "Upright Row", "Arrow Drill"])
+
+print("\n--- Full-Text Search ---")
+import search_index as _search_index
+
+with app.app_context():
+    _fts_profile_id = UserProfile.query.filter_by(account_id=test_account_id).first().id
+    _fts_other = UserProfile(name="Other", age=30, sex="Male", fitness_level="Beginner", goals="Other")
+    db.session.add(_fts_other)
+    db.session.flush()
+    _fts_ws = WorkoutSession(user_id=_fts_profile_id, date=date(2024, 3, 5), status="completed",
+                             session_notes="Left shoulder hurt during <b>presses</b>")
+    db.session.add(_fts_ws)
+    db.session.flush()
+    db.session.add_all([
+        LoggedSet(session_id=_fts_ws.id, exercise_name="Landmine Press", set_number=1,
+                  notes="shoulder felt pinchy on rep 6"),
+        LoggedSet(session_id=_fts_ws.id, exercise_name="Landmine Press", set_number=2),
+        LoggedSet(session_id=_fts_ws.id, exercise_name="Zottman Curl", set_number=1),
+        NextWorkoutNote(user_id=_fts_profile_id, workout_name=None, note="Go easy on the shoulder"),
+        AIReview(user_id=_fts_profile_id, review_text="Shoulder volume is climbing too fast."),
+        WorkoutSession(user_id=_fts_other.id, date=date(2024, 3, 5), session_notes="shoulder secret"),
+    ])
+    db.session.commit()
+    _fts_ws_id = _fts_ws.id
+
+    _fts_hits, _fts_more = _search_index.search(_fts_profile_id, "shoulder")
+    _fts_kinds = sorted(h["kind"] for h in _fts_hits)
+    check(f"Search finds session, set, note and review text ({_fts_kinds})",
+          _fts_kinds == ["note", "review", "session", "set"] and not _fts_more)
+    check("Search never returns another user's documents",
+          not any("secret" in h["snippet"] for h in _search_index.search(_fts_profile_id, "secret")[0]))
+    _fts_session_hit = next(h for h in _fts_hits if h["kind"] == "session")
+    check("Hits link back to their session with its date",
+          _fts_session_hit["session_id"] == _fts_ws_id and _fts_session_hit["date"] == "2024-03-05")
+    check("Snippets highlight matches and escape stored HTML",
+          "<mark>shoulder</mark>" in _fts_session_hit["snippet"].lower()
+          and "&lt;b&gt;" in _fts_session_hit["snippet"])
+    check("Words match by prefix and stem", {h["kind"] for h in _search_index.search(_fts_profile_id, "hurting")[0]}
+          == {"session"} and _search_index.search(_fts_profile_id, "pinch")[0][0]["kind"] == "set")
+    check("Exercise names index the session",
+          [h["ref_id"] for h in _search_index.search(_fts_profile_id, "zottman")[0]] == [_fts_ws_id])
+    check("FTS syntax in the query is taken literally",
+          _search_index.search(_fts_profile_id, 'shoulder" OR "x')[0] == []
+          and _search_index.search(_fts_profile_id, "NEAR(")[0] == [])
+
+    # Writes on any path keep the index current
+    db.session.execute(db.update(LoggedSet).where(LoggedSet.exercise_name == "Zottman Curl")
+                       .values(exercise_name="Spider Curl"))
+    _fts_ws.session_notes = "All good today"
+    db.session.commit()
+    check("Renamed exercises and edited notes are re-indexed",
+          _search_index.search(_fts_profile_id, "zottman")[0] == []
+          and [h["ref_id"] for h in _search_index.search(_fts_profile_id, "spider")[0]] == [_fts_ws_id]
+          and "session" not in {h["kind"] for h in _search_index.search(_fts_profile_id, "hurt")[0]})
+    LoggedSet.query.filter_by(session_id=_fts_ws_id).delete()
+    db.session.delete(_fts_ws)
+    db.session.commit()
+    check("Deleted sessions and sets leave the index",
+          {h["kind"] for h in _search_index.search(_fts_profile_id, "shoulder")[0]} == {"note", "review"})
+
+    db.session.add_all([WorkoutSession(user_id=_fts_profile_id, date=date(2024, 4, 1 + i),
+                                       session_notes=f"tempo run {i}") for i in range(25)])
+    db.session.commit()
+    _fts_page1, _fts_more1 = _search_index.search(_fts_profile_id, "tempo", page=1, page_size=20)
+    _fts_page2, _fts_more2 = _search_index.search(_fts_profile_id, "tempo", page=2, page_size=20)
+    check("Search pages through hits",
+          len(_fts_page1) == 20 and _fts_more1 and len(_fts_page2) == 5 and not _fts_more2
+          and not {h["ref_id"] for h in _fts_page1} & {h["ref_id"] for h in _fts_page2})
+
+    _fts_count = db.session.execute(_sa.text("SELECT count(*) FROM search_index")).scalar()
+    with db.engine.begin() as _fc:
+        _search_index.rebuild_search_index(_fc)
+    check("Rebuild reproduces the trigger-maintained index",
+          db.session.execute(_sa.text("SELECT count(*) FROM search_index")).scalar() == _fts_count)
+
+r = client.get("/search?q=tempo")
+check("/search renders ranked hits with a next-page link",
+      r.status_code == 200 and b"<mark>tempo</mark> run" in r.data and b"page=2" in r.data)
+r = client.get("/search?q=nothingmatchesthis")
+check("/search reports no matches", r.status_code == 200 and b"Nothing matches" in r.data)
+
+print("\n--- Resumed Session Set Sync ---")
+
+
+def _sync_items(sets, resume_id=""):
+    items = [("overall_feeling", "3"), ("session_notes", "sync"), ("session_elapsed_seconds", "60"),
+             ("resume_session_id", str(resume_id))]
+    for name, number, weight in sets:
+        items += [("exercise_name", name), ("set_number", str(number)), ("weight", weight),
+                  ("reps", "5"), ("rpe", ""), ("set_notes", "")]
+    return MultiDict(items)
+
+
+def _stored_sets(session_id):
+    with app.app_context():
+        return {(ls.exercise_name, ls.set_number): (ls.id, ls.weight_lbs)
+                for ls in LoggedSet.query.filter_by(session_id=session_id)}
+
+
+_sync_sets = [("Sync Squat", n, "225") for n in (1, 2, 3)] + [("Sync Row", n, "135") for n in (1, 2)]
+r = client.post("/workout/pause", data=_sync_items(_sync_sets))
+check("New paused session reports its inserts", r.headers.get("X-Logged-Sets") ==
+      "inserted=5 updated=0 deleted=0 unchanged=0")
+with app.app_context():
+    _sync_id = WorkoutSession.query.filter_by(session_notes="sync", status="paused").first().id
+_sync_before = _stored_sets(_sync_id)
+
+r = client.post("/workout/pause", data=_sync_items(_sync_sets, _sync_id))
+check("Re-pausing unchanged sets writes none of them",
+      r.headers.get("X-Logged-Sets") == "inserted=0 updated=0 deleted=0 unchanged=5"
+      and _stored_sets(_sync_id) == _sync_before)
+
+_sync_changed = [("Sync Squat", 1, "225"), ("Sync Squat", 2, "235"), ("Sync Row", 1, "135"),
+                 ("Sync Row", 2, "135"), ("Sync Row", 3, "140")]
+_sync_responses = []
+with app.app_context():
+    _sync_stmts = _captured_sql(lambda: _sync_responses.append(
+        client.post("/workout/log", data=_sync_items(_sync_changed, _sync_id))))
+check("Finishing reports the touched rows",
+      _sync_responses[0].headers.get("X-Logged-Sets") == "inserted=1 updated=1 deleted=1 unchanged=3")
+_sync_after = _stored_sets(_sync_id)
+check("Finishing applies only the diff, keeping unchanged row ids",
+      set(_sync_after) == {("Sync Squat", 1), ("Sync Squat", 2), ("Sync Row", 1), ("Sync Row", 2), ("Sync Row", 3)}
+      and all(_sync_after[k][0] == _sync_before[k][0] for k in _sync_before if k in _sync_after)
+      and _sync_after[("Sync Squat", 2)][1] == 235)
+check("Sync writes one statement per changed row",
+      sum(1 for _st, _ in _sync_stmts
+          if _st.startswith(("INSERT INTO logged_set", "UPDATE logged_set", "DELETE FROM logged_set"))) == 3)
+with app.app_context():
+    check("Resumed session is completed in place",
+          db.session.get(WorkoutSession, _sync_id).status == "completed")
+
+print("\n--- Per-Set Logging API ---")
+
+
+def _set_call(seq, number, weight="100", **extra):
+    body = {"client_token": "tok-per-set", "seq": seq, "exercise_name": "Per Set Press",
+            "set_number": number, "weight": weight, "reps": "8", "rpe": "", "notes": ""}
+    body.update(extra)
+    return client.post("/api/workout/set", json=body)
+
+
+r = _set_call(1, 1, phase_name="Per Set Phase")
+_ps_id = r.get_json()["session_id"] if r.status_code == 200 else None
+with app.app_context():
+    _ps_session = db.session.get(WorkoutSession, _ps_id) if _ps_id else None
+    check("First set creates a paused session for the client token",
+          _ps_session is not None and _ps_session.status == "paused"
+          and _ps_session.client_token == "tok-per-set" and _ps_session.phase_name == "Per Set Phase")
+check("Set is stored as soon as it is posted", _stored_sets(_ps_id).get(("Per Set Press", 1), (0, 0))[1] == 100)
+
+r = _set_call(1, 1, weight="999")
+check("Replayed seq is acknowledged but not applied",
+      r.status_code == 200 and r.get_json()["applied"] is False and r.get_json()["session_id"] == _ps_id
+      and _stored_sets(_ps_id)[("Per Set Press", 1)][1] == 100)
+
+_set_call(2, 2)
+r = _set_call(3, 1, weight="105")
+check("Later seq updates the set in place", r.get_json()["applied"] is True
+      and _stored_sets(_ps_id)[("Per Set Press", 1)][1] == 105)
+_set_call(4, 3, session_id=_ps_id)
+r = _set_call(5, 3, session_id=_ps_id, deleted=True)
+check("Deleted set is removed", r.get_json()["applied"] is True
+      and set(_stored_sets(_ps_id)) == {("Per Set Press", 1), ("Per Set Press", 2)})
+with app.app_context():
+    check("Session records the highest applied seq", db.session.get(WorkoutSession, _ps_id).client_seq == 5)
+
+check("Missing seq is rejected", client.post("/api/workout/set", json={
+    "client_token": "tok-per-set", "exercise_name": "Per Set Press", "set_number": 1}).status_code == 400)
+check("Unknown session returns 404", _set_call(6, 1, session_id=999999).status_code == 404)
+r = other_client.post("/api/workout/set", json={
+    "session_id": _ps_id, "seq": 99, "exercise_name": "Per Set Press", "set_number": 1, "weight": "1"})
+check("Another user's session is refused", r.status_code in (401, 404)
+      and _stored_sets(_ps_id)[("Per Set Press", 1)][1] == 105)
+
+r = client.post("/workout/log", data=MultiDict([
+    ("overall_feeling", "3"), ("session_notes", "per set"), ("session_elapsed_seconds", "60"),
+    ("resume_session_id", str(_ps_id)),
+    ("exercise_name", "Per Set Press"), ("set_number", "1"), ("weight", "105"), ("reps", "8"),
+    ("rpe", ""), ("set_notes", ""),
+    ("exercise_name", "Per Set Press"), ("set_number", "2"), ("weight", "100"), ("reps", "8"),
+    ("rpe", ""), ("set_notes", ""),
+]))
+check("Log Workout only reconciles what per-set calls already saved",
+      r.headers.get("X-Logged-Sets") == "inserted=0 updated=0 deleted=0 unchanged=2")
+with app.app_context():
+    _ps_session = db.session.get(WorkoutSession, _ps_id)
+    check("Logged session is completed and released from its token",
+          _ps_session.status == "completed" and _ps_session.client_token is None)
+r = _set_call(7, 1, session_id=_ps_id)
+check("Sets for a finished session are refused", r.status_code == 409)
+
+# Starting a workout set by set leaves only that one paused
+with app.app_context():
+    _ps_older = WorkoutSession(user_id=_ps_session.user_id, date=date.today(), status="paused")
+    db.session.add(_ps_older)
+    db.session.commit()
+    _ps_older_id = _ps_older.id
+r = _set_call(1, 1, client_token="tok-per-set-new")
+_ps_new_id = r.get_json()["session_id"]
+with app.app_context():
+    check("First set of a new workout completes older paused sessions",
+          db.session.get(WorkoutSession, _ps_older_id).status == "completed"
+          and db.session.get(WorkoutSession, _ps_new_id).status == "paused")
+    _ps_older = WorkoutSession(user_id=_ps_session.user_id, date=date.today(), status="paused")
+    db.session.add(_ps_older)
+    db.session.commit()
+    _ps_older_id = _ps_older.id
+r = client.post("/api/workout/sync", json={
+    "client_token": "tok-per-set-new", "session_id": _ps_new_id, "sets": [],
+    "finish": {"seq": 2, "status": "paused", "sets": []}})
+with app.app_context():
+    check("Offline Save & Pause completes other paused sessions",
+          r.status_code == 200 and db.session.get(WorkoutSession, _ps_older_id).status == "completed"
+          and db.session.get(WorkoutSession, _ps_new_id).status == "paused")
+    db.session.get(WorkoutSession, _ps_new_id).status = "completed"
+    db.session.commit()
+
+print("\n--- Offline Batch Sync ---")
+
+
+def _batch(token, sets, **extra):
+    body = {"client_token": token, "sets": [
+        {"seq": seq, "exercise_name": "Batch Squat", "set_number": number, "weight": weight, "reps": "5"}
+        for seq, number, weight in sets
+    ]}
+    body.update(extra)
+    return client.post("/api/workout/sync", json=body)
+
+
+_yesterday = date.today() - timedelta(days=1)
+r = _batch("tok-batch-a", [(1, 1, "200"), (2, 2, "200"), (3, 1, "205")], date=_yesterday.isoformat())
+_bs_id = r.get_json().get("session_id")
+check("Batch applies every queued set in one call",
+      r.status_code == 200 and r.get_json()["applied"] == 3 and r.get_json()["seq"] == 3
+      and {k: v[1] for k, v in _stored_sets(_bs_id).items()} == {("Batch Squat", 1): 205, ("Batch Squat", 2): 200})
+with app.app_context():
+    check("Batch session keeps the day the sets were queued",
+          db.session.get(WorkoutSession, _bs_id).date == _yesterday)
+
+r = _batch("tok-batch-a", [(1, 1, "999"), (2, 2, "999"), (3, 1, "999"), (4, 3, "210")], session_id=_bs_id)
+check("Re-sent batch applies only the writes past the session's seq",
+      r.get_json()["applied"] == 1 and r.get_json()["skipped"] == 3
+      and _stored_sets(_bs_id)[("Batch Squat", 1)][1] == 205 and _stored_sets(_bs_id)[("Batch Squat", 3)][1] == 210)
+
+r = _batch("tok-batch-a", [(5, 4, "215"), ("x", 5, "215")], session_id=_bs_id)
+check("Malformed batch is rejected whole", r.status_code == 400 and ("Batch Squat", 4) not in _stored_sets(_bs_id))
+
+r = _batch("tok-batch-b", [(1, 4, "215")], session_id=_bs_id)
+check("Another page's writes are refused as superseded",
+      r.status_code == 409 and r.get_json()["conflict"] == "superseded"
+      and r.get_json()["session"] == {"id": _bs_id, "status": "paused", "seq": 4}
+      and ("Batch Squat", 4) not in _stored_sets(_bs_id))
+r = _batch("tok-batch-b", [(1, 4, "215")], session_id=_bs_id, claim=True)
+check("A resuming page claims the session and restarts its seq",
+      r.status_code == 200 and r.get_json()["applied"] == 1 and r.get_json()["seq"] == 1)
+check("The superseded page is refused once claimed",
+      _batch("tok-batch-a", [(6, 5, "220")], session_id=_bs_id).status_code == 409)
+
+r = _batch("tok-batch-b", [(2, 2, "202")], session_id=_bs_id, finish={
+    "seq": 3, "status": "completed", "overall_feeling": "4", "session_notes": "offline finish",
+    "elapsed_seconds": "1800", "superset_exercises": [],
+    "notes_for_next_general": "batch note", "notes_for_next_workout": "",
+    "sets": [{"exercise_name": "Batch Squat", "set_number": n, "weight": w, "reps": "5"}
+             for n, w in ((1, "205"), (2, "202"))],
+})
+check("Queued form finishes the session in the same batch",
+      r.status_code == 200 and r.get_json()["status"] == "completed" and r.get_json()["applied"] == 2)
+with app.app_context():
+    _bs_session = db.session.get(WorkoutSession, _bs_id)
+    check("Finished session takes the form's fields and set list",
+          _bs_session.session_notes == "offline finish" and _bs_session.overall_feeling == 4
+          and _bs_session.elapsed_seconds == 1800 and _bs_session.client_token is None
+          and set(_stored_sets(_bs_id)) == {("Batch Squat", 1), ("Batch Squat", 2)}
+          and _stored_sets(_bs_id)[("Batch Squat", 2)][1] == 202)
+    check("Finishing saves the next-workout note",
+          NextWorkoutNote.query.filter_by(user_id=_bs_session.user_id, note="batch note").first() is not None)
+r = _batch("tok-batch-b", [(4, 1, "300")], session_id=_bs_id)
+check("Writes to a finished session conflict with its state",
+      r.status_code == 409 and r.get_json()["conflict"] == "finished"
+      and r.get_json()["session"]["status"] == "completed" and _stored_sets(_bs_id)[("Batch Squat", 1)][1] == 205)
+
+for _bad_body in ([1, 2], {"client_token": "tok-batch-c", "sets": ["x"]},
+                  {"client_token": "tok-batch-c", "sets": [], "finish": {"seq": 1, "sets": ["x"]}},
+                  {"client_token": "tok-batch-c", "sets": [], "finish": {"seq": 1, "superset_exercises": "AB"}}):
+    r = client.post("/api/workout/sync", json=_bad_body)
+    with app.app_context():
+        check(f"Batch with wrongly typed parts is a 400: {_bad_body}", r.status_code == 400
+              and WorkoutSession.query.filter_by(client_token="tok-batch-c").first() is None)
+check("A per-set call that is not an object is a 400",
+      client.post("/api/workout/set", json=["x"]).status_code == 400)
+
+# Two tabs sharing a token: the first lookup misses the other tab's
+# just-committed session, so the insert hits the unique index
+r = _batch("tok-batch-race", [(1, 1, "100")])
+_race_id = r.get_json()["session_id"]
+_race_lookups = []
+
+
+def _racing_lookup(token):
+    _race_lookups.append(token)
+    if len(_race_lookups) == 1:
+        return None
+    return WorkoutSession.query.filter_by(client_token=token).first()
+
+
+with _mock.patch("app._session_by_token", side_effect=_racing_lookup):
+    r = _batch("tok-batch-race", [(2, 2, "100")])
+check("Losing the client-token insert race joins the existing session",
+      r.status_code == 200 and len(_race_lookups) == 2 and r.get_json()["session_id"] == _race_id
+      and set(_stored_sets(_race_id)) == {("Batch Squat", 1), ("Batch Squat", 2)})
+
+
+def _form_post(route, token, weight):
+    return client.post(route, data=MultiDict([
+        ("client_token", token), ("resume_session_id", ""), ("session_elapsed_seconds", "600"),
+        ("exercise_name", "Batch Squat"), ("set_number", "1"), ("weight", weight), ("reps", "5"),
+        ("rpe", ""), ("set_notes", ""),
+    ]))
+
+
+def _token_sessions(token):
+    with app.app_context():
+        return [s.id for s in WorkoutSession.query.filter(db.or_(
+            WorkoutSession.client_token == token, WorkoutSession.finalized_token == token))]
+
+
+# First edits queued offline: the batch made the session, but the page never learned its id
+_fb_id = _batch("tok-form-a", [(1, 1, "150")]).get_json()["session_id"]
+with app.app_context():
+    _fb_sessions = WorkoutSession.query.count()
+_form_post("/workout/log", "tok-form-a", "155")
+with app.app_context():
+    check("A form posted before the page learned its session id saves that session",
+          WorkoutSession.query.count() == _fb_sessions and db.session.get(WorkoutSession, _fb_id).status == "completed"
+          and _stored_sets(_fb_id)[("Batch Squat", 1)][1] == 155)
+r = _batch("tok-form-a", [(2, 1, "150")])
+check("A batch replayed after the page's form post is refused as finished",
+      r.status_code == 409 and r.get_json()["conflict"] == "finished" and _token_sessions("tok-form-a") == [_fb_id]
+      and _stored_sets(_fb_id)[("Batch Squat", 1)][1] == 155)
+
+# Form posted (paused) before the page's first batch landed at all
+_form_post("/workout/pause", "tok-form-b", "160")
+_fb_paused = _token_sessions("tok-form-b")
+with app.app_context():
+    _fb_sessions = WorkoutSession.query.count()
+r = _batch("tok-form-b", [(1, 1, "150"), (2, 2, "150")])
+with app.app_context():
+    check("A late batch never starts a second session for a form-saved page",
+          r.status_code == 409 and r.get_json()["conflict"] == "finished"
+          and WorkoutSession.query.count() == _fb_sessions and len(_fb_paused) == 1
+          and db.session.get(WorkoutSession, _fb_paused[0]).status == "paused"
+          and set(_stored_sets(_fb_paused[0])) == {("Batch Squat", 1)})
+    db.session.get(WorkoutSession, _fb_paused[0]).status = "completed"
+    db.session.commit()
+
+r = client.get("/sw.js")
+check("Service worker is served from the root", r.status_code == 200 and "javascript" in r.content_type
+      and b"fitlocal-offline" in r.data)
+r.close()
+
+print("\n--- Background Plan Generation ---")
+import threading as _threading
+import plan_jobs as _plan_jobs
+from models import PlanJob as _PlanJob
+
+_job_plan = {"plan_name": "Job Plan", "description": "From a job", "days_per_week": 2,
+             "total_weeks": 8, "phases": [], "workouts": []}
+_job_release = _threading.Event()
+
+
+def _slow_plan(profile, **kwargs):
+    _job_release.wait(10)
+    return dict(_job_plan, extra=kwargs.get("extra_context"))
+
+
+with _mock.patch("ai.generate_workout_plan", side_effect=_slow_plan) as _mock_generate:
+    r = client.post("/generate-plan/generate", data={"extra_context": "job context"},
+                    headers={"Accept": "application/json"})
+    _job_id = r.get_json()["job_id"] if r.status_code == 202 else None
+    check("Generate POST returns a job id at once", r.status_code == 202 and _job_id is not None
+          and r.get_json()["status_url"] == f"/api/plan/jobs/{_job_id}")
+    r = client.post("/generate-plan/generate", data={"extra_context": "again"})
+    check("Repeat submit joins the running job",
+          r.status_code == 302 and r.headers["Location"].endswith(f"/generate-plan?job={_job_id}"))
+    r = client.get(f"/api/plan/jobs/{_job_id}")
+    check("Status endpoint reports a job in progress",
+          r.status_code == 200 and r.get_json()["done"] is False
+          and r.get_json()["status"] in ("queued", "running") and r.headers["Cache-Control"] == "no-store")
+    r = client.get(f"/generate-plan?job={_job_id}")
+    check("Generate page polls the running job",
+          r.status_code == 200 and f"/api/plan/jobs/{_job_id}".encode() in r.data
+          and b"EventSource" not in r.data)
+    _job_release.set()
+    _plan_jobs.plan_job_runner.drain(timeout=10)
+    check("Job generates once with the form's inputs",
+          _mock_generate.call_count == 1 and _mock_generate.call_args.kwargs["extra_context"] == "job context")
+
+r = client.get(f"/api/plan/jobs/{_job_id}")
+_job_status = r.get_json()
+with app.app_context():
+    _job_user_id = db.session.get(_PlanJob, _job_id).user_id
+    _job_pending = WorkoutPlan.query.filter_by(user_id=_job_user_id, status="pending").all()
+    check("Finished job lands as the pending plan",
+          _job_status["status"] == "succeeded" and _job_status["done"] is True
+          and [p.id for p in _job_pending] == [_job_status["plan_id"]]
+          and _job_pending[0].name == "Job Plan" and json.loads(_job_pending[0].plan_json)["extra"] == "job context")
+r = client.get(f"/generate-plan?job={_job_id}", follow_redirects=True)
+check("Generate page reports the finished job", b"Plan generated! Review it below." in r.data and b"Job Plan" in r.data)
+r = client.get(f"/generate-plan?job={_job_id}", follow_redirects=True)
+check("Reloading the finished job's URL does not report it again",
+      b"Plan generated!" not in r.data and b"Job Plan" in r.data)
+check("Another user's job is not found", other_client.get(f"/api/plan/jobs/{_job_id}").status_code == 404)
+
+with _mock.patch("ai.generate_workout_plan", side_effect=RuntimeError("model overloaded")):
+    r = client.post("/generate-plan/generate", data={})
+    _failed_id = int(r.headers["Location"].rsplit("=", 1)[1])
+    _plan_jobs.plan_job_runner.drain(timeout=10)
+r = client.get(f"/api/plan/jobs/{_failed_id}")
+check("Failed job keeps its error", r.get_json()["status"] == "failed" and r.get_json()["error"] == "model overloaded")
+r = client.get(f"/generate-plan?job={_failed_id}", follow_redirects=True)
+check("Generate page reports the failure", b"Error generating plan: model overloaded" in r.data)
+check("A failure is reported once", b"Error generating plan" not in client.get(
+    f"/generate-plan?job={_failed_id}", follow_redirects=True).data)
+with app.app_context():
+    check("Failed job leaves the pending plan alone",
+          WorkoutPlan.query.filter_by(id=_job_status["plan_id"], status="pending").count() == 1)
+
+# A worker killed mid-generation leaves a running job whose heartbeat goes stale
+with app.app_context():
+    _stale_at = _plan_jobs._now() - _plan_jobs.LEASE - timedelta(seconds=1)
+    _orphan = _PlanJob(user_id=db.session.get(_PlanJob, _job_id).user_id, status="running", attempts=1,
+                       params_json="{}", heartbeat_at=_stale_at)
+    _exhausted = _PlanJob(user_id=_orphan.user_id, status="running", attempts=_plan_jobs.MAX_ATTEMPTS,
+                          params_json="{}", heartbeat_at=_stale_at)
+    _live = _PlanJob(user_id=_orphan.user_id, status="running", attempts=1,
+                     params_json="{}", heartbeat_at=_plan_jobs._now())
+    db.session.add_all([_orphan, _exhausted, _live])
+    db.session.commit()
+    _orphan_id, _exhausted_id, _live_id = _orphan.id, _exhausted.id, _live.id
+with _mock.patch("ai.generate_workout_plan", return_value=dict(_job_plan, plan_name="Recovered Plan")):
+    client.get(f"/api/plan/jobs/{_orphan_id}")
+    client.get(f"/api/plan/jobs/{_live_id}")
+    _plan_jobs.plan_job_runner.drain(timeout=10)
+r = client.get(f"/api/plan/jobs/{_orphan_id}")
+check("Polling a job whose worker died re-runs it",
+      r.get_json()["status"] == "succeeded" and r.get_json()["attempts"] == 2)
+check("A job with a live heartbeat is left to its worker",
+      client.get(f"/api/plan/jobs/{_live_id}").get_json()["status"] == "running")
+r = client.get(f"/api/plan/jobs/{_exhausted_id}")
+check("A job out of attempts is failed", r.get_json()["status"] == "failed" and r.get_json()["done"] is True)
+with app.app_context():
+    _PlanJob.query.filter_by(id=_live_id).delete()
+    db.session.commit()
+
+
+def _reclaimed_plan(profile, **kwargs):
+    # While this slow call runs, its heartbeat lapses and another worker re-claims the job
+    _PlanJob.query.filter_by(status="running").update({"attempts": _PlanJob.attempts + 1})
+    db.session.commit()
+    return dict(_job_plan, plan_name="Lapsed Plan")
+
+
+with _mock.patch("ai.generate_workout_plan", side_effect=_reclaimed_plan):
+    _lapsed_id = int(client.post("/generate-plan/generate", data={}).headers["Location"].rsplit("=", 1)[1])
+    _plan_jobs.plan_job_runner.drain(timeout=10)
+with app.app_context():
+    _lapsed = db.session.get(_PlanJob, _lapsed_id)
+    check("A re-claimed attempt's result is discarded",
+          _lapsed.status == "running" and _lapsed.plan_id is None and _lapsed.attempts == 2
+          and WorkoutPlan.query.filter_by(name="Lapsed Plan").count() == 0)
+    check("A re-claimed attempt's failure is discarded too",
+          _plan_jobs._update(_lapsed_id, 1, status="failed") is False and _lapsed.status == "running")
+    db.session.delete(_lapsed)
+    db.session.commit()
+
+with _mock.patch("ai.generate_workout_plan", return_value=_job_plan) as _mock_generate:
+    client.post("/generate-plan/generate", data={"regenerate": "1"})
+    _plan_jobs.plan_job_runner.drain(timeout=10)
+    check("Regenerate form bypasses the response cache", _mock_generate.call_args.kwargs["refresh"] is True)
+    with app.app_context():
+        WorkoutPlan.query.filter_by(user_id=_job_user_id, status="pending").delete()
+        db.session.commit()
+    client.post("/generate-plan/generate", data={})
+    _plan_jobs.plan_job_runner.drain(timeout=10)
+    check("A first generation may be answered from the cache", _mock_generate.call_args.kwargs["refresh"] is False)
+    client.post("/generate-plan/generate", data={})
+    _plan_jobs.plan_job_runner.drain(timeout=10)
+    check("Generating over a pending plan bypasses the cache", _mock_generate.call_args.kwargs["refresh"] is True)
+
+print("\n--- Streaming Plan Generation ---")
+from ai import PlanStreamParser as _PlanStreamParser, validate_plan as _validate_plan
+
+_sp_plan = {
+    "plan_name": 'The "Brace {" Plan', "description": "Escapes \\ and } in strings",
+    "days_per_week": 2, "total_weeks": 8,
+    "phases": [{"phase_name": "Base", "phase_type": "progressive", "week_start": 1, "week_end": 4,
+                "description": "ends with }"},
+               {"phase_name": "Deload", "phase_type": "recovery", "week_start": 5, "week_end": 8}],
+    "workouts": [{"day": "Workout A", "name": "Push",
+                  "exercises": [{"name": "Dip [weighted]", "sets": 3, "reps": "8"}]},
+                 {"day": "Workout B", "name": "Pull", "exercises": [{"name": "Row", "sets": 4, "reps": "10"}]}],
+}
+_sp_text = "```json\n" + json.dumps(_sp_plan, indent=2) + "\n```"
+for _size in (1, 9, len(_sp_text)):
+    _sp_parser = _PlanStreamParser()
+    _sp_events = [e for i in range(0, len(_sp_text), _size) for e in _sp_parser.feed(_sp_text[i:i + _size])]
+    check(f"Stream parser emits each part once complete ({_size}-char chunks)", _sp_events == [
+        ("meta", {"plan_name": _sp_plan["plan_name"]}), ("meta", {"description": _sp_plan["description"]}),
+        ("phase", _sp_plan["phases"][0]), ("phase", _sp_plan["phases"][1]),
+        ("workout", _sp_plan["workouts"][0]), ("workout", _sp_plan["workouts"][1]),
+    ] and _sp_parser.text == _sp_text)
+_sp_parser = _PlanStreamParser()
+_sp_first = _sp_text[:_sp_text.index('"Workout B"')]
+check("First workout is emitted before the rest of the response arrives",
+      [k for k, _ in _sp_parser.feed(_sp_first)].count("workout") == 1)
+
+for _bad, _why in (({"plan_name": "x", "workouts": []}, "no workouts"),
+                   ({"workouts": _sp_plan["workouts"]}, "no plan_name"),
+                   (dict(_sp_plan, phases=[{"phase_name": "P", "week_start": "1"}]), "bad phase weeks")):
+    try:
+        _validate_plan(_bad)
+        check(f"Invalid plan is rejected ({_why})", False)
+    except ValueError:
+        check(f"Invalid plan is rejected ({_why})", True)
+
+with _mock.patch("ai.get_client") as _mock_client:
+    _stream_response(_mock_client, _sp_text, stop_reason="max_tokens")
+    try:
+        with app.app_context():
+            from ai import generate_workout_plan
+            generate_workout_plan(UserProfile.query.first())
+        check("Truncated response is rejected", False)
+    except ValueError as _e:
+        check("Truncated response is rejected", "cut off" in str(_e))
+
+with _mock.patch("ai.get_client") as _mock_client:
+    _stream_response(_mock_client, _sp_text, chunk_size=16)
+    r = client.post("/generate-plan/generate", data={}, headers={"Accept": "application/json"})
+    _sp_job = r.get_json()["job_id"]
+    _plan_jobs.plan_job_runner.drain(timeout=10)
+    check("Generation streams from the model",
+          _mock_client.return_value.messages.stream.call_args.kwargs["max_tokens"] == 32000)
+
+with app.app_context():
+    _sp_row = db.session.get(_PlanJob, _sp_job)
+    _sp_pending = db.session.get(WorkoutPlan, _sp_row.plan_id)
+    check("Streamed parts are recorded on the job",
+          [k for k, _ in _plan_jobs.job_events(_sp_row)] == ["meta", "meta", "phase", "phase", "workout", "workout"])
+    check("Assembled plan is stored as the pending plan",
+          _sp_row.status == "succeeded" and _sp_pending.status == "pending"
+          and json.loads(_sp_pending.plan_json) == _sp_plan)
+
+r = client.get(f"/api/plan/jobs/{_sp_job}")
+check("Status poll carries the streamed parts in order",
+      [e[0] for e in r.get_json()["events"]] == ["meta", "meta", "phase", "phase", "workout", "workout"]
+      and r.get_json()["events"][2][1] == _sp_plan["phases"][0] and r.get_json()["reset"] is False)
+r = client.get(f"/api/plan/jobs/{_sp_job}?since=4&attempt=1")
+check("Status poll returns only the parts since the page's last poll",
+      [e[1] for e in r.get_json()["events"]] == _sp_plan["workouts"] and r.get_json()["reset"] is False)
+r = client.get(f"/api/plan/jobs/{_sp_job}?since=4&attempt=7")
+check("A page that saw an earlier attempt gets the re-run's parts from the top",
+      len(r.get_json()["events"]) == 6 and r.get_json()["reset"] is True)
+with app.app_context():
+    _sp_gone = _PlanJob(user_id=_sp_row.user_id, status="running", attempts=1, params_json="{}",
+                        heartbeat_at=_plan_jobs._now())
+    db.session.add(_sp_gone)
+    db.session.commit()
+    _sp_gone_id = _sp_gone.id
+    db.session.delete(_sp_gone)
+    db.session.commit()
+check("Polling a deleted job is a 404", client.get(f"/api/plan/jobs/{_sp_gone_id}").status_code == 404)
+r = client.get(f"/generate-plan?job={_sp_job}", follow_redirects=True)
+check("Finished streamed job shows its plan", b"Plan generated! Review it below." in r.data and b"Brace" in r.data)
+
+print("\n--- AI Response Cache ---")
+import threading as _threading
+import ai as _ai
+import ai_cache as _ai_cache
+from ai_cache import ai_responses as _ai_responses
+from datetime import datetime as _datetime
+from models import AIResponse as _AIResponse
+
+_review_text = json.dumps({"whats_working": "Consistency", "watch_out_for": "Sleep",
+                           "suggestions": ["Add a rest day"], "overall_assessment": "Bring it!"})
+
+
+def _review_reply(mock_client, text=_review_text):
+    mock_client.return_value.messages.create.return_value.content = [_mock.MagicMock(text=text)]
+    return mock_client.return_value.messages.create
+
+
+with app.app_context():
+    _ai_responses.clear()
+    _ac_profile = UserProfile.query.first()
+    with _mock.patch("ai.get_client") as _mock_client:
+        _ac_create = _review_reply(_mock_client)
+        _ac_first = _ai.generate_progress_review(_ac_profile, [{"date": "2024-01-01", "sets": []}])
+        _ac_again = _ai.generate_progress_review(_ac_profile, [{"date": "2024-01-01", "sets": []}])
+        check("Identical review request is answered from the cache",
+              _ac_create.call_count == 1 and _ac_first == _ac_again == json.loads(_review_text))
+        _ai.generate_progress_review(_ac_profile, [{"date": "2024-01-02", "sets": []}])
+        check("Different inputs call the model", _ac_create.call_count == 2)
+    check("Cache counts hits and misses", {k: _ai_responses.stats()[k] for k in ("entries", "hits", "misses")}
+          == {"entries": 2, "hits": 1, "misses": 2} and abs(_ai_responses.stats()["hit_rate"] - 1 / 3) < 1e-9)
+
+    with _mock.patch("ai.get_client") as _mock_client:
+        _ac_create = _review_reply(_mock_client, "Sorry, no JSON today")
+        for _ in range(2):
+            try:
+                _ai.generate_progress_review(_ac_profile, [{"date": "2024-01-03", "sets": []}])
+            except ValueError:
+                pass
+        check("Unparseable response is not cached", _ac_create.call_count == 2
+              and _ai_responses.stats()["entries"] == 2)
+
+    _ac_events = []
+    with _mock.patch("ai.get_client") as _mock_client:
+        _stream_response(_mock_client, _sp_text)
+        _ac_plan = _ai.generate_workout_plan(_ac_profile, extra_context="cache me")
+        _ac_cached = _ai.generate_workout_plan(_ac_profile, extra_context="cache me",
+                                               on_event=lambda kind, data: _ac_events.append(kind))
+        check("Identical plan request is answered from the cache",
+              _mock_client.return_value.messages.stream.call_count == 1 and _ac_cached == _ac_plan == _sp_plan)
+        check("Cached plan replays its streamed parts",
+              _ac_events == ["meta", "meta", "phase", "phase", "workout", "workout"])
+        _ai.generate_workout_plan(_ac_profile, extra_context="cache me", refresh=True)
+        _ai.generate_workout_plan(_ac_profile, extra_context="cache me")
+        check("Regenerate asks the model again, and its plan replaces the cached one",
+              _mock_client.return_value.messages.stream.call_count == 2)
+
+    db.session.execute(db.update(_AIResponse).values(expires_at=_datetime(2000, 1, 1)))
+    db.session.commit()
+    with _mock.patch("ai.get_client") as _mock_client:
+        _ac_create = _review_reply(_mock_client)
+        _ai.generate_progress_review(_ac_profile, [{"date": "2024-01-01", "sets": []}])
+        check("Expired entry calls the model again", _ac_create.call_count == 1)
+
+    _ai_responses.configure(_ai_responses.ttl, len(_review_text.encode()) + 10)
+    with _mock.patch("ai.get_client") as _mock_client:
+        _review_reply(_mock_client)
+        _ai.generate_progress_review(_ac_profile, [{"date": "2024-02-01", "sets": []}])
+    check("Cache evicts down to its byte limit", _ai_responses.stats()["entries"] == 1
+          and _ai_responses.stats()["bytes"] <= _ai_responses.max_bytes and _ai_responses.stats()["evictions"] >= 3)
+    _ai_responses.configure(_ai_responses.ttl, _ai_cache.DEFAULT_MAX_BYTES)
+
+    _ac_boom = {"model": "m", "prompt": "boom"}
+    try:
+        _ai_responses.fetch(_ac_boom, lambda: 1 / 0)
+    except ZeroDivisionError:
+        pass
+    _ac_row = db.session.get(_AIResponse, _ai_cache.request_key(_ac_boom))
+    check("Failed call leaves its error for the callers waiting on it",
+          _ac_row.status == "failed" and "division by zero" in _ac_row.response_text)
+    try:
+        _ai_responses._claim(_ai_cache.request_key(_ac_boom), "m", waited=True)
+        check("A waiter raises the failed call's error instead of calling again", False)
+    except _ai_cache.SharedCallError as _e:
+        check("A waiter raises the failed call's error instead of calling again", "division by zero" in str(_e))
+    check("A new request after a failure calls again",
+          _ai_responses.fetch(_ac_boom, lambda: "recovered") == "recovered")
+
+    _ac_busy = {"model": "m", "prompt": "busy"}
+    db.session.add(_AIResponse(key=_ai_cache.request_key(_ac_busy), model="m", status="pending",
+                               claim_id="other", claimed_at=_ai_cache._now()))
+    db.session.commit()
+    try:
+        _ai_responses.fetch(_ac_busy, lambda: "never", max_wait=0)
+        check("Waiting on another caller's call stops at the deadline", False)
+    except _ai_cache.SharedCallError:
+        check("Waiting on another caller's call stops at the deadline", True)
+
+    def _ac_fail_other(seconds):
+        db.session.execute(db.update(_AIResponse).where(_AIResponse.claim_id == "other")
+                           .values(status="failed", response_text="upstream overloaded"))
+        db.session.commit()
+
+    with _mock.patch.object(_ai_cache, "time", _mock.Mock(sleep=_ac_fail_other)):
+        try:
+            _ai_responses.fetch(_ac_busy, lambda: "never")
+            check("A waiting request fails with the call it waited on", False)
+        except _ai_cache.SharedCallError as _e:
+            check("A waiting request fails with the call it waited on", str(_e) == "upstream overloaded")
+
+    _ac_lapsed = {"model": "m", "prompt": "lapsed"}
+    _ac_lapsed_key = _ai_cache.request_key(_ac_lapsed)
+    _ac_first_claim, _ = _ai_responses._claim(_ac_lapsed_key, "m")
+    db.session.execute(db.update(_AIResponse).where(_AIResponse.key == _ac_lapsed_key)
+                       .values(claimed_at=_datetime(2000, 1, 1)))
+    db.session.commit()
+    _ac_second_claim, _ = _ai_responses._claim(_ac_lapsed_key, "m")
+    _ai_responses._store(_ac_lapsed_key, _ac_first_claim, "stale")
+    _ai_responses._fail(_ac_lapsed_key, _ac_first_claim, RuntimeError("stale"))
+    db.session.expire_all()
+    check("A caller whose claim lapsed cannot overwrite its successor's row",
+          _ac_second_claim not in (None, _ac_first_claim)
+          and db.session.get(_AIResponse, _ac_lapsed_key).status == "pending")
+    _ai_responses._store(_ac_lapsed_key, _ac_second_claim, "current")
+    check("The current claimant stores its response",
+          _ai_responses.fetch(_ac_lapsed, lambda: "never") == "current")
+
+    _ac_key = _ai_cache.request_key({"prompt": "abandoned", "model": "m"})
+    db.session.add(_AIResponse(key=_ac_key, model="m", status="pending", claimed_at=_datetime(2000, 1, 1)))
+    db.session.commit()
+    check("Abandoned claim is taken over",
+          _ai_responses.fetch({"model": "m", "prompt": "abandoned"}, lambda: "fresh") == "fresh")
+    check("Request key ignores argument order", _ac_key == _ai_cache.request_key({"model": "m", "prompt": "abandoned"}))
+
+# Concurrent identical requests share one call
+_ac_started, _ac_release, _ac_calls, _ac_results = _threading.Event(), _threading.Event(), [], []
+
+
+def _ac_slow_call():
+    _ac_calls.append(1)
+    _ac_started.set()
+    _ac_release.wait(5)
+    return "shared"
+
+
+def _ac_fetch():
+    with app.app_context():
+        _ac_results.append(_ai_responses.fetch({"model": "m", "prompt": "slow"}, _ac_slow_call))
+
+
+_ac_waiters = set()
+
+
+def _ac_poll(seconds):
+    _ac_waiters.add(_threading.get_ident())
+    _ac_release.wait(0.01)
+
+
+with _mock.patch.object(_ai_cache, "time", _mock.Mock(sleep=_ac_poll)):
+    _ac_threads = [_threading.Thread(target=_ac_fetch) for _ in range(3)]
+    _ac_threads[0].start()
+    _ac_started.wait(5)
+    for _t in _ac_threads[1:]:
+        _t.start()
+    for _ in range(500):  # until both are waiting on the first call
+        if len(_ac_waiters) == 2:
+            break
+        _ac_release.wait(0.01)
+    _ac_release.set()
+    for _t in _ac_threads:
+        _t.join(5)
+with app.app_context():
+    check("Concurrent identical requests make one upstream call",
+          len(_ac_calls) == 1 and _ac_results == ["shared"] * 3 and _ai_responses.stats()["coalesced"] == 2)
+
+_ai_responses.configure(0, _ai_cache.DEFAULT_MAX_BYTES)
+with app.app_context():
+    _ac_calls.clear()
+    _ai_responses.fetch({"model": "m", "prompt": "slow"}, lambda: _ac_calls.append(1) or "x")
+    check("TTL of 0 disables the cache", _ac_calls == [1])
+_ai_responses.configure(_ai_cache.DEFAULT_TTL_SECONDS, _ai_cache.DEFAULT_MAX_BYTES)
+
+with app.app_context():
+    _ac_reviews = AIReview.query.count()
+with _mock.patch("ai.get_client") as _mock_client:
+    _ac_create = _review_reply(_mock_client)
+    client.post("/review/generate")
+    r = client.post("/review/generate", follow_redirects=True)
+with app.app_context():
+    check("Re-submitted review makes one call and saves one review",
+          b"Progress review generated!" in r.data and _ac_create.call_count == 1
+          and AIReview.query.count() == _ac_reviews + 1)
+    _ai_responses.clear()
+
+print("\n--- AI Client Resilience ---")
+import time as _time
+from http.server import BaseHTTPRequestHandler as _BaseHandler, ThreadingHTTPServer as _StubServer
+import anthropic as _anthropic
+import ai_client as _ai_client_mod
+from ai_client import ai_client as _ai_client, CircuitOpenError as _CircuitOpenError
+
+_stub_script, _stub_seen = [], []
+
+
+def _stub_message(text):
+    return {"id": "msg_stub", "type": "message", "role": "assistant", "model": "claude-opus-4-6",
+            "content": [{"type": "text", "text": text}], "stop_reason": "end_turn", "stop_sequence": None,
+            "usage": {"input_tokens": 1, "output_tokens": 1}}
+
+
+def _stub_events(text, chunk_size=50, truncate=False):
+    message = dict(_stub_message(""), content=[], stop_reason=None)
+    events = [("message_start", {"type": "message_start", "message": message}),
+              ("content_block_start", {"type": "content_block_start", "index": 0,
+                                       "content_block": {"type": "text", "text": ""}})]
+    events += [("content_block_delta", {"type": "content_block_delta", "index": 0,
+                                        "delta": {"type": "text_delta", "text": text[i:i + chunk_size]}})
+               for i in range(0, len(text), chunk_size)]
+    if truncate:
+        return "".join(f"event: {e}\ndata: {json.dumps(d)}\n\n" for e, d in events[:3])
+    events += [("content_block_stop", {"type": "content_block_stop", "index": 0}),
+               ("message_delta", {"type": "message_delta", "delta": {"stop_reason": "end_turn", "stop_sequence": None},
+                                  "usage": {"output_tokens": 1}}),
+               ("message_stop", {"type": "message_stop"})]
+    return "".join(f"event: {e}\ndata: {json.dumps(d)}\n\n" for e, d in events)
+
+
+class _StubHandler(_BaseHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        _stub_seen.append((self.path, self.client_address[1], body.get("stream", False)))
+        status, payload, delay = _stub_script.pop(0) if _stub_script else (500, {"error": "unscripted"}, 0)
+        _time.sleep(delay)
+        if isinstance(payload, str):  # a Server-Sent Events stream
+            data = payload.encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "text/event-stream")
+            if payload.endswith("\n\n") and "message_stop" not in payload:
+                self.send_header("Content-Length", str(len(data) + 100))  # promise more than is sent
+            else:
+                self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+            self.wfile.flush()
+            if "message_stop" not in payload:
+                self.close_connection = True
+            return
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        if status in (429, 529):
+            self.send_header("Retry-After", "0")
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class _QuietStubServer(_StubServer):
+    def handle_error(self, request, client_address):
+        pass  # a client that timed out hangs up mid-response: expected here
+
+
+_stub_server = _QuietStubServer(("127.0.0.1", 0), _StubHandler)
+_threading.Thread(target=_stub_server.serve_forever, daemon=True).start()
+_stub_error = {"type": "error", "error": {"type": "api_error", "message": "boom"}}
+_overloaded = {"type": "error", "error": {"type": "overloaded_error", "message": "Overloaded"}}
+
+os.environ.setdefault("ANTHROPIC_API_KEY", "stub-key")
+_ai_responses.configure(0, _ai_cache.DEFAULT_MAX_BYTES)  # every call goes upstream
+_ai_client.configure(connect_timeout=1, read_timeout=0.5, max_retries=2, breaker_failures=3, breaker_reset=0.3,
+                     base_url=f"http://127.0.0.1:{_stub_server.server_port}")
+_ai_client.breaker.reset()
+_ac_sessions = [{"date": "2024-03-01", "sets": []}]
+with _mock.patch.object(_ai_client_mod, "BACKOFF_BASE", 0.01), app.app_context():
+    _ac_profile = UserProfile.query.first()
+
+    _stub_script[:] = [(529, _overloaded, 0), (500, _stub_error, 0), (200, _stub_message(_review_text), 0)]
+    _stub_seen.clear()
+    _ac_retries = _ai_client.retries
+    _ac_review = _ai.generate_progress_review(_ac_profile, _ac_sessions)
+    check("Overloaded and 5xx responses are retried",
+          _ac_review == json.loads(_review_text) and len(_stub_seen) == 3 and _ai_client.retries - _ac_retries == 2)
+
+    _stub_script[:] = [(200, _stub_message(_review_text), 0), (200, _stub_message(_review_text), 0)]
+    _stub_seen.clear()
+    _ai.generate_progress_review(_ac_profile, _ac_sessions)
+    _ai.generate_progress_review(_ac_profile, _ac_sessions)
+    check("One pooled client reuses its connection",
+          _ai.get_client() is _ai.get_client() and len({port for _, port, _ in _stub_seen}) == 1)
+
+    _stub_script[:] = [(400, {"type": "error", "error": {"type": "invalid_request_error", "message": "bad"}}, 0)]
+    _stub_seen.clear()
+    try:
+        _ai.generate_progress_review(_ac_profile, _ac_sessions)
+        check("Client errors are not retried", False)
+    except _anthropic.BadRequestError:
+        check("Client errors are not retried", len(_stub_seen) == 1 and _ai_client.breaker.state == "closed")
+
+    _ai_client.configure(connect_timeout=1, read_timeout=0.3, max_retries=0, breaker_failures=3, breaker_reset=0.3,
+                         base_url=_ai_client.base_url)
+    _stub_script[:] = [(200, _stub_message(_review_text), 1.5)]
+    _ac_start = _time.monotonic()
+    try:
+        _ai.generate_progress_review(_ac_profile, _ac_sessions)
+        check("Hung response hits the read deadline", False)
+    except _anthropic.APITimeoutError:
+        check("Hung response hits the read deadline", _time.monotonic() - _ac_start < 1.2)
+    _ai_client.configure(connect_timeout=1, read_timeout=2, max_retries=2, breaker_failures=3, breaker_reset=0.3,
+                         base_url=_ai_client.base_url)
+    _ai_client.breaker.reset()
+
+    _stub_script[:] = [(529, _overloaded, 0), (200, _stub_events(_sp_text), 0)]
+    _stub_seen.clear()
+    _ac_events = []
+    _ac_plan = _ai.generate_workout_plan(_ac_profile, on_event=lambda kind, data: _ac_events.append(kind))
+    check("Streamed plan is retried before any text arrives",
+          _ac_plan == _sp_plan and [stream for _, _, stream in _stub_seen] == [True, True]
+          and _ac_events.count("workout") == 2)
+
+    _stub_script[:] = [(200, _stub_events(_sp_text, truncate=True), 0), (200, _stub_events(_sp_text), 0)]
+    _stub_seen.clear()
+    _ac_events = []
+    try:
+        _ai.generate_workout_plan(_ac_profile, on_event=lambda kind, data: _ac_events.append(kind))
+        check("Stream that breaks after text arrived is not retried", False)
+    except Exception as _e:
+        check("Stream that breaks after text arrived is not retried",
+              _ai_client_mod.retryable(_e) and len(_stub_seen) == 1 and "workout" not in _ac_events)
+    _ai_client.breaker.reset()
+    _stub_script.clear()
+
+    _stub_script[:] = [(500, _stub_error, 0)] * 3
+    _stub_seen.clear()
+    try:
+        _ai.generate_progress_review(_ac_profile, _ac_sessions)
+    except _anthropic.InternalServerError:
+        pass
+    check("Repeated failures open the circuit breaker", _ai_client.breaker.state == "open" and len(_stub_seen) == 3)
+    _ac_start = _time.monotonic()
+    try:
+        _ai.generate_progress_review(_ac_profile, _ac_sessions)
+        check("Open breaker fails fast without calling the API", False)
+    except _CircuitOpenError as _e:
+        check("Open breaker fails fast without calling the API",
+              len(_stub_seen) == 3 and _time.monotonic() - _ac_start < 0.1 and "try again" in str(_e))
+
+r = client.post("/review/generate", follow_redirects=True)
+check("Review page reports the unavailable API", b"The AI service is unavailable right now" in r.data)
+
+_time.sleep(0.35)
+with _mock.patch.object(_ai_client_mod, "BACKOFF_BASE", 0.01), app.app_context():
+    check("Breaker is half-open after its reset period", _ai_client.breaker.state == "half-open")
+    _stub_script[:] = [(500, _stub_error, 0)]
+    try:
+        _ai.generate_progress_review(_ac_profile, _ac_sessions)
+    except _anthropic.InternalServerError:
+        pass
+    check("Failed trial call re-opens the breaker", _ai_client.breaker.state == "open" and not _stub_script)
+    _time.sleep(0.35)
+
+    def _local_failure():
+        raise RuntimeError("database is locked")  # e.g. an on_event write, before the API said anything
+
+    try:
+        _ai_client.call(_local_failure)
+    except RuntimeError:
+        pass
+    check("A local error in the trial call does not close the breaker",
+          _ai_client.breaker.state == "half-open" and _ai_client.breaker._failed == 4)
+    _stub_script[:] = [(200, _stub_message(_review_text), 0)]
+    check("Successful trial call closes the breaker",
+          _ai.generate_progress_review(_ac_profile, _ac_sessions) == json.loads(_review_text)
+          and _ai_client.breaker.state == "closed")
+
+
+print("\n--- Prompt Caching ---")
+from models import AICall as _AICall
+
+with _mock.patch("ai.get_client") as _mock_client:
+    _stream_response(_mock_client, _sp_text)
+    with app.app_context():
+        _ac_profile = UserProfile.query.first()
+        _ai.generate_workout_plan(_ac_profile, extra_context="Knees are cranky")
+        _pc_plan = _mock_client.return_value.messages.stream.call_args.kwargs
+        _ai.generate_workout_plan(_ac_profile, extra_context="Travelling next month")
+        _pc_plan_2 = _mock_client.return_value.messages.stream.call_args.kwargs
+check("Plan instructions are a cacheable system prefix",
+      _pc_plan["system"] == [{"type": "text", "text": _ai.PLAN_INSTRUCTIONS, "cache_control": {"type": "ephemeral"}}]
+      and "Return a JSON object" in _ai.PLAN_INSTRUCTIONS and "Goals:" not in _ai.PLAN_INSTRUCTIONS)
+check("Plan user message holds only the person's details",
+      "Knees are cranky" in _pc_plan["messages"][0]["content"]
+      and "Return a JSON object" not in _pc_plan["messages"][0]["content"])
+check("Different inputs share the same plan prefix",
+      _pc_plan_2["system"] == _pc_plan["system"] and _pc_plan_2["messages"] != _pc_plan["messages"])
+
+with _mock.patch("ai.get_client") as _mock_client:
+    _pc_create = _review_reply(_mock_client)
+    with app.app_context():
+        _ai.generate_progress_review(_ac_profile, [{"date": "2024-04-01", "sets": []}], plan_name="Cached")
+_pc_review = _pc_create.call_args.kwargs
+check("Review persona is a cacheable system prefix",
+      _pc_review["system"][0]["cache_control"] == {"type": "ephemeral"}
+      and "Tony Horton" in _pc_review["system"][0]["text"] and "2024-04-01" in _pc_review["messages"][0]["content"]
+      and "catchphrases" not in _pc_review["messages"][0]["content"])
+
+_pc_usage = {"input_tokens": 120, "output_tokens": 900, "cache_creation_input_tokens": 0,
+             "cache_read_input_tokens": 1400}
+_pc_stream = _stub_events(_sp_text).replace('"usage": {"input_tokens": 1, "output_tokens": 1}',
+                                            f'"usage": {json.dumps(_pc_usage)}', 1)
+_stub_script[:] = [(200, _pc_stream, 0),
+                   (200, dict(_stub_message(_review_text), usage=dict(_pc_usage, cache_creation_input_tokens=700,
+                                                                      cache_read_input_tokens=0)), 0)]
+with _mock.patch.object(_ai_client_mod, "BACKOFF_BASE", 0.01), app.app_context():
+    _ai_client.breaker.reset()
+    _pc_before = _AICall.query.count()
+    _ai.generate_workout_plan(_ac_profile, extra_context="stub usage")
+    _ai.generate_progress_review(_ac_profile, [{"date": "2024-04-02", "sets": []}])
+    _pc_calls = _AICall.query.order_by(_AICall.id).all()[_pc_before:]
+    check("Each call records its prompt cache token counts",
+          [(c.kind, c.input_tokens, c.cache_read_input_tokens, c.cache_creation_input_tokens) for c in _pc_calls]
+          == [("plan", 120, 1400, 0), ("review", 120, 0, 700)])
+    check("Streamed calls record time to first token",
+          _pc_calls[0].first_token_ms is not None and _pc_calls[1].first_token_ms is None
+          and all(c.duration_ms >= 0 for c in _pc_calls))
+    _pc_stats = _ai.call_stats()
+    check("Call stats total the prompt cache per kind",
+          _pc_stats["plan"]["cache_read_input_tokens"] >= 1400
+          and _pc_stats["review"]["cache_creation_input_tokens"] >= 700)
+
+    _stub_script[:] = [(500, _stub_error, 0), (200, _stub_message(_review_text), 0)]
+    _pc_before = _AICall.query.count()
+    _ai.generate_progress_review(_ac_profile, [{"date": "2024-04-03", "sets": []}])
+    check("A retried call records its usage once", _AICall.query.count() - _pc_before == 1)
+
+with _mock.patch("ai.get_client") as _mock_client, _mock.patch("ai._tokens", side_effect=RuntimeError("locked")), \
+        _mock.patch("ai.logger") as _pc_logger, app.app_context():
+    _pc_create = _review_reply(_mock_client)
+    _pc_result = _ai.generate_progress_review(_ac_profile, [{"date": "2024-04-04", "sets": []}])
+    check("A failure to record usage is logged, not raised or retried",
+          _pc_result == json.loads(_review_text) and _pc_create.call_count == 1 and _pc_logger.exception.called)
+
+_stub_server.shutdown()
+_stub_server.server_close()
+_ai_client.configure()
+_ai_client.breaker.reset()
+_ai_responses.configure(_ai_cache.DEFAULT_TTL_SECONDS, _ai_cache.DEFAULT_MAX_BYTES)
+
 # Summary
 print(f"\n{'='*50}")
 print(f"Results: {passed} passed, {failed} failed out of {passed + failed} tests")
 
-# Clean up temp DB
-try:
-    os.unlink(_db_path)
-except Exception:
-    pass
+# Clean up temp DB (and its WAL side files)
+for _suffix in ("", "-wal", "-shm"):
+    try:
+        os.unlink(_db_path + _suffix)
+    except Exception:
+        pass
 
 if failed > 0:
     sys.exit(1)